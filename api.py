@@ -0,0 +1,313 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+from data_loader import load_area_layer, source_fingerprint
+from grade_utils import GRADE_TO_NUMERIC
+from media_fetcher import get_media_batch
+from metrics import increment, registry, span
+from route_store import ROUTE_BACKEND, get_route_store
+from shared_store import current_version
+from ui_components import apply_filters
+
+logger = logging.getLogger(__name__)
+
+API_HOST = os.environ.get("API_HOST", "127.0.0.1")
+API_PORT = int(os.environ.get("API_PORT", "8000"))
+
+# Problems per page: the default, and the most a client may ask for
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+# Responses smaller than this many bytes are not worth compressing
+API_GZIP_MINIMUM_SIZE = 500
+
+# Problem columns returned by /problems, with the name each one gets in the JSON
+PROBLEM_FIELDS = {
+    'id': 'id', 'name': 'name', 'name_en': 'name_en', 'grade': 'grade', 'area_name': 'area',
+    'steepness': 'steepness', 'sit_start': 'sit_start', 'latitude': 'latitude', 'longitude': 'longitude',
+    'popularity': 'popularity', 'circuit_color': 'circuit_color', 'bleau_info_id': 'bleau_info_id',
+}
+
+SIT_START_OPTIONS = {'sit': "Sit Start Only", 'standing': "Standing Start Only"}
+
+# Serialized problems kept for recent /problems queries, so paging through one or repeating it
+# does not refilter; about 250 bytes each
+API_QUERY_CACHE_ROWS = 200_000
+
+_query_cache = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+# Media lookups that may go out to bleau.info run in worker threads, at most this many at once, so
+# slow fetches cannot take every thread the other endpoints need
+API_MEDIA_CONCURRENCY = int(os.environ.get("API_MEDIA_CONCURRENCY", "8"))
+_media_slots = asyncio.Semaphore(API_MEDIA_CONCURRENCY)
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def _local_version():
+    return hashlib.sha1(f"{ROUTE_BACKEND}:{source_fingerprint()}".encode()).hexdigest()[:16]
+
+
+def dataset_version():
+    """The published route store version, or a fingerprint of the database the store was built from.
+
+    Checked on every request, which costs one stat() of the database when
+    no store is published, so edits to it show up as new ETags at once.
+    """
+    return (current_version() if ROUTE_BACKEND == "memory" else None) or _local_version()
+
+
+def _etag(request, version):
+    # Weak, since the gzip middleware may change the bytes but not the meaning
+    query = sorted(request.query_params.multi_items())
+    digest = hashlib.sha1(json.dumps([request.url.path, query]).encode()).hexdigest()[:16]
+    return f'W/"{version}-{digest}"'
+
+
+def _cached(request, endpoint, version, build):
+    """Answer 304 if the client holds the current ETag for this request, else the response `build()` returns."""
+    etag = _etag(request, version)
+    if etag in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+        response = Response(status_code=304)
+    else:
+        try:
+            response = build()
+        except BadRequest as e:
+            response = JSONResponse({'error': str(e)}, status_code=400)
+    if response.status_code in (200, 304):
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'no-cache'
+    increment("api_requests_total", endpoint=endpoint, status=str(response.status_code))
+    return response
+
+
+def _grade(value, name):
+    if value.isdigit():
+        return int(value)
+    # An unencoded + in the query string, as in grade_min=6a+, arrives as a space
+    grade = value.rstrip(' ') + '+' if value.endswith(' ') else value
+    if grade in GRADE_TO_NUMERIC:
+        return GRADE_TO_NUMERIC[grade]
+    raise BadRequest(f"{name} must be a grade like 6a+ or a numeric grade, not {value!r}")
+
+
+def _number(value, name, kind=float):
+    try:
+        return kind(value)
+    except ValueError:
+        raise BadRequest(f"{name} must be a number, not {value!r}") from None
+
+
+def parse_filters(params):
+    """Turn /problems query parameters into a filter dict like create_sidebar_filters() returns."""
+    popularity = None
+    if 'popularity_min' in params or 'popularity_max' in params:
+        popularity = (
+            _number(params.get('popularity_min', '0'), 'popularity_min', int),
+            _number(params.get('popularity_max', str(2 ** 31)), 'popularity_max', int),
+        )
+    sit_start = params.get('sit_start', 'all')
+    if sit_start not in (*SIT_START_OPTIONS, 'all'):
+        raise BadRequest("sit_start must be sit, standing or all")
+    return {
+        'search_query': params.get('q', '').strip(),
+        'selected_grade_range': (
+            _grade(params.get('grade_min', '0'), 'grade_min'),
+            _grade(params.get('grade_max', str(max(GRADE_TO_NUMERIC.values()))), 'grade_max'),
+        ),
+        'selected_steepness': params.getlist('steepness'),
+        'selected_areas': params.getlist('area'),
+        'sit_start_option': SIT_START_OPTIONS.get(sit_start, "All"),
+        'selected_popularity': popularity,
+    }
+
+
+def _bbox(value):
+    parts = value.split(',')
+    if len(parts) != 4:
+        raise BadRequest("bbox must be south,west,north,east")
+    return [_number(part, 'bbox') for part in parts]
+
+
+def encode_cursor(version, offset):
+    return base64.urlsafe_b64encode(json.dumps([version, offset]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        version, offset = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        version, offset = str(version), int(offset)
+    except (TypeError, ValueError):
+        raise BadRequest("invalid cursor") from None
+    if offset < 0:
+        raise BadRequest("invalid cursor")
+    return version, offset
+
+
+def _matching_records(version, params):
+    """Every problem matching the /problems query parameters, as one JSON object string each.
+
+    Results are memoized per dataset version, least recently used first
+    out once they hold more than API_QUERY_CACHE_ROWS problems in total.
+    """
+    key = (version, tuple(sorted((name, value) for name, value in params.multi_items() if name not in ('cursor', 'limit'))))
+    with _query_cache_lock:
+        if key in _query_cache:
+            _query_cache.move_to_end(key)
+            return _query_cache[key]
+
+    filters = parse_filters(params)
+    with span("api_problems"):
+        store = get_route_store()
+        routes = apply_filters(store, filters)
+        if 'bbox' in params:
+            routes = store.routes_in_bounds(routes, *_bbox(params['bbox']))
+        if 'bleau_info_id' in params:
+            routes = routes[routes['bleau_info_id'].isin(params.getlist('bleau_info_id'))]
+        routes = routes[list(PROBLEM_FIELDS)].rename(columns=PROBLEM_FIELDS)
+        # Non-ASCII is escaped, so records never contain a raw newline
+        records = routes.to_json(orient='records', lines=True).split('\n') if len(routes) else []
+        records = [record for record in records if record]
+    with _query_cache_lock:
+        _query_cache[key] = records
+        total = sum(len(cached) for cached in _query_cache.values())
+        while total > API_QUERY_CACHE_ROWS and len(_query_cache) > 1:
+            total -= len(_query_cache.popitem(last=False)[1])
+    return records
+
+
+def problems(request):
+    """GET /problems: the problems matching the sidebar filters, one page at a time.
+
+    Accepts grade_min and grade_max (a grade like 6a+, whose + may be sent
+    unencoded, or a numeric grade), steepness and area (both repeatable),
+    sit_start (sit, standing or all), popularity_min, popularity_max, q (a
+    name search), bbox (south,west,north,east) and bleau_info_id
+    (repeatable, e.g. a project list), plus limit and the cursor returned as
+    next_cursor by the previous page. Cursors are only valid for the
+    dataset version they were issued for.
+    """
+    version = dataset_version()
+
+    def build():
+        params = request.query_params
+        limit = min(max(_number(params.get('limit', str(API_PAGE_SIZE)), 'limit', int), 1), API_MAX_PAGE_SIZE)
+        offset = 0
+        if 'cursor' in params:
+            cursor_version, offset = decode_cursor(params['cursor'])
+            if cursor_version != version:
+                return JSONResponse({'error': "the dataset changed, start again without a cursor"}, status_code=410)
+
+        records = _matching_records(version, params)
+        next_cursor = encode_cursor(version, offset + limit) if offset + limit < len(records) else None
+        body = (
+            f'{{"version": {json.dumps(version)}, "count": {len(records)}, '
+            f'"next_cursor": {json.dumps(next_cursor)}, "problems": [{",".join(records[offset:offset + limit])}]}}'
+        )
+        return Response(body, media_type='application/json')
+
+    return _cached(request, 'problems', version, build)
+
+
+def _media_payload(problem_id):
+    """Media of a problem as /problems/{id}/media returns it, or None if there is no such problem."""
+    routes = get_route_store().routes_by_id([problem_id])
+    if routes.empty:
+        return None
+    route = routes.iloc[0]
+    bleau_info_id = route['bleau_info_id'] if isinstance(route['bleau_info_id'], str) else None
+    media = (None, None)
+    if bleau_info_id:
+        media = get_media_batch([(route['area_name'], bleau_info_id)]).get(bleau_info_id, media)
+    return {'id': int(route['id']), 'bleau_info_id': bleau_info_id, 'video': media[0], 'image': media[1]}
+
+
+async def problem_media(request):
+    """GET /problems/{id}/media: the video and photo of a problem, as the map popups show them.
+
+    Media comes from the media cache, the mirror index or bleau.info, so
+    it can change without the dataset changing; its ETag is therefore
+    derived from the content rather than the dataset version. Lookups run
+    in the thread pool, at most API_MEDIA_CONCURRENCY at a time.
+    """
+    problem_id = request.path_params['problem_id']
+    async with _media_slots:
+        payload = await run_in_threadpool(_media_payload, problem_id)
+    if payload is None:
+        increment("api_requests_total", endpoint='media', status='404')
+        return JSONResponse({'error': f"no problem {problem_id}"}, status_code=404)
+    digest = hashlib.sha1(json.dumps(payload).encode()).hexdigest()[:16]
+    return _cached(request, 'media', digest, lambda: JSONResponse(payload))
+
+
+@lru_cache(maxsize=1)
+def _area_features():
+    return json.loads(load_area_layer())['features']
+
+
+def areas(request):
+    """GET /areas: every area with its bounds, priority and number of problems."""
+    def build():
+        counts = get_route_store().facet_counts({
+            'selected_grade_range': (0, max(GRADE_TO_NUMERIC.values())), 'selected_steepness': [],
+            'selected_areas': [], 'sit_start_option': "All", 'selected_popularity': None,
+        })['areas']
+        result = []
+        for feature in _area_features():
+            properties = feature['properties']
+            (west, south), _, (east, north), *_ = feature['geometry']['coordinates'][0]
+            result.append({
+                'id': properties['area_id'], 'name': properties['name'], 'priority': properties['priority'],
+                'bounds': [south, west, north, east], 'problems': counts.get(properties['name'], 0),
+            })
+        return JSONResponse(result)
+
+    return _cached(request, 'areas', dataset_version(), build)
+
+
+def metrics(request):
+    return PlainTextResponse(registry.prometheus_text(), media_type='text/plain; version=0.0.4')
+
+
+app = Starlette(
+    routes=[
+        Route('/problems', problems),
+        Route('/problems/{problem_id:int}/media', problem_media),
+        Route('/areas', areas),
+        Route('/metrics', metrics),
+    ],
+    middleware=[Middleware(GZipMiddleware, minimum_size=API_GZIP_MINIMUM_SIZE)],
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(
+        description="Serve the route store as a JSON API. With several workers, "
+                    "publish the store first (python shared_store.py) so they share one copy."
+    )
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    uvicorn.run("api:app", host=args.host, port=args.port, workers=args.workers, log_level="warning")
@@ -1,60 +1,145 @@
+import logging
+import os
+
 import streamlit as st
 from streamlit_folium import st_folium
 
 # Import our modular components
-from data_loader import load_areas_geojson, load_data
-from grade_utils import grade_to_numeric
-from map_utils import create_map_with_areas
+from data_loader import load_area_layer
+from map_utils import DEFAULT_ZOOM, get_map_with_areas
+from media_server import start_media_server
+from metrics import start_metrics_log, timed
+from route_store import get_route_store
 from ui_components import (
+    PROJECT_LIST_FRAGMENT,
+    TABLE_FRAGMENT,
     apply_filters,
     create_data_table,
     create_project_list_section,
+    create_similar_routes_section,
     create_sidebar_filters,
+    limit_to_viewport,
+    routes_in_view,
     show_too_many_routes_message,
 )
 
+# Largest number of routes rendered on the map and in the table
+MAP_RENDER_BUDGET = 2000
+
 # Configure the page
 st.set_page_config(layout="wide")
 
-# Load data
-data = load_data()
-areas_data = load_areas_geojson()
+# App logs go to stderr; set LOG_LEVEL=DEBUG for per-stage timings and media lookup details
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+# Serve /metrics next to the popup media, and append snapshots to METRICS_JSONL if set
+start_media_server()
+start_metrics_log()
 
-# Add numeric grade column for filtering
-data['grade_numeric'] = data['grade'].apply(grade_to_numeric)
+# Load data (built once per process and shared by every session)
+store = get_route_store()
+area_layer = load_area_layer()
 
 # Initialize project list in session state
 if 'project_list' not in st.session_state:
     st.session_state.project_list = set()
 
+def _known_bounds(bounds):
+    """Bounds reported by the browser, or None for st_folium's placeholder before the first report."""
+    try:
+        return bounds if bounds['_southWest']['lat'] is not None else None
+    except (KeyError, TypeError):
+        return None
+
+
+@st.fragment(key=PROJECT_LIST_FRAGMENT)
+def project_list_fragment():
+    create_project_list_section(store)
+
+
+@st.fragment
+@timed("map_fragment")
+def map_fragment(filtered_data, filters):
+    """Draw the map; panning and zooming rerun only this fragment.
+
+    When the table follows the map view, a new view reported on a
+    fragment-only rerun reruns the whole app so the table catches up.
+    """
+    full_run = st.session_state.pop('map_full_run', False)
+    map_state = st.session_state.get('route_map') or {}
+    bounds = _known_bounds(map_state.get('bounds'))
+    center = map_state.get('center')
+    zoom = map_state.get('zoom') or DEFAULT_ZOOM
+
+    # Build the map for the current view, clustered server-side for the
+    # current zoom, or reuse it if nothing it shows has changed
+    m = get_map_with_areas(
+        routes_in_view(store, filtered_data, bounds),
+        area_layer,
+        filters['show_areas'],
+        store=store,
+        zoom=zoom,
+        bounds=bounds,
+        show_trails=filters['show_trails'],
+    )
+    result = st_folium(
+        m,
+        key='route_map',
+        width='100%',
+        height=560,
+        returned_objects=['bounds', 'center', 'zoom'],
+        center=(center['lat'], center['lng']) if center else None,
+        zoom=zoom if center else None,
+    )
+
+    new_bounds = _known_bounds((result or {}).get('bounds'))
+    if not full_run and filters['viewport_only'] and new_bounds != st.session_state.get('table_bounds'):
+        st.rerun()
+
+
+@st.fragment(key=TABLE_FRAGMENT)
+def table_fragment(visible_data):
+    create_data_table(visible_data, store)
+    create_similar_routes_section(store)
+
+
 # Main application
+@timed("rerun")
 def main():
     st.title("🧗‍♀️ Fontainebleau Route Finder")
     st.markdown("Welcome to the interactive Fontainebleau bouldering map. Use the filters in the sidebar to discover your next project!")
 
     # Create sidebar filters
-    filters = create_sidebar_filters(data)
+    filters = create_sidebar_filters(store)
     
     # Create project list section
-    create_project_list_section(data)
+    with st.sidebar:
+        project_list_fragment()
     
     # Apply filters to data
-    filtered_data = apply_filters(data, filters)
+    filtered_data = apply_filters(store, filters)
     
-    # Display map and table only when filtered to 100 or fewer routes
-    if len(filtered_data) <= 100:
+    # Display map and table when following the map view or when few enough routes match
+    if filters['viewport_only'] or len(filtered_data) <= MAP_RENDER_BUDGET:
         st.header("Route Locations")
-        
+
+        # Narrow the table down to the last reported map view and the render budget
+        map_state = st.session_state.get('route_map') or {}
+        bounds = _known_bounds(map_state.get('bounds')) if filters['viewport_only'] else None
+        st.session_state.table_bounds = bounds
+        visible_data, in_view = limit_to_viewport(store, filtered_data, bounds, MAP_RENDER_BUDGET)
+        if in_view > len(visible_data):
+            st.caption(f"Showing the {len(visible_data)} most popular of {in_view} routes in view - zoom in to see the rest.")
+
         # Create and display map
-        m = create_map_with_areas(filtered_data, areas_data, filters['show_areas'])
-        st_folium(m, width='100%', height=560, returned_objects=[])
-        
+        st.session_state.map_full_run = True
+        map_fragment(filtered_data, filters)
+
         # Create data table
-        create_data_table(filtered_data, data)
+        table_fragment(visible_data)
     else:
         # Show message when too many routes are selected
-        show_too_many_routes_message(filtered_data)
-
+        show_too_many_routes_message(store, filters, MAP_RENDER_BUDGET)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,1293 @@
+"""Offline benchmarks and consistency checks for the app's hot paths.
+
+Run from the repository root, e.g.:
+
+    python benchmark.py suite --json results.jsonl
+    python benchmark.py compare baseline.jsonl results.jsonl
+    python benchmark.py load
+    python benchmark.py table
+    python benchmark.py media --limit 2000
+    python benchmark.py map
+    python benchmark.py filters
+    python benchmark.py spatial
+    python benchmark.py backends
+    python benchmark.py topo
+    python benchmark.py tiles
+    python benchmark.py search
+    python benchmark.py fragments
+    python benchmark.py facets
+    python benchmark.py metrics
+    python benchmark.py thumbnails
+    python benchmark.py refresh
+    python benchmark.py startup
+    python benchmark.py shared
+    python benchmark.py api
+    python benchmark.py similar
+
+Pass --db with a database written by scale_dataset.py to run against 10x
+or 100x the real routes, and --json to append every timing as a JSON line
+tagged with the git commit, for comparing runs with `compare`.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import warnings
+
+# Timings reported by the running benchmark, written out by --json
+results = []
+_current = {}
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def _report(name, timings):
+    timings = sorted(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    results.append({
+        **_current, 'name': name, 'n': len(timings), 'mean_ms': statistics.mean(timings) * 1000,
+        'p50_ms': statistics.median(timings) * 1000, 'p99_ms': p99 * 1000,
+    })
+    print(
+        f"{name:<28} n={len(timings):<6} mean={statistics.mean(timings) * 1000:8.3f} ms  "
+        f"p50={statistics.median(timings) * 1000:8.3f} ms  p99={p99 * 1000:8.3f} ms"
+    )
+
+
+def bench_load(args):
+    """Time loading the typed route table from SQLite and from the snapshot, and grade conversion.
+
+    The snapshot is skipped if it has not been built (`python data_loader.py`)
+    or is stale; tests/test_data_loader.py checks that it loads the same frame
+    as the SQLite path.
+    """
+    from data_loader import ROUTE_DB, ROUTE_SNAPSHOT, prepare_routes, read_problems, read_snapshot
+    from grade_utils import grade_to_numeric, grades_to_numeric
+
+    read_times, prepare_times, snapshot_times = [], [], []
+    for _ in range(args.repeat):
+        data, elapsed = _timed(read_problems)
+        read_times.append(elapsed)
+        routes, elapsed = _timed(prepare_routes, data)
+        prepare_times.append(elapsed)
+        snapshot, elapsed = _timed(read_snapshot)
+        snapshot_times.append(elapsed)
+    print(f"{ROUTE_DB}: {len(data)} routes")
+    _report("read_problems", read_times)
+    _report("prepare_routes", prepare_times)
+    if snapshot is None:
+        print(f"{ROUTE_SNAPSHOT}: missing or stale, skipped")
+    else:
+        _report("read_snapshot", snapshot_times)
+
+    grades = data['grade']
+    row_times, column_times = [], []
+    for _ in range(args.repeat):
+        expected, elapsed = _timed(lambda: grades.apply(grade_to_numeric))
+        row_times.append(elapsed)
+        result, elapsed = _timed(grades_to_numeric, grades)
+        column_times.append(elapsed)
+    _report("grade_to_numeric per row", row_times)
+    _report("grades_to_numeric column", column_times)
+    parity = (expected.to_numpy() == result.to_numpy()).all()
+    print(f"parity: grade conversions identical: {parity}")
+    return bool(parity)
+
+
+def bench_media(args):
+    """Time the targeted media extractor against the BeautifulSoup reference over mirror pages.
+
+    tests/test_media_extractor.py checks that both give the same results.
+    """
+    from media_extractor import extract_media, extract_media_soup
+    from media_index import iter_mirror_pages
+
+    pages = list(iter_mirror_pages())
+    if args.limit:
+        pages = pages[:args.limit]
+
+    fast_times, soup_times = [], []
+    for bleau_info_id, area_slug, path in pages:
+        with open(path, 'rb') as f:
+            content = f.read()
+        fast_times.append(_timed(extract_media, content)[1])
+        soup_times.append(_timed(extract_media_soup, content)[1])
+
+    _report("extract_media", fast_times)
+    _report("extract_media_soup", soup_times)
+    print(f"speedup: {sum(soup_times) / sum(fast_times):.1f}x over {len(pages)} pages")
+    return True
+
+
+def bench_map(args):
+    """Time building and rendering the folium map for growing route counts.
+
+    Maps are clustered server-side at the default zoom, as in the app; the
+    page size should stay roughly flat from 10 routes to the full table.
+    """
+    import map_utils
+    from data_loader import load_area_layer
+    from route_store import get_route_store
+
+    store = get_route_store()
+    data = store.data
+    area_layer = load_area_layer()
+
+    sizes = [size for size in (10, 100, 1000) if size < len(data)] + [len(data)]
+    for size in sizes:
+        subset = data.sample(n=size, random_state=0) if size < len(data) else data
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            m = map_utils.create_map_with_areas(subset, area_layer, show_areas=True, store=store)
+            html = m.get_root().render()
+            timings.append(time.perf_counter() - start)
+        _report(f"map {size} routes", timings)
+        print(f"{'':<28} html={len(html) / 1024:.0f} KiB")
+    return True
+
+
+def bench_table(args):
+    """Time preparing the data editor rows for growing route counts, with five projects.
+
+    Media is left out (it is resolved over the network for at most 100
+    rows); see the media benchmark for the extraction side.
+    """
+    from route_store import get_route_store
+    from ui_components import build_editor_frame, combine_with_projects
+
+    data = get_route_store().data
+    projects = data.nlargest(5, 'popularity')
+    project_list = set(projects['bleau_info_id'])
+
+    for size in [size for size in (10, 100, 1000) if size < len(data)] + [len(data)]:
+        subset = data.sample(n=size, random_state=0) if size < len(data) else data
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            editor_df = build_editor_frame(combine_with_projects(subset, projects, project_list), {})
+            timings.append(time.perf_counter() - start)
+        _report(f"table {size} routes", timings)
+    return len(editor_df) >= len(data)
+
+
+def _apply_filters_pandas(data, filters):
+    """The original mask-chaining filter implementation, kept as the parity reference."""
+    filtered_data = data.copy()
+    filtered_data = filtered_data[
+        (filtered_data['grade_numeric'] >= filters['selected_grade_range'][0]) &
+        (filtered_data['grade_numeric'] <= filters['selected_grade_range'][1])
+    ]
+    if filters['selected_steepness']:
+        filtered_data = filtered_data[filtered_data['steepness'].isin(filters['selected_steepness'])]
+    if filters['selected_areas']:
+        filtered_data = filtered_data[filtered_data['area_name'].isin(filters['selected_areas'])]
+    if filters['sit_start_option'] == "Sit Start Only":
+        filtered_data = filtered_data[filtered_data['sit_start'] == 1]
+    elif filters['sit_start_option'] == "Standing Start Only":
+        filtered_data = filtered_data[filtered_data['sit_start'] == 0]
+    if filters['selected_popularity']:
+        filtered_data = filtered_data[
+            (filtered_data['popularity'] >= filters['selected_popularity'][0]) &
+            (filtered_data['popularity'] <= filters['selected_popularity'][1])
+        ]
+    return filtered_data
+
+
+def _filter_combinations(data, count=50, seed=0):
+    """Representative sidebar filter dicts: defaults, single areas, narrow grades, etc."""
+    import random
+
+    rng = random.Random(seed)
+    steepness = sorted(data['steepness'].dropna().unique())
+    areas = sorted(data['area_name'].dropna().unique())
+    max_popularity = int(data['popularity'].max())
+    combinations = [{
+        'selected_grade_range': (16, 27),
+        'selected_steepness': steepness,
+        'selected_areas': [],
+        'sit_start_option': "All",
+        'selected_popularity': (0, max_popularity),
+    }]
+    while len(combinations) < count:
+        low = rng.randint(0, 30)
+        combinations.append({
+            'selected_grade_range': (low, rng.randint(low, 34)),
+            'selected_steepness': rng.sample(steepness, rng.randint(0, len(steepness))),
+            'selected_areas': rng.sample(areas, rng.choice([0, 1, 1, 2, 5])),
+            'sit_start_option': rng.choice(["All", "Sit Start Only", "Standing Start Only"]),
+            'selected_popularity': (rng.choice([0, 0, 10, 100]), max_popularity),
+        })
+    return combinations
+
+
+def _bench_filter_table(label, data, combinations):
+    from filter_engine import FilterEngine
+
+    engine, build_time = _timed(FilterEngine, data)
+    print(f"{label}: {len(data)} rows, index build {build_time * 1000:.1f} ms")
+
+    reference_times, cold_times, warm_times, mismatches = [], [], [], 0
+    for filters in combinations:
+        reference, reference_time = _timed(_apply_filters_pandas, data, filters)
+        result, cold_time = _timed(engine.apply, filters)
+        _, warm_time = _timed(engine.apply, filters)
+        reference_times.append(reference_time)
+        cold_times.append(cold_time)
+        warm_times.append(warm_time)
+        if not reference.index.equals(result.index):
+            mismatches += 1
+
+    _report("apply_filters (pandas)", reference_times)
+    _report("FilterEngine (cold)", cold_times)
+    _report("FilterEngine (memoized)", warm_times)
+    print(f"parity: {len(combinations) - mismatches}/{len(combinations)} filter combinations identical")
+    return not mismatches
+
+
+def bench_filters(args):
+    """Time filter latency on the full problem table and on a synthetic 1M-row table."""
+    from route_store import get_route_store
+
+    data = get_route_store().data
+    combinations = _filter_combinations(data, count=args.limit or 50)
+    ok = _bench_filter_table("full table", data, combinations)
+
+    synthetic = data.sample(n=1_000_000, replace=True, random_state=0).reset_index(drop=True)
+    ok = _bench_filter_table("synthetic table", synthetic, combinations[:10]) and ok
+    return ok
+
+
+def bench_facets(args):
+    """Check the facet counts against FilterEngine and the areas table, and time them.
+
+    For every filter combination, each sidebar option's count must equal
+    the number of routes FilterEngine selects with that option alone, and
+    the summary statistics must equal those of the selected rows. The
+    per-area totals and grade family counts are also compared with the
+    problems_count and level1-8_count columns of the areas table.
+    """
+    import sqlite3
+
+    import numpy as np
+
+    from cluster_index import GRADE_FAMILIES, GRADE_FAMILY
+    from data_loader import ROUTE_DB
+    from facet_cube import FacetCube
+    from route_store import get_route_store
+
+    store = get_route_store()
+    data = store.data
+    cube, build_time = _timed(FacetCube, data)
+    engine = store.filter_engine
+    print(f"cube build {build_time * 1000:.1f} ms, {cube.count_prefix.nbytes / 1024:.0f} KiB of counts")
+
+    combinations = _filter_combinations(data, count=args.limit or 30)
+    options = store.filter_options()
+    count_times, summary_times, mismatches = [], [], 0
+    for filters in combinations:
+        counts, elapsed = _timed(cube.counts, filters)
+        count_times.append(elapsed)
+        summary, elapsed = _timed(cube.summary, filters)
+        summary_times.append(elapsed)
+
+        mismatches += counts['total'] != len(engine.select(filters))
+        for area in options['areas'][::8]:
+            mismatches += counts['areas'][area] != len(engine.select({**filters, 'selected_areas': [area]}))
+        for steepness in options['steepness']:
+            mismatches += counts['steepness'][steepness] != len(engine.select({**filters, 'selected_steepness': [steepness]}))
+        for option, count in counts['sit_start'].items():
+            mismatches += count != len(engine.select({**filters, 'sit_start_option': option}))
+        for grade in range(0, 35, 3):
+            mismatches += counts['grades'][grade] != len(engine.select({**filters, 'selected_grade_range': (grade, grade)}))
+
+        rows = engine.apply(filters)
+        if len(rows):
+            mismatches += (
+                summary['count'] != len(rows) or summary['areas'] != rows['area_name'].nunique()
+                or abs(summary['mean_grade'] - rows['grade_numeric'].mean()) > 1e-9
+                or abs(summary['mean_popularity'] - rows['popularity'].mean()) > 1e-6
+            )
+    _report("facet counts", count_times)
+    _report("facet summary", summary_times)
+    print(f"parity: {mismatches} mismatches against FilterEngine over {len(combinations)} filter combinations")
+
+    # Consistency with the per-area counts that ship with the database
+    con = sqlite3.connect(ROUTE_DB)
+    try:
+        areas = con.execute(
+            "SELECT name, problems_count, " + ", ".join(f"level{level}_count" for level in range(1, 9)) + " FROM areas"
+        ).fetchall()
+    finally:
+        con.close()
+    everything = {
+        'selected_grade_range': (0, 34), 'selected_steepness': [], 'selected_areas': [],
+        'sit_start_option': "All", 'selected_popularity': None,
+    }
+    per_area = cube.counts(everything)['areas']
+    total_off, level_off = [], []
+    for name, problems_count, *levels in areas:
+        if per_area.get(name, 0) != problems_count:
+            total_off.append(f"{name} ({per_area.get(name, 0)} vs {problems_count})")
+        per_grade = cube.counts({**everything, 'selected_areas': [name]})['grades']
+        families = np.bincount(GRADE_FAMILY, weights=per_grade, minlength=GRADE_FAMILIES)[1:9]
+        if families.astype(int).tolist() != levels:
+            level_off.append(name)
+    print(f"areas.problems_count: {len(areas) - len(total_off)}/{len(areas)} areas agree {total_off[:5]}")
+    print(f"areas.level1-8_count: {len(areas) - len(level_off)}/{len(areas)} areas agree {level_off[:5]}")
+    return not mismatches
+
+
+def bench_spatial(args):
+    """Time radius, viewport and nearest-K queries and check them against brute force."""
+    import numpy as np
+
+    from route_store import get_route_store
+    from spatial_index import SpatialIndex
+
+    data = get_route_store().data
+    index, build_time = _timed(SpatialIndex, data['latitude'], data['longitude'])
+    print(f"index build {build_time * 1000:.1f} ms over {len(index)} routes")
+
+    rng = np.random.default_rng(0)
+    points = data[['latitude', 'longitude']].to_numpy()[rng.integers(0, len(data), args.limit or 200)]
+    x, y = index._project(data['latitude'].to_numpy(), data['longitude'].to_numpy())
+
+    radius_times, bounds_times, nearest_times, mismatches = [], [], [], 0
+    for lat, lon in points:
+        px, py = index._project(lat, lon)
+        distances = np.hypot(x - px, y - py)
+
+        result, elapsed = _timed(index.within_radius, lat, lon, 300)
+        radius_times.append(elapsed)
+        mismatches += set(result) != set(np.flatnonzero(distances <= 300))
+
+        box = (lat - 0.01, lon - 0.015, lat + 0.01, lon + 0.015)
+        result, elapsed = _timed(index.within_bounds, *box)
+        bounds_times.append(elapsed)
+        lats, lons = data['latitude'].to_numpy(), data['longitude'].to_numpy()
+        expected = np.flatnonzero((lats >= box[0]) & (lats <= box[2]) & (lons >= box[1]) & (lons <= box[3]))
+        mismatches += not np.array_equal(result, expected)
+
+        (result, result_distances), elapsed = _timed(index.nearest, lat, lon, 10)
+        nearest_times.append(elapsed)
+        mismatches += not np.allclose(result_distances, np.sort(distances)[:10])
+
+    _report("within_radius 300 m", radius_times)
+    _report("within_bounds ~2 km box", bounds_times)
+    _report("nearest k=10", nearest_times)
+    print(f"parity: {mismatches} mismatches against brute force over {len(points)} points")
+    return not mismatches
+
+
+def bench_similar(args):
+    """Time similar problem queries and check them against brute force and the SQLite backend.
+
+    Project lists are random problems with a bleau.info ID; the answer
+    must match a direct, unblocked distance computation over every
+    problem, and the SQLite backend must suggest the same problems.
+    """
+    import numpy as np
+
+    from route_store import get_route_store
+    from similarity_index import problem_features
+    from sql_backend import SqlRouteStore
+
+    store = get_route_store()
+    data = store.data
+    _, build_time = _timed(lambda: store.similarity_index)
+    features = problem_features(data)
+    print(f"index build {build_time * 1000:.1f} ms over {len(data)} routes, {features.shape[1]} features")
+
+    rng = np.random.default_rng(0)
+    listed = np.flatnonzero(data['bleau_info_id'].fillna('') != '')
+    sql_store = SqlRouteStore()
+    mismatches = 0
+    for size in (1, 10, 100):
+        timings = []
+        for _ in range(args.limit or 50):
+            projects = set(data['bleau_info_id'].iloc[rng.choice(listed, size, replace=False)])
+            result, elapsed = _timed(store.similar_routes, projects, 10)
+            timings.append(elapsed)
+
+            positions = np.flatnonzero(data['bleau_info_id'].isin(projects))
+            distances = np.full(len(data), np.inf)
+            for chunk in np.array_split(positions, max(1, len(positions) // 10)):
+                difference = features[None, :, :] - features[chunk][:, None, :]
+                distances = np.minimum(distances, np.sqrt((difference ** 2).sum(axis=2)).min(axis=0))
+            distances[positions] = np.inf
+            distances[np.setdiff1d(np.arange(len(data)), listed)] = np.inf
+            mismatches += not np.allclose(np.sort(distances)[:10], np.sort(distances[result.index.to_numpy()]))
+            mismatches += bool(result['bleau_info_id'].isin(projects).any())
+            if size == 10 and len(timings) <= 5:
+                mismatches += not np.array_equal(sql_store.similar_routes(projects, 10)['id'], result['id'])
+        _report(f"similar top 10, {size} projects", timings)
+    print(f"parity: {mismatches} mismatches against brute force and the SQLite backend")
+    return not mismatches
+
+
+def bench_backends(args):
+    """Time the SQLite backend against the in-memory store.
+
+    Runs on a temporary copy of boolder.db prepared by sql_backend.prepare_database(),
+    so the working database is left untouched. tests/test_sql_backend.py checks that
+    both backends give the same answers.
+    """
+    import os
+    import shutil
+    import tempfile
+
+    from route_store import get_route_store
+    from sql_backend import ROUTE_DB, SqlRouteStore, prepare_database
+
+    memory = get_route_store()
+    combinations = _filter_combinations(memory.data, count=args.limit or 50)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "boolder.db")
+        shutil.copyfile(ROUTE_DB, db_path)
+        _, prepare_time = _timed(prepare_database, db_path)
+        print(f"prepare_database {prepare_time * 1000:.1f} ms")
+        sql = SqlRouteStore(db_path)
+        for method in ('apply_filters', 'facet_counts'):
+            _report(f"memory {method}", [_timed(getattr(memory, method), filters)[1] for filters in combinations])
+            _report(f"sqlite {method}", [_timed(getattr(sql, method), filters)[1] for filters in combinations])
+        sql.con.close()
+    return True
+
+
+def bench_topo(args):
+    """Time cold load and per-problem lookups of the packed topo line store against JSON decoding.
+
+    Builds the store into a temporary directory and checks every problem's
+    lines against the JSON in the lines table.
+    """
+    import json
+    import sqlite3
+    import tempfile
+
+    import numpy as np
+
+    from topo_store import TOPO_DB, TopoStore, build_topo_store, topo_svg
+
+    con = sqlite3.connect(TOPO_DB)
+    problem_ids = [row[0] for row in con.execute("SELECT id FROM problems ORDER BY id")]
+    if args.limit:
+        problem_ids = problem_ids[:args.limit]
+
+    def json_lines(problem_id):
+        rows = con.execute(
+            "SELECT topo_id, coordinates FROM lines WHERE problem_id = ? ORDER BY id", (problem_id,)
+        ).fetchall()
+        return [(topo_id, json.loads(coordinates or 'null') or []) for topo_id, coordinates in rows]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _, build_time = _timed(build_topo_store, TOPO_DB, tmp)
+        print(f"build_topo_store {build_time * 1000:.1f} ms")
+
+        cold_times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            store = TopoStore(tmp)
+            store.lines(problem_ids[0])
+            cold_times.append(time.perf_counter() - start)
+
+        lookup_times, json_times, svg_times, mismatches = [], [], [], 0
+        for problem_id in problem_ids:
+            lines, lookup_time = _timed(store.lines, problem_id)
+            reference, json_time = _timed(json_lines, problem_id)
+            _, svg_time = _timed(topo_svg, lines)
+            lookup_times.append(lookup_time)
+            json_times.append(json_time)
+            svg_times.append(svg_time)
+            expected = [(topo_id, np.array([(p['x'], p['y']) for p in points], dtype=np.float32).reshape(-1, 2))
+                        for topo_id, points in reference]
+            if len(lines) != len(expected) or any(
+                topo_id != expected_topo or not np.array_equal(points, expected_points)
+                for (topo_id, points), (expected_topo, expected_points) in zip(lines, expected)
+            ):
+                mismatches += 1
+        del store
+    con.close()
+
+    _report("cold load + first lookup", cold_times)
+    _report("TopoStore.lines", lookup_times)
+    _report("SQLite + json.loads", json_times)
+    _report("topo_svg", svg_times)
+    print(f"parity: {len(problem_ids) - mismatches}/{len(problem_ids)} problems identical")
+    return not mismatches
+
+
+# Largest trails payload of one map view accepted by `tiles`, in bytes
+TILE_VIEW_BUDGET = 64 * 1024
+
+
+def bench_tiles(args):
+    """Time building the tile pyramid and reading the trails for map views at several zoom levels.
+
+    A view is a 1200x600 pixel window around a random route. Fails if a
+    zoom level of the pyramid has no tiles or a view's payload exceeds
+    TILE_VIEW_BUDGET. tests/test_tile_pyramid.py checks the simplified
+    trails against trails.geojson.
+    """
+    import json
+    import os
+    import sqlite3
+    import tempfile
+
+    import numpy as np
+
+    from cluster_index import TILE_SIZE, world_coordinates
+    from route_store import get_route_store
+    from tile_pyramid import TILE_MAX_ZOOM, TILE_MIN_ZOOM, TRAILS_GEOJSON, build_tile_pyramid, read_tiles, to_lonlat
+
+    data = get_route_store().data
+    rng = np.random.default_rng(0)
+    centers = data[['latitude', 'longitude']].to_numpy()[rng.integers(0, len(data), args.limit or 50)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "tiles.mbtiles")
+        _, build_time = _timed(build_tile_pyramid, db_path)
+        print(f"build_tile_pyramid {build_time:.2f} s, {os.path.getsize(db_path) / 1024:.0f} KiB")
+        print(f"raw {TRAILS_GEOJSON}: {os.path.getsize(TRAILS_GEOJSON) / 1024:.0f} KiB")
+        con = sqlite3.connect(db_path)
+        tiled = {zoom for (zoom,) in con.execute("SELECT DISTINCT zoom_level FROM tiles")}
+        con.close()
+        missing = sorted(set(range(TILE_MIN_ZOOM, TILE_MAX_ZOOM + 1)) - tiled)
+        print(f"zoom levels without tiles: {missing or 'none'}")
+        ok = not missing
+
+        for zoom in (11, 13, 15, 17):
+            timings, sizes = [], []
+            half_width, half_height = 600 / (TILE_SIZE * 2 ** zoom), 300 / (TILE_SIZE * 2 ** zoom)
+            for lat, lon in centers:
+                x, y = world_coordinates([lat], [lon])
+                west, north = to_lonlat(x[0] - half_width, y[0] - half_height)
+                east, south = to_lonlat(x[0] + half_width, y[0] + half_height)
+                trails, elapsed = _timed(read_tiles, south, west, north, east, zoom, ('trails',), db_path)
+                timings.append(elapsed)
+                sizes.append(len(json.dumps(trails)))
+            _report(f"trails in view z{zoom}", timings)
+            print(f"{'':<28} mean payload={statistics.mean(sizes) / 1024:.1f} KiB  max={max(sizes) / 1024:.1f} KiB")
+            ok = ok and max(sizes) <= TILE_VIEW_BUDGET
+    return ok
+
+
+def bench_search(args):
+    """Time name search and check that misspelled names still find their problem.
+
+    Queries are the names of random problems with one character dropped,
+    doubled or swapped; each must return its problem in the top 10,
+    whether or not the query is combined with the default filters.
+    """
+    import random
+
+    from name_search import normalize_name
+    from route_store import get_route_store
+
+    store = get_route_store()
+    data = store.data
+    _, build_time = _timed(lambda: store.name_index)
+    print(f"index build {build_time * 1000:.1f} ms over {len(data)} routes")
+
+    rng = random.Random(0)
+    named = data[data['name'].map(normalize_name).str.len() >= 8]
+    sample = named.sample(n=args.limit or 500, random_state=0)
+    filtered = store.apply_filters(_filter_combinations(data, count=1)[0])
+
+    timings, filtered_timings, misses = [], [], 0
+    for position, name in zip(sample.index, sample['name']):
+        i = rng.randrange(1, len(name) - 1)
+        query = rng.choice([
+            name[:i] + name[i + 1:],                              # dropped
+            name[:i] + name[i] + name[i:],                        # doubled
+            name[:i - 1] + name[i] + name[i - 1] + name[i + 1:],  # swapped
+        ])
+        result, elapsed = _timed(store.search, data, query, 10)
+        timings.append(elapsed)
+        # Problems sharing the exact normalized name are all equally good answers
+        misses += normalize_name(name) not in set(result['name'].map(normalize_name))
+        _, elapsed = _timed(store.search, filtered, query, 10)
+        filtered_timings.append(elapsed)
+
+    _report("search top 10", timings)
+    _report("search top 10 + filters", filtered_timings)
+    print(f"recall: {len(sample) - misses}/{len(sample)} misspelled names found in the top 10")
+    return misses <= len(sample) * 0.05
+
+
+def _tick_project(at):
+    """Tick the first unticked Project checkbox of the app's route table as a browser would, and rerun.
+
+    AppTest has no data editor API, so the edit is sent as the widget state
+    the frontend would send. Returns the ticked route's bleau.info ID.
+    """
+    from streamlit.proto.WidgetStates_pb2 import WidgetStates
+
+    editor = next(element for element in at.get('dataframe') if (element.key or '').startswith('projects_'))
+    rows = editor.value
+    position = int(rows['Project'].to_numpy(dtype=bool).argmin())
+    states = WidgetStates()
+    states.widgets.extend(state for state in at._tree.get_widget_states().widgets if state.id != editor.proto.id)
+    edit = states.widgets.add()
+    edit.id = editor.proto.id
+    edit.string_value = json.dumps({
+        'edited_rows': {str(position): {'Project': True}}, 'added_rows': [], 'deleted_rows': [],
+    })
+    at._run(states)
+    return rows['bleau_info_id'].iloc[position]
+
+
+def bench_fragments(args):
+    """Time project list edits made in the table and check that they never rerun the map.
+
+    Runs app.py under Streamlit's AppTest and ticks Project checkboxes in
+    the route table. Each edit must rerun only the project list and table
+    fragments: the map fragment and the app body must not run, and the
+    sidebar count and the table header must show the new project.
+    """
+    import os
+
+    from streamlit.testing.v1 import AppTest
+
+    from metrics import registry
+    from route_store import get_route_store
+
+    def runs(stage):
+        histogram = registry.histogram('stage_seconds', stage=stage)
+        return histogram.count if histogram is not None else 0
+
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    at = AppTest.from_file(app_path, default_timeout=300)
+    _, first_time = _timed(at.run)
+    builds = registry.counter('map_builds_total')
+    print(f"first run {first_time * 1000:.0f} ms, {builds} map build(s)")
+
+    map_runs, app_runs = runs('map_fragment'), runs('rerun')
+    timings, ok = [], not at.exception and map_runs > 0
+    for count in range(1, (args.limit or 3) + 1):
+        _, elapsed = _timed(_tick_project, at)
+        timings.append(elapsed)
+        sidebar = [markdown.value for markdown in at.sidebar.markdown]
+        headers = [header.value for header in at.header]
+        ok = (
+            ok and not at.exception and len(at.session_state['project_list']) == count
+            and f"**{count} routes** in your project list" in sidebar
+            and any(f"+ {count} projects" in header for header in headers)
+        )
+
+    _report("fragment rerun after project edit", timings)
+    reran = runs('map_fragment') - map_runs, runs('rerun') - app_runs
+    print(f"map fragment / app runs during project edits: {reran[0]} / {reran[1]}")
+    print(f"sidebar and table show the edited project list: {ok}")
+
+    # A filter change must still rebuild the map, or the counters prove nothing; the tree of a
+    # fragment rerun holds only the fragments' elements, so run the whole app to get the filters back
+    at.run()
+    at.multiselect[1].set_value([get_route_store().data['area_name'].iloc[0]]).run()
+    filter_builds = registry.counter('map_builds_total') - builds
+    print(f"map builds after a filter change: {filter_builds}")
+    return ok and builds > 0 and reran == (0, 0) and filter_builds > 0
+
+
+def bench_metrics(args):
+    """Run the app a few times and check the exported stage timings and counters.
+
+    Scrapes /metrics from the media server like Prometheus would, and
+    writes and summarizes one JSON-lines snapshot.
+    """
+    import os
+    import tempfile
+    from urllib.request import urlopen
+
+    from streamlit.testing.v1 import AppTest
+
+    from media_server import get_media_server_url
+    from metrics import registry, summarize, write_snapshot
+
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    at = AppTest.from_file(app_path, default_timeout=300)
+    for _ in range(args.repeat):
+        at.run()
+    ok = not at.exception
+
+    stages = ('rerun', 'load_data', 'apply_filters', 'create_map_with_areas', 'create_data_table')
+    for stage in stages:
+        histogram = registry.histogram('stage_seconds', stage=stage)
+        ok = ok and histogram is not None
+        if histogram is not None:
+            print(
+                f"{stage:<28} n={histogram.count:<6} p50={histogram.quantile(0.5) * 1000:8.1f} ms  "
+                f"p99={histogram.quantile(0.99) * 1000:8.1f} ms"
+            )
+
+    url = get_media_server_url()
+    if url:
+        text = urlopen(url.rsplit('/', 1)[0] + '/metrics').read().decode('utf-8')
+        scraped = all(f'stage="{stage}"' in text for stage in stages)
+        print(f"/metrics: {len(text.splitlines())} lines, all stages present: {scraped}")
+        ok = ok and scraped
+    else:
+        print("/metrics: media server not running, skipped")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "metrics.jsonl")
+        write_snapshot(path)
+        summarize(path)
+    return ok
+
+
+# Cold start budgets, in seconds, checked by `startup`
+IMPORT_BUDGET = 2.5
+FIRST_RENDER_BUDGET = 1.0
+
+# Modules that must not be imported until first used
+LAZY_MODULES = ('bs4', 'requests')
+
+_STARTUP_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter() - start
+from streamlit.testing.v1 import AppTest
+from metrics import registry
+at = AppTest.from_file(app.__file__, default_timeout=300).run()
+print(json.dumps({
+    'import': imported,
+    'render': registry.histogram('stage_seconds', stage='rerun').sum,
+    'load_data': registry.histogram('stage_seconds', stage='load_data').sum,
+    'errors': len(at.exception),
+}))
+"""
+
+_LAZY_PROBE = """
+import json, sys
+import data_loader, media_extractor, media_fetcher, media_index, media_server, route_store, ui_components
+print(json.dumps(sorted(set(sys.modules) & set(sys.argv[1:]))))
+"""
+
+
+def bench_startup(args):
+    """Check the cold start of a fresh process against IMPORT_BUDGET and FIRST_RENDER_BUDGET.
+
+    Each repetition imports app.py in a new interpreter, then renders it
+    once under AppTest; the render time is the app's own `rerun` stage,
+    which includes loading the routes and building the route store.
+    Also checks that none of LAZY_MODULES is imported by the app's modules
+    (folium, which the map needs, still imports requests itself).
+    """
+    import os
+
+    from data_loader import ROUTE_SNAPSHOT, read_snapshot
+
+    root = os.path.dirname(os.path.abspath(__file__))
+
+    def probe(code, *argv):
+        completed = subprocess.run(
+            [sys.executable, "-c", code, *argv], cwd=root, capture_output=True, text=True, check=True
+        )
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+    if read_snapshot() is None:
+        print(f"{ROUTE_SNAPSHOT}: missing or stale, measuring the SQLite path")
+    runs = [probe(_STARTUP_PROBE) for _ in range(args.repeat)]
+    _report("import app", [run['import'] for run in runs])
+    _report("first render", [run['render'] for run in runs])
+    _report("load_data (cold)", [run['load_data'] for run in runs])
+    imported = statistics.median(run['import'] for run in runs)
+    rendered = statistics.median(run['render'] for run in runs)
+    print(f"budget: import {imported:.2f}s of {IMPORT_BUDGET}s, first render {rendered:.2f}s of {FIRST_RENDER_BUDGET}s")
+
+    eager = probe(_LAZY_PROBE, *LAZY_MODULES)
+    print(f"imported eagerly by the app's modules: {eager or 'none'}")
+    return (
+        not any(run['errors'] for run in runs) and not eager
+        and imported <= IMPORT_BUDGET and rendered <= FIRST_RENDER_BUDGET
+    )
+
+
+_WORKER_PROBE = """
+import json, sys
+from route_store import get_route_store
+
+def private_bytes():
+    fields = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    return fields['Private_Clean'] + fields['Private_Dirty']
+
+filters = {
+    'selected_grade_range': (10, 20), 'selected_steepness': [], 'selected_areas': [],
+    'sit_start_option': 'All', 'selected_popularity': None,
+}
+before = private_bytes()
+store = get_route_store()
+routes = store.apply_filters(filters)
+store.facet_counts(filters)
+store.search(routes, 'marie rose')
+store.clusters(routes, 12)
+store.spatial_index.within_radius(48.4, 2.6, 500)
+print(json.dumps({'rows': len(store), 'private': private_bytes() - before}), flush=True)
+sys.stdin.readline()
+print(json.dumps({'rows': len(get_route_store())}), flush=True)
+"""
+
+
+def bench_shared(args):
+    """Check that worker processes share one published route store and pick up a new version live.
+
+    Publishes the store to a temporary directory, checks the mapped copy
+    answers like the one it was made from, then starts --repeat workers
+    attached to it and as many that build their own store, comparing the
+    private memory each one adds. The attached workers are then sent a
+    newly published, smaller dataset and must switch to it without a
+    restart.
+    """
+    import os
+    import tempfile
+
+    from data_loader import load_data
+    from route_store import RouteStore
+    from shared_store import attach_store, current_version, publish_store
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    data = load_data()
+    with tempfile.TemporaryDirectory() as tmp:
+        local = RouteStore(data)
+        version, publish_time = _timed(publish_store, local, tmp)
+        shared, attach_time = _timed(attach_store, version, tmp)
+        print(f"published in {publish_time:.2f}s, attached in {attach_time * 1000:.1f} ms")
+        combinations = _filter_combinations(data, args.limit or 20)
+        same = all(shared.apply_filters(filters).equals(local.apply_filters(filters)) for filters in combinations)
+        same = same and all(
+            shared.facet_counts(filters)['total'] == local.facet_counts(filters)['total'] for filters in combinations
+        )
+        print(f"parity: attached store answers {len(combinations)} filter combinations identically: {same}")
+
+        def start_workers(segments):
+            env = {**os.environ, 'ROUTE_SEGMENTS': segments, 'ROUTE_BACKEND': 'memory'}
+            return [
+                subprocess.Popen(
+                    [sys.executable, "-c", _WORKER_PROBE], cwd=root, env=env, text=True,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                )
+                for _ in range(args.repeat)
+            ]
+
+        empty = os.path.join(tmp, "unpublished")
+        attached, building = start_workers(tmp), start_workers(empty)
+        first = [json.loads(worker.stdout.readline()) for worker in attached]
+        built = [json.loads(worker.stdout.readline()) for worker in building]
+        for worker in building:
+            worker.communicate("\n")
+
+        smaller = publish_store(RouteStore(data.iloc[:1000].reset_index(drop=True)), tmp)
+        swapped = [json.loads(worker.communicate("\n")[0].splitlines()[-1]) for worker in attached]
+        swapped_ok = current_version(tmp) == smaller and all(result['rows'] == 1000 for result in swapped)
+        still_readable = len(shared.apply_filters(combinations[0])) == len(local.apply_filters(combinations[0]))
+
+    attached_mib = statistics.median(result['private'] for result in first) / 2 ** 20
+    built_mib = statistics.median(result['private'] for result in built) / 2 ** 20
+    print(f"private memory per worker: attached {attached_mib:.1f} MiB, building its own {built_mib:.1f} MiB")
+    print(f"workers switched to the new version without a restart: {swapped_ok}")
+    print(f"old version still readable after the swap: {still_readable}")
+    return (
+        same and swapped_ok and still_readable and all(result['rows'] == len(data) for result in first)
+        and attached_mib < built_mib / 2
+    )
+
+
+# Connections the api load test keeps open at once, and the requests each one sends
+API_LOAD_CONCURRENCY = 200
+API_LOAD_REQUESTS = 10
+
+
+def _api_query(filters, **extra):
+    """/problems query string for a sidebar filter dict."""
+    from urllib.parse import urlencode
+
+    sit_start = {"Sit Start Only": 'sit', "Standing Start Only": 'standing'}.get(filters['sit_start_option'], 'all')
+    params = [('grade_min', filters['selected_grade_range'][0]), ('grade_max', filters['selected_grade_range'][1])]
+    params += [('steepness', value) for value in filters['selected_steepness']]
+    params += [('area', value) for value in filters['selected_areas']]
+    params.append(('sit_start', sit_start))
+    if filters['selected_popularity']:
+        params += [('popularity_min', filters['selected_popularity'][0]), ('popularity_max', filters['selected_popularity'][1])]
+    return urlencode(params + list(extra.items()))
+
+
+def bench_api(args):
+    """Run api.py under uvicorn, time paging through /problems, then load test it.
+
+    Pages through every filter combination with cursors, then holds
+    API_LOAD_CONCURRENCY keep-alive connections open, each sending
+    API_LOAD_REQUESTS requests, and reports the latencies. Cursors, ETags
+    and error statuses are checked in tests/test_api.py.
+    """
+    import asyncio
+    import os
+    import socket
+    from collections import Counter
+    from urllib.request import urlopen
+
+    from route_store import get_route_store
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    base_url = f"http://127.0.0.1:{port}"
+    root = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen(
+        [sys.executable, "api.py", "--port", str(port)], cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+    def get(path):
+        with urlopen(base_url + path) as response:
+            return response.read()
+
+    try:
+        for _ in range(600):
+            try:
+                get('/areas')
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        combinations = _filter_combinations(get_route_store().data, args.limit or 10)
+        page_times = []
+        for filters in combinations:
+            cursor = None
+            while True:
+                query = _api_query(filters, limit=1000, **({'cursor': cursor} if cursor else {}))
+                body, elapsed = _timed(get, f"/problems?{query}")
+                page_times.append(elapsed)
+                if not (cursor := json.loads(body)['next_cursor']):
+                    break
+        _report("GET /problems page of 1000", page_times)
+
+        urls = [f"/problems?{_api_query(filters)}" for filters in combinations] + [
+            '/areas', '/problems?bbox=48.40,2.60,48.45,2.70', '/problems?q=marie+rose', '/problems?grade_min=7a&limit=1000',
+        ]
+        latencies, statuses = [], Counter()
+
+        async def client(number):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            for i in range(API_LOAD_REQUESTS):
+                url = urls[(number + i) % len(urls)]
+                start = time.perf_counter()
+                writer.write(f"GET {url} HTTP/1.1\r\nHost: 127.0.0.1\r\nAccept-Encoding: gzip\r\n\r\n".encode())
+                status = int((await reader.readline()).split()[1])
+                length = 0
+                while (line := await reader.readline()) not in (b"\r\n", b""):
+                    name, _, value = line.decode().partition(":")
+                    if name.lower() == 'content-length':
+                        length = int(value)
+                await reader.readexactly(length)
+                latencies.append(time.perf_counter() - start)
+                statuses[status] += 1
+            writer.close()
+
+        async def load():
+            await asyncio.gather(*(client(number) for number in range(API_LOAD_CONCURRENCY)))
+
+        start = time.perf_counter()
+        asyncio.run(load())
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    _report(f"request, {API_LOAD_CONCURRENCY} concurrent", latencies)
+    print(f"{len(latencies)} requests in {elapsed:.2f}s ({len(latencies) / elapsed:.0f}/s), statuses {dict(statuses)}")
+    return statuses[200] == API_LOAD_CONCURRENCY * API_LOAD_REQUESTS
+
+
+def bench_thumbnails(args):
+    """Build thumbnails for the mirrored photos, read locally and over HTTP, and check the cache.
+
+    Serves the mirror from a local HTTP stand-in for bleau.info, so the
+    download path runs offline. The same photo fetched under both URLs
+    must land in the same content-addressed file, and a second lookup
+    must find every thumbnail without building anything.
+    """
+    import functools
+    import glob
+    import os
+    import tempfile
+    import threading
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+    from media_index import MIRROR_DIR
+    from metrics import registry
+    from thumbnails import ThumbnailPipeline, thumbnail_path
+
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=MIRROR_DIR))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    paths = sorted(glob.glob(os.path.join(MIRROR_DIR, "images", "**", "*.jpg"), recursive=True))[:args.limit or None]
+    relative = [os.path.relpath(path, MIRROR_DIR).replace(os.sep, '/') for path in paths]
+    mirrored = [f"https://bleau.info/{path}" for path in relative]
+    downloaded = [f"http://127.0.0.1:{server.server_port}/{path}" for path in relative]
+    unreachable = f"http://127.0.0.1:{server.server_port}/images/missing.jpg"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pipeline = ThumbnailPipeline(os.path.join(tmp, "thumbnails"), os.path.join(tmp, "thumbnails.db"))
+        urls = mirrored + downloaded + [unreachable]
+        start = time.perf_counter()
+        first = pipeline.lookup(urls)
+        pipeline.drain()
+        build_time = time.perf_counter() - start
+        ready, lookup_time = _timed(pipeline.lookup, urls)
+        pipeline.executor.shutdown()
+
+        same_files = all(ready.get(a) == ready.get(b) for a, b in zip(mirrored, downloaded))
+        source_bytes = sum(os.path.getsize(path) for path in paths)
+        thumbnail_bytes = sum(os.path.getsize(thumbnail_path(ready[url], pipeline.directory)) for url in mirrored if url in ready)
+    server.shutdown()
+
+    print(f"built {len(ready)} of {len(urls)} images in {build_time:.2f}s ({len(first)} ready before)")
+    histogram = registry.histogram('stage_seconds', stage='thumbnail_build')
+    print(f"per image p50={histogram.quantile(0.5) * 1000:.1f} ms (HTTP copies are rate limited per host)")
+    print(f"lookup of {len(urls)} urls once built: {lookup_time * 1000:.1f} ms")
+    print(f"{source_bytes / 1024:.0f} KiB of photos -> {thumbnail_bytes / 1024:.0f} KiB of table thumbnails")
+    print(f"mirror and HTTP copies share a file: {same_files}; missing image falls back: {unreachable not in ready}")
+    return (
+        not first and same_files and unreachable not in ready
+        and len(ready) == len(mirrored) + len(downloaded) and thumbnail_bytes < source_bytes
+    )
+
+
+def bench_refresh(args):
+    """Time refreshing a copy of part of the mirror from a local HTTP stand-in for bleau.info.
+
+    The stand-in answers conditional GETs with 304 for the ETags HTTrack
+    recorded, except for a few pages edited on the "server" and one it no
+    longer has. A run is cut short halfway and resumed from its manifest,
+    then a second refresh finds nothing to download.
+    tests/test_mirror_refresh.py checks the outcomes.
+    """
+    import os
+    import shutil
+    import sqlite3
+    import tempfile
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import quote, urlparse
+
+    import media_fetcher
+    from mirror_refresh import problem_pages, refresh_mirror
+
+    pages = sorted(problem_pages().items())[:args.limit or 200]
+    edited = {bleau_info_id for bleau_info_id, _ in pages[::10]}
+    removed = pages[-1][0]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        served, etags = {}, {}
+        hts_lines = []
+        for bleau_info_id, record in pages:
+            url_path = urlparse(record['url']).path
+            local = os.path.join(tmp, "bleau.info", url_path.lstrip('/'))
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            shutil.copyfile(record['path'], local)
+            with open(record['path'], 'rb') as f:
+                content = f.read()
+            etag = record['etag']
+            if bleau_info_id in edited:
+                content = content.replace(b"</body>", b"<!-- edited --></body>")
+                etag = f'W/"edited-{bleau_info_id}"'
+            if bleau_info_id != removed:
+                served[url_path], etags[url_path] = content, etag
+            hts_lines.append("\t".join([
+                "00:00:00", "0/0", "------", "200", "added ('OK')", "text/html",
+                f"etag:{quote(record['etag'] or '')}", record['url'], f"./bleau.info{url_path}", "(from )",
+            ]))
+        os.makedirs(os.path.join(tmp, "hts-cache"))
+        hts_index = os.path.join(tmp, "hts-cache", "new.txt")
+        with open(hts_index, 'w') as f:
+            f.write("header\n" + "\n".join(hts_lines) + "\n")
+        db_path = os.path.join(tmp, "routes.db")
+        con = sqlite3.connect(db_path)
+        with con:
+            con.execute("CREATE TABLE problems (bleau_info_id TEXT)")
+            con.executemany("INSERT INTO problems VALUES (?)", [(bleau_info_id,) for bleau_info_id, _ in pages])
+        con.close()
+
+        requests_seen = {'full': 0, 'not_modified': 0}
+
+        class StandIn(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in served:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if self.headers.get('If-None-Match') == etags[self.path]:
+                    requests_seen['not_modified'] += 1
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                requests_seen['full'] += 1
+                self.send_response(200)
+                self.send_header('ETag', etags[self.path])
+                self.send_header('Content-Length', str(len(served[self.path])))
+                self.end_headers()
+                self.wfile.write(served[self.path])
+
+            def log_message(self, format, *args):
+                pass
+
+        # The stand-in is local, so lift the per-host politeness limit
+        media_fetcher.MEDIA_REQUESTS_PER_SECOND = 0
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        mirror_dir = os.path.join(tmp, "bleau.info")
+        manifest = os.path.join(tmp, "hts-cache", "refresh.json")
+
+        def refresh(limit=None):
+            return refresh_mirror(base_url, db_path, mirror_dir, hts_index, manifest, limit=limit, route_db=db_path)
+
+        partial, partial_time = _timed(refresh, len(pages) // 2)
+        resumed, resumed_time = _timed(refresh)
+        again, again_time = _timed(refresh)
+        server.shutdown()
+
+    first = {key: partial[key] + resumed[key] for key in ('changed', 'unchanged', 'gone', 'failed')}
+    print(f"first refresh of {len(pages)} pages: {first} (cut at {len(pages) // 2}, resumed skipping {resumed['skipped']})")
+    print(f"  {partial_time + resumed_time:.2f}s, {requests_seen['full']} full downloads")
+    print(f"second refresh: {again} in {again_time:.2f}s")
+    _report("refresh (all 304)", [again_time])
+    return True
+
+
+# Benchmarks run by `suite`, with the --limit each one gets there
+SUITE = {
+    'load': 0,
+    'filters': 20,
+    'map': 0,
+    'table': 0,
+    'media': 500,
+    'search': 200,
+    'spatial': 200,
+}
+
+
+def bench_suite(args):
+    """Run every hot-path benchmark in turn; see SUITE."""
+    ok = True
+    for name, limit in SUITE.items():
+        print(f"\n== {name}")
+        _current['benchmark'] = name
+        ok = BENCHMARKS[name](argparse.Namespace(**{**vars(args), 'limit': args.limit or limit})) and ok
+    return ok
+
+
+def _load_results(path):
+    """Latest p50 per (benchmark, name, rows) in a --json results file."""
+    latest = {}
+    with open(path) as f:
+        for line in f:
+            result = json.loads(line)
+            latest[(result['benchmark'], result['name'], result['rows'])] = result
+    return latest
+
+
+def bench_compare(args):
+    """Compare the p50 timings of two --json result files; fails on slowdowns above --threshold."""
+    if len(args.files) != 2:
+        print("compare needs two result files: baseline and candidate")
+        return False
+    baseline, candidate = (_load_results(path) for path in args.files)
+    regressions = 0
+    for key in sorted(baseline.keys() & candidate.keys()):
+        before, after = baseline[key]['p50_ms'], candidate[key]['p50_ms']
+        ratio = after / before if before else 1.0
+        flag = "  REGRESSION" if ratio > args.threshold else ""
+        regressions += bool(flag)
+        benchmark, name, rows = key
+        print(f"{benchmark:<9} {name:<28} rows={rows:<8} {before:9.3f} -> {after:9.3f} ms  {ratio:5.2f}x{flag}")
+    print(f"{regressions} regression(s) above {args.threshold:.2f}x")
+    return not regressions
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _route_count(db_path):
+    import sqlite3
+
+    con = sqlite3.connect(db_path)
+    try:
+        return con.execute("SELECT COUNT(*) FROM problems").fetchone()[0]
+    finally:
+        con.close()
+
+
+BENCHMARKS = {
+    'api': bench_api,
+    'backends': bench_backends,
+    'compare': bench_compare,
+    'facets': bench_facets,
+    'filters': bench_filters,
+    'fragments': bench_fragments,
+    'load': bench_load,
+    'map': bench_map,
+    'media': bench_media,
+    'metrics': bench_metrics,
+    'refresh': bench_refresh,
+    'search': bench_search,
+    'shared': bench_shared,
+    'similar': bench_similar,
+    'spatial': bench_spatial,
+    'startup': bench_startup,
+    'suite': bench_suite,
+    'table': bench_table,
+    'thumbnails': bench_thumbnails,
+    'tiles': bench_tiles,
+    'topo': bench_topo,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--limit", type=int, default=0, help="Only use the first N inputs")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions per measurement")
+    parser.add_argument("--db", help="Route database to benchmark instead of boolder.db, e.g. from scale_dataset.py")
+    parser.add_argument("--json", help="Append every timing to this file as JSON lines")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Slowdown ratio `compare` fails on")
+    parser.add_argument("files", nargs="*", help="Result files for `compare`")
+    args = parser.parse_args()
+    warnings.filterwarnings("ignore")
+    if args.db:
+        # Read by data_loader at import time, so set before any benchmark runs
+        os.environ["ROUTE_DB"] = args.db
+    db_path = os.environ.get("ROUTE_DB", "boolder.db")
+    _current.update(benchmark=args.benchmark, rows=_route_count(db_path) if args.benchmark != 'compare' else None)
+    ok = BENCHMARKS[args.benchmark](args)
+    if args.json and results:
+        commit, timestamp = _commit(), time.time()
+        with open(args.json, 'a') as f:
+            for result in results:
+                f.write(json.dumps({**result, 'commit': commit, 'db': db_path, 'time': timestamp}) + "\n")
+        print(f"Wrote {len(results)} results to {args.json}")
+    sys.exit(0 if ok else 1)
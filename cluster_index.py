@@ -0,0 +1,80 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+from grade_utils import NUMERIC_TO_GRADE
+
+# Zoom levels with precomputed clusters; from CLUSTER_EXPAND_ZOOM on, routes are shown individually
+CLUSTER_MIN_ZOOM = 8
+CLUSTER_EXPAND_ZOOM = 16
+
+# Cluster cell edge in screen pixels at the cluster's zoom level
+CLUSTER_RADIUS = 60
+
+TILE_SIZE = 256
+
+# Grade family (the leading digit of the grade) for every numeric grade; 0 means ungraded
+GRADE_FAMILY = np.array(
+    [int(NUMERIC_TO_GRADE[numeric][0]) if NUMERIC_TO_GRADE.get(numeric) else 0 for numeric in range(35)],
+    dtype=np.int8,
+)
+GRADE_FAMILIES = 10
+
+
+def world_coordinates(latitudes, longitudes):
+    """Web Mercator coordinates of lat/lon points, scaled to 0-1 across the world."""
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    x = (np.asarray(longitudes, dtype=np.float64) + 180) / 360
+    y = (1 - np.log(np.tan(latitudes) + 1 / np.cos(latitudes)) / math.pi) / 2
+    return x, y
+
+
+class ClusterIndex:
+    """Grid clusters of route coordinates, precomputed for every zoom level.
+
+    At each zoom level the world is cut into square cells of CLUSTER_RADIUS
+    screen pixels, and every route gets the id of the cell it falls in.
+    Clustering any subset of routes is then a group-by over those ids,
+    so the map receives one marker per occupied cell instead of one per route.
+    """
+
+    def __init__(self, latitudes, longitudes, grade_numeric):
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        self.families = GRADE_FAMILY[np.clip(np.asarray(grade_numeric, dtype=np.int64), 0, len(GRADE_FAMILY) - 1)]
+        x, y = world_coordinates(self.latitudes, self.longitudes)
+        self.cells = {}
+        for zoom in range(CLUSTER_MIN_ZOOM, CLUSTER_EXPAND_ZOOM):
+            cells_per_side = TILE_SIZE * 2 ** zoom // CLUSTER_RADIUS
+            cx = np.floor(x * cells_per_side).astype(np.int64)
+            cy = np.floor(y * cells_per_side).astype(np.int64)
+            self.cells[zoom] = cy * cells_per_side + cx
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def clusters(self, positions, zoom):
+        """Group the routes at the given row positions into clusters for a zoom level.
+
+        Returns a DataFrame with one row per cluster (centroid latitude and
+        longitude, route count, and a route count per grade family in
+        columns grade_0 to grade_9), plus a boolean array marking the
+        positions that are alone in their cell and are better shown as
+        individual routes.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        zoom = min(max(int(zoom), CLUSTER_MIN_ZOOM), CLUSTER_EXPAND_ZOOM - 1)
+        _, inverse, counts = np.unique(self.cells[zoom][positions], return_inverse=True, return_counts=True)
+
+        clusters = pd.DataFrame({
+            'latitude': np.bincount(inverse, weights=self.latitudes[positions]) / counts,
+            'longitude': np.bincount(inverse, weights=self.longitudes[positions]) / counts,
+            'count': counts,
+        })
+        histogram = np.bincount(
+            inverse * GRADE_FAMILIES + self.families[positions], minlength=len(counts) * GRADE_FAMILIES
+        ).reshape(len(counts), GRADE_FAMILIES)
+        for family in range(GRADE_FAMILIES):
+            clusters[f'grade_{family}'] = histogram[:, family]
+        return clusters, counts[inverse] == 1
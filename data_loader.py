@@ -1,30 +1,220 @@
+import argparse
+import hashlib
 import json
+import logging
+import os
 import sqlite3
 
 import pandas as pd
 import streamlit as st
 
+from grade_utils import grades_to_numeric
+from metrics import timed
 
-@st.cache_data
-def load_data():
-    """Loads data from the SQLite database and prepares it for the app."""
-    con = sqlite3.connect("boolder.db")
-    df = pd.read_sql("SELECT * FROM problems", con)
-    areas = pd.read_sql("SELECT * FROM areas", con)
-    areas.rename(columns={"id": "area_id", "name": "area_name"}, inplace=True)
-    df = df.merge(areas[["area_id", "area_name"]], on="area_id", how="left")
+logger = logging.getLogger(__name__)
+
+# Route database; point ROUTE_DB at a scaled copy (see scale_dataset.py) to benchmark larger datasets
+ROUTE_DB = os.environ.get("ROUTE_DB", "boolder.db")
+
+# Typed, denormalized copy of the route table written by build_snapshot()
+ROUTE_SNAPSHOT = os.environ.get("ROUTE_SNAPSHOT", "routes.arrow")
+
+# Problem columns the app actually uses
+PROBLEM_COLUMNS = [
+    'id', 'name', 'name_en', 'name_searchable', 'grade', 'latitude', 'longitude', 'circuit_id', 'circuit_color',
+    'steepness', 'sit_start', 'area_id', 'bleau_info_id', 'popularity',
+]
+
+
+def read_problems(db_path=ROUTE_DB):
+    """Read the problems with their area names from the SQLite database, untyped."""
+    con = sqlite3.connect(db_path)
+    try:
+        df = pd.read_sql(f"SELECT {', '.join(PROBLEM_COLUMNS)} FROM problems", con)
+        areas = pd.read_sql("SELECT id AS area_id, name AS area_name FROM areas", con)
+    finally:
+        con.close()
+    df = df.merge(areas, on="area_id", how="left")
     df['grade'] = df['grade'].str.strip()
     df.dropna(subset=['latitude', 'longitude'], inplace=True)
     return df
 
 
-@st.cache_data
-def load_areas_geojson():
-    """Loads areas data from the GeoJSON file."""
+@timed("load_data")
+def load_data(db_path=ROUTE_DB, snapshot_path=ROUTE_SNAPSHOT):
+    """Loads the typed route table for the app.
+
+    Memory-maps the snapshot written by build_snapshot() when it was built
+    from the current database, and falls back to reading and typing the
+    SQLite tables otherwise. Called once per process by
+    route_store.get_route_store(), which keeps the result shared across
+    sessions.
+    """
+    routes = read_snapshot(snapshot_path, db_path)
+    if routes is None:
+        routes = prepare_routes(read_problems(db_path))
+    return routes
+
+
+# Low-cardinality text columns stored as categoricals
+CATEGORICAL_COLUMNS = ['steepness', 'area_name', 'circuit_color']
+
+
+def _downcast(series):
+    return pd.to_numeric(series, downcast='integer')
+
+
+def prepare_routes(df):
+    """Type the raw problems table for the route store.
+
+    Adds grade_numeric as int8, turns low-cardinality text columns into
+    categoricals and shrinks integer columns to the smallest type that fits.
+    """
+    df = df.copy()
+    df['grade_numeric'] = grades_to_numeric(df['grade'])
+    for column in CATEGORICAL_COLUMNS:
+        df[column] = df[column].astype('category')
+    df['sit_start'] = df['sit_start'].astype('int8')
+    df['popularity'] = _downcast(df['popularity'].fillna(0))
+    df['id'] = _downcast(df['id'])
+    df['area_id'] = _downcast(df['area_id'])
+    df['circuit_id'] = df['circuit_id'].astype('Int32')
+    return df.reset_index(drop=True)
+
+
+def source_fingerprint(db_path=ROUTE_DB):
+    """Size and modification time of the route database, a cheap check that it has not changed."""
+    stat = os.stat(db_path)
+    return json.dumps([stat.st_size, stat.st_mtime_ns])
+
+
+def source_digest(db_path=ROUTE_DB):
+    """SHA-1 of the problem and area rows the route table is read from.
+
+    Other tables in the database, and columns the app does not read, do
+    not affect it. The rows are serialized by SQLite, so this takes a
+    fraction of a full read.
+    """
+    problems = " || ',' || ".join(f"quote({column})" for column in PROBLEM_COLUMNS)
+    con = sqlite3.connect(db_path)
     try:
-        with open('areas.geojson', 'r', encoding='utf-8') as f:
-            areas_data = json.load(f)
-        return areas_data
-    except Exception as e:
-        st.error(f"Error loading areas.geojson: {e}")
-        return None 
\ No newline at end of file
+        digest = hashlib.sha1()
+        for columns, table in ((problems, 'problems'), ("quote(id) || ',' || quote(name)", 'areas')):
+            (rows,) = con.execute(
+                f"SELECT group_concat(row, char(10)) FROM (SELECT {columns} AS row FROM {table} ORDER BY id)"
+            ).fetchone()
+            digest.update((rows or '').encode() + b'\0')
+    finally:
+        con.close()
+    return digest.hexdigest()
+
+
+def _write_table(table, path):
+    from pyarrow import feather
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    feather.write_feather(table, temporary, compression='uncompressed')
+    os.replace(temporary, path)
+
+
+def _with_source(table, db_path, digest):
+    return table.replace_schema_metadata({
+        **(table.schema.metadata or {}), b'source': source_fingerprint(db_path), b'source_digest': digest,
+    })
+
+
+def build_snapshot(out_path=ROUTE_SNAPSHOT, db_path=ROUTE_DB):
+    """Write the typed route table to an uncompressed Feather (Arrow IPC) file.
+
+    The file carries area_name and grade_numeric precomputed, and is
+    uncompressed so load_data() can memory-map it instead of decoding it.
+    It is stale once the problems or areas change; rebuild it then.
+    Returns the number of routes written.
+    """
+    import pyarrow as pa
+
+    routes = prepare_routes(read_problems(db_path))
+    table = pa.Table.from_pandas(routes, preserve_index=False)
+    _write_table(_with_source(table, db_path, source_digest(db_path)), out_path)
+    logger.info("Wrote %d routes to %s", len(routes), out_path)
+    return len(routes)
+
+
+def read_snapshot(path=ROUTE_SNAPSHOT, db_path=ROUTE_DB):
+    """Memory-map the route snapshot, or return None if it is missing or stale.
+
+    Numeric columns come back as views of the mapped file rather than
+    copies; only strings and nullable columns are materialized. The
+    snapshot is fresh while the database keeps the size and mtime it was
+    built from. When those change, e.g. because another table was written
+    or the checkout was copied, the problem and area rows are compared
+    instead; if they are unchanged, the snapshot records the new size and
+    mtime, so later starts take the cheap check again.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        from pyarrow import feather
+    except ImportError:
+        return None
+    table = feather.read_table(path, memory_map=True)
+    metadata = table.schema.metadata or {}
+    if metadata.get(b'source', b'').decode() != source_fingerprint(db_path):
+        digest = source_digest(db_path)
+        if metadata.get(b'source_digest', b'').decode() != digest:
+            logger.info("%s is stale, reading %s instead; rebuild it with `python data_loader.py`", path, db_path)
+            return None
+        try:
+            _write_table(_with_source(table, db_path, digest), path)
+        except OSError as e:
+            logger.warning("Could not update %s: %s", path, e)
+    return table.to_pandas(split_blocks=True)
+
+
+# Area boundary colors by priority (1=red, 2=orange, 3=yellow, etc.)
+AREA_COLORS = ['red', 'orange', 'yellow', 'green', 'blue', 'purple']
+
+
+@st.cache_data
+def load_area_layer():
+    """Builds the area boundaries as one serialized GeoJSON FeatureCollection.
+
+    Each area becomes a bounding-box polygon whose properties carry its
+    name, id, priority and display color. The result never changes, so it
+    is built once and reused by every map.
+    """
+    con = sqlite3.connect(ROUTE_DB)
+    areas = pd.read_sql(
+        "SELECT id, name, priority, south_west_lat, south_west_lon, north_east_lat, north_east_lon FROM areas",
+        con,
+    )
+
+    features = []
+    for area in areas.itertuples(index=False):
+        sw_lat, sw_lon = area.south_west_lat, area.south_west_lon
+        ne_lat, ne_lon = area.north_east_lat, area.north_east_lon
+        features.append({
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[
+                    [sw_lon, sw_lat], [ne_lon, sw_lat], [ne_lon, ne_lat], [sw_lon, ne_lat], [sw_lon, sw_lat],
+                ]],
+            },
+            "properties": {
+                "name": area.name,
+                "area_id": int(area.id),
+                "priority": int(area.priority),
+                "color": AREA_COLORS[min(max(int(area.priority), 1) - 1, len(AREA_COLORS) - 1)],
+            },
+        })
+    return json.dumps({"type": "FeatureCollection", "features": features})
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Write the typed route snapshot the app loads at startup.")
+    parser.add_argument("--db", default=ROUTE_DB)
+    parser.add_argument("--out", default=ROUTE_SNAPSHOT)
+    args = parser.parse_args()
+    build_snapshot(args.out, args.db)
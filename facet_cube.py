@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+
+from filter_engine import SIT_START_VALUES
+
+# Popularity is cut into this many quantile buckets in the cube
+POPULARITY_BUCKETS = 16
+
+# Numeric grades 0-34, see grade_utils.GRADE_TO_NUMERIC
+GRADE_LEVELS = 35
+
+
+def _codes(column):
+    """Factorize a column, giving missing values their own code after the last value."""
+    codes, values = pd.factorize(column)
+    codes = np.where(codes < 0, len(values), codes)
+    return codes, list(values)
+
+
+class FacetCube:
+    """Route counts over (area, grade, steepness, sit start, popularity bucket).
+
+    Built once over the full table. For a filter dict from
+    create_sidebar_filters() it gives, for every option of each filter, the
+    number of routes that option would match combined with the other
+    current filters, plus summary statistics, without touching the rows.
+    Counts and popularity sums are kept as running sums over the
+    popularity buckets, so a popularity range is one subtraction; the
+    at most two buckets it cuts through are counted from their rows.
+    """
+
+    def __init__(self, data):
+        area, self.areas = _codes(data['area_name'])
+        steepness, self.steepness = _codes(data['steepness'])
+        grade = np.clip(data['grade_numeric'].to_numpy(dtype=np.int64), 0, GRADE_LEVELS - 1)
+        sit_start = (data['sit_start'].to_numpy(dtype=np.int64) != 0).astype(np.int64)
+        self.popularity = data['popularity'].to_numpy(dtype=np.int64)
+
+        if len(self.popularity):
+            quantiles = np.quantile(self.popularity, np.linspace(0, 1, POPULARITY_BUCKETS, endpoint=False))
+            self.edges = np.unique(quantiles.astype(np.int64))
+            self.edges[0] = self.popularity.min()
+            maximum = self.popularity.max()
+        else:
+            self.edges, maximum = np.zeros(1, dtype=np.int64), 0
+        # Highest popularity in each bucket
+        self.uppers = np.append(self.edges[1:] - 1, maximum)
+        bucket = np.searchsorted(self.edges, self.popularity, side='right') - 1
+
+        self.shape = (len(self.areas) + 1, GRADE_LEVELS, len(self.steepness) + 1, 2)
+        self.row_cells = np.ravel_multi_index((area, grade, steepness, sit_start), self.shape)
+        size = int(np.prod(self.shape))
+        cells = bucket * size + self.row_cells
+        # Counts are kept as float64 (exact up to 2**53) so the reductions below run as BLAS products
+        counts = np.bincount(cells, minlength=size * len(self.edges)).reshape(len(self.edges), *self.shape)
+        sums = np.bincount(cells, weights=self.popularity, minlength=size * len(self.edges))
+        zeros = np.zeros((1, *self.shape))
+        self.count_prefix = np.concatenate([zeros, counts.cumsum(axis=0)]).astype(np.float64)
+        self.sum_prefix = np.concatenate([zeros, sums.reshape(counts.shape).cumsum(axis=0)])
+
+        # Rows grouped by bucket, for the buckets a popularity range only partly covers
+        self.order = np.argsort(bucket, kind='stable')
+        self.bucket_start = np.searchsorted(bucket[self.order], np.arange(len(self.edges) + 1))
+
+    def _cells(self, prefix, popularity_range, weighted=False):
+        """Sum a running-sum cube over a popularity range, per (area, grade, steepness, sit start).
+
+        `prefix` is count_prefix, or sum_prefix with `weighted` set.
+        """
+        if not popularity_range:
+            return prefix[-1]
+        low, high = popularity_range
+        first = np.searchsorted(self.edges, low, side='left')
+        stop = np.searchsorted(self.uppers, high, side='right')
+        cells = prefix[stop] - prefix[first] if first < stop else np.zeros(self.shape)
+
+        edge_buckets = {np.searchsorted(self.edges, value, side='right') - 1 for value in (low, high)}
+        for b in edge_buckets:
+            if b < 0 or first <= b < stop:
+                continue
+            rows = self.order[self.bucket_start[b]:self.bucket_start[b + 1]]
+            rows = rows[(self.popularity[rows] >= low) & (self.popularity[rows] <= high)]
+            cells = cells + np.bincount(
+                self.row_cells[rows], weights=self.popularity[rows] if weighted else None, minlength=cells.size
+            ).reshape(self.shape)
+        return cells
+
+    def _masks(self, filters):
+        """0/1 weights per area, grade, steepness and sit start value selected by the filters."""
+        def value_mask(values, selected):
+            if not selected:
+                return np.ones(len(values) + 1)
+            selected = set(selected)
+            return np.array([value in selected for value in values] + [False], dtype=np.float64)
+
+        grade = np.zeros(GRADE_LEVELS)
+        low, high = filters['selected_grade_range']
+        grade[max(low, 0):min(high, GRADE_LEVELS - 1) + 1] = 1
+        sit_start = np.ones(2)
+        if filters['sit_start_option'] in SIT_START_VALUES:
+            sit_start[1 - SIT_START_VALUES[filters['sit_start_option']]] = 0
+        return (
+            value_mask(self.areas, filters['selected_areas']),
+            grade,
+            value_mask(self.steepness, filters['selected_steepness']),
+            sit_start,
+        )
+
+    def _marginals(self, cells, masks):
+        """Sum `cells` over the masked values of every axis but one, for each axis in turn.
+
+        Every step is a 2-d matrix-vector product, which numpy hands to BLAS.
+        """
+        area, grade, steepness, sit_start = masks
+        a, g, s, t = self.shape
+        by_steepness = cells.reshape(-1, t).dot(sit_start).reshape(a, g, s)
+        by_grade = by_steepness.reshape(-1, s).dot(steepness).reshape(a, g)
+        per_area = by_grade.dot(grade)
+        per_grade = area.dot(by_grade)
+        per_steepness = grade.dot(area.dot(by_steepness.reshape(a, g * s)).reshape(g, s))
+        per_sit_start = steepness.dot(grade.dot(area.dot(cells.reshape(a, g * s * t)).reshape(g, s * t)).reshape(s, t))
+        return per_area, per_grade, per_steepness, per_sit_start
+
+    def counts(self, filters):
+        """Routes matched by each filter option, given the other filters.
+
+        Returns a dict with the 'total' for the filters as they are, and
+        per option counts under 'areas', 'steepness' and 'sit_start' (keyed
+        by option) and 'grades' (an array indexed by numeric grade).
+        """
+        counts = self._cells(self.count_prefix, filters.get('selected_popularity'))
+        masks = self._masks(filters)
+        per_area, per_grade, per_steepness, per_sit_start = self._marginals(counts, masks)
+        return {
+            'total': int(per_area @ masks[0]),
+            'areas': dict(zip(self.areas, per_area.astype(np.int64).tolist())),
+            'grades': per_grade.astype(np.int64),
+            'steepness': dict(zip(self.steepness, per_steepness.astype(np.int64).tolist())),
+            'sit_start': {
+                option: int(per_sit_start[value]) for option, value in SIT_START_VALUES.items()
+            } | {"All": int(per_sit_start.sum())},
+        }
+
+    def summary(self, filters):
+        """Route count, mean numeric grade, mean popularity and number of areas matched by the filters."""
+        counts = self._cells(self.count_prefix, filters.get('selected_popularity'))
+        sums = self._cells(self.sum_prefix, filters.get('selected_popularity'), weighted=True)
+        masks = self._masks(filters)
+        area, grade = masks[0], masks[1]
+        per_area, per_grade, _, _ = self._marginals(counts, masks)
+        per_area, per_grade = per_area * area, per_grade * grade
+        total = int(per_grade.sum())
+        popularity = float(self._marginals(sums, masks)[0] @ area)
+        return {
+            'count': total,
+            'mean_grade': float(per_grade @ np.arange(GRADE_LEVELS)) / total if total else None,
+            'mean_popularity': popularity / total if total else None,
+            'areas': int(np.count_nonzero(per_area[:len(self.areas)])),
+        }
@@ -0,0 +1,114 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Number of distinct filter combinations whose results are memoized
+FILTER_CACHE_SIZE = 256
+
+SIT_START_VALUES = {"Sit Start Only": 1, "Standing Start Only": 0}
+
+
+def _bitset(mask):
+    return np.packbits(mask)
+
+
+class SortedColumn:
+    """A numeric column sorted once so that range filters are two binary searches."""
+
+    def __init__(self, values):
+        self.order = np.argsort(values, kind='stable')
+        self.sorted_values = np.asarray(values)[self.order]
+
+    def range_bitset(self, low, high, n):
+        start = np.searchsorted(self.sorted_values, low, side='left')
+        stop = np.searchsorted(self.sorted_values, high, side='right')
+        mask = np.zeros(n, dtype=bool)
+        mask[self.order[start:stop]] = True
+        return _bitset(mask)
+
+
+class FilterEngine:
+    """Precomputed indexes over the route table for the sidebar filters.
+
+    Steepness, area and sit_start get one packed bitset per value; grade and
+    popularity are kept as sorted arrays and range-searched. A filter dict
+    from create_sidebar_filters() is answered by AND-ing bitsets into a
+    single row selection, without materializing intermediate DataFrames.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.steepness = self._value_bitsets(data['steepness'])
+        self.areas = self._value_bitsets(data['area_name'])
+        self.sit_start = self._value_bitsets(data['sit_start'])
+        self.grade = SortedColumn(data['grade_numeric'].to_numpy())
+        self.popularity = SortedColumn(data['popularity'].to_numpy())
+        self.empty = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def __getstate__(self):
+        # The result cache and its lock stay with the process, e.g. when published by shared_store.py
+        state = self.__dict__.copy()
+        del state['_cache'], state['_cache_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _value_bitsets(self, column):
+        codes, uniques = column.factorize()
+        return {value: _bitset(codes == code) for code, value in enumerate(uniques)}
+
+    def _any_of(self, bitsets, values):
+        combined = self.empty.copy()
+        for value in values:
+            bitset = bitsets.get(value)
+            if bitset is not None:
+                combined |= bitset
+        return combined
+
+    @staticmethod
+    def cache_key(filters):
+        return (
+            tuple(filters['selected_grade_range']),
+            tuple(sorted(filters['selected_steepness'])),
+            tuple(sorted(filters['selected_areas'])),
+            filters['sit_start_option'],
+            tuple(filters['selected_popularity']) if filters['selected_popularity'] else None,
+        )
+
+    def select(self, filters):
+        """Return the sorted row positions matching the filter dict."""
+        key = self.cache_key(filters)
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        (grade_min, grade_max), steepness, areas, sit_start_option, popularity = key
+        selection = self.grade.range_bitset(grade_min, grade_max, self.size)
+        if steepness:
+            selection &= self._any_of(self.steepness, steepness)
+        if areas:
+            selection &= self._any_of(self.areas, areas)
+        if sit_start_option in SIT_START_VALUES:
+            selection &= self.sit_start.get(SIT_START_VALUES[sit_start_option], self.empty)
+        if popularity:
+            selection &= self.popularity.range_bitset(popularity[0], popularity[1], self.size)
+
+        positions = np.flatnonzero(np.unpackbits(selection, count=self.size))
+        positions.flags.writeable = False
+        with self._cache_lock:
+            self._cache[key] = positions
+            if len(self._cache) > FILTER_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return positions
+
+    def apply(self, filters):
+        """Return the rows matching the filter dict as a DataFrame."""
+        return self.data.iloc[self.select(filters)]
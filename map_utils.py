@@ -1,141 +1,312 @@
+import copy
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
 import folium
+import numpy as np
 import pandas as pd
-from folium.plugins import MarkerCluster
+from folium.map import Layer
+from folium.template import Template
+
+from cluster_index import CLUSTER_EXPAND_ZOOM
+from media_server import get_media_server_url
+from metrics import increment, span, timed
+from tile_pyramid import TILE_DB, TILE_MAX_ZOOM, TILE_MIN_ZOOM, read_bounds, read_tiles, tile_range
+
+# Maps with more routes than this are sent as server-side clusters below CLUSTER_EXPAND_ZOOM
+MAP_MARKER_LIMIT = 300
+
+DEFAULT_ZOOM = 11
+
+# Number of built maps kept by get_map_with_areas
+MAP_CACHE_SIZE = 32
+
+_map_cache = OrderedDict()
+_map_cache_lock = threading.Lock()
+
+# Zoom levels a click on a cluster zooms in by
+CLUSTER_CLICK_ZOOM_STEP = 2
+
+# Placeholder in each popup that is replaced by the route's media once the popup opens
+MEDIA_PLACEHOLDER = '<div class="route-media">Loading media...</div>'
+
+NO_MEDIA_TEXT = "This is not showing a video or image"
+
+# Leaflet marker factory for RouteLayer rows built by build_marker_rows.
+# Media is fetched from the local media endpoint the first time a popup opens.
+MARKER_CALLBACK = """
+var callback = function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindPopup(row[2], {maxWidth: 300});
+    marker.bindTooltip(row[3]);
+    marker.on('popupopen', function (e) {
+        if (!row[4] || marker.mediaRequested) return;
+        marker.mediaRequested = true;
+        fetch(row[4])
+            .then(function (response) { return response.json(); })
+            .then(function (media) {
+                var html = media.html || '%s';
+                if (media.width) e.popup.options.maxWidth = media.width;
+                e.popup.setContent(row[2].replace('%s', function () {
+                    return '<div class="route-media">' + html + '</div>';
+                }));
+            })
+            .catch(function () { marker.mediaRequested = false; });
+    });
+    return marker;
+};
+""" % (NO_MEDIA_TEXT, MEDIA_PLACEHOLDER)
+
+# Leaflet marker factory for RouteLayer rows built by build_cluster_rows
+CLUSTER_CALLBACK = """
+var callback = function (row, map) {
+    var size = row[2] < 10 ? 30 : row[2] < 100 ? 36 : row[2] < 1000 ? 44 : 52;
+    var color = row[2] < 10 ? '110, 204, 57' : row[2] < 100 ? '240, 194, 12' : '241, 128, 23';
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {
+        icon: L.divIcon({
+            html: '<div style="width: ' + size + 'px; height: ' + size + 'px; line-height: ' + size + 'px; '
+                + 'border-radius: 50%; text-align: center; font: bold 12px sans-serif; '
+                + 'background: rgba(' + color + ', 0.7); box-shadow: 0 0 0 5px rgba(' + color + ', 0.3);">'
+                + row[2] + '</div>',
+            className: '',
+            iconSize: new L.Point(size, size),
+        }),
+    });
+    marker.bindTooltip(row[3]);
+    marker.on('click', function () { map.setView(marker.getLatLng(), row[4]); });
+    return marker;
+};
+"""
+
+
+class RouteLayer(Layer):
+    """Plain Leaflet layer of markers built in the browser from compact rows.
+
+    Unlike FastMarkerCluster no clustering happens client-side: every row
+    becomes exactly one marker, so the rows must already be clustered.
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(){
+                {{ this.callback }}
+
+                var data = {{ this.data|tojson }};
+                var layer = L.featureGroup();
+                for (var i = 0; i < data.length; i++) {
+                    callback(data[i], {{ this._parent.get_name() }}).addTo(layer);
+                }
+
+                layer.addTo({{ this._parent.get_name() }});
+                return layer;
+            })();
+        {% endmacro %}"""
+    )
+
+    def __init__(self, data, callback, name=None):
+        super().__init__(name=name)
+        self._name = "RouteLayer"
+        self.data = data
+        self.callback = callback
+
+
+def area_style(feature):
+    """Leaflet style for an area boundary polygon."""
+    color = feature['properties']['color']
+    return {'color': color, 'weight': 2, 'fillColor': color, 'fillOpacity': 0.1}
+
+
+def trail_style(feature):
+    """Leaflet style for a trail line from the tile pyramid."""
+    return {'color': feature['properties'].get('color') or 'gray', 'weight': 3, 'opacity': 0.7}
+
+
+def _view_box(bounds):
+    """(south, west, north, east) of the view reported by st_folium, or the tile pyramid extent."""
+    try:
+        south_west, north_east = bounds['_southWest'], bounds['_northEast']
+        box = (south_west['lat'], south_west['lng'], north_east['lat'], north_east['lng'])
+        if None not in box:
+            return box
+    except (KeyError, TypeError):
+        pass
+    return read_bounds()
+
+
+def load_visible_tiles(bounds, zoom, layers=('trails',)):
+    """Read only the pyramid tiles that cover the map view, as one GeoJSON FeatureCollection.
 
-from media_fetcher import (
-    create_image_html,
-    create_video_html,
-    get_media_from_bleau_page,
-)
+    `bounds` is the view reported by st_folium; without one the whole
+    pyramid extent is read. Returns None if the tile pyramid has not been
+    built.
+    """
+    if not os.path.exists(TILE_DB):
+        return None
+    return read_tiles(*_view_box(bounds), zoom, layers=layers)
 
 
-def create_map_with_areas(filtered_data, areas_data, show_areas=True):
-    """Create a Folium map with route markers and area boundaries."""
+@timed("create_map_with_areas")
+def create_map_with_areas(
+    filtered_data, area_layer, show_areas=True, store=None, zoom=DEFAULT_ZOOM, bounds=None, show_trails=False
+):
+    """Create a Folium map with route markers and area boundaries.
+
+    With a route store, maps of more than MAP_MARKER_LIMIT routes below
+    CLUSTER_EXPAND_ZOOM show the store's clusters for `zoom` instead of
+    individual routes, so the page size stays flat however many routes match.
+    Trails come from the tiles covering `bounds` at `zoom`.
+    """
+    increment("map_builds_total")
     if not filtered_data.empty:
         map_center = [filtered_data['latitude'].mean(), filtered_data['longitude'].mean()]
     else:
         map_center = [48.404, 2.695]  # Fontainebleau center
 
-    m = folium.Map(location=map_center, zoom_start=11, tiles="cartodbpositron")
-
-    # Add areas data to the map
-    if areas_data and show_areas:
-        areas_group = folium.FeatureGroup(name="Areas", show=True)
-        
-        for feature in areas_data['features']:
-            properties = feature['properties']
-            geometry = feature['geometry']
-            
-            # Get area coordinates
-            if geometry['type'] == 'Point':
-                lat, lon = geometry['coordinates'][1], geometry['coordinates'][0]
-                
-                # Create bounding box rectangle if coordinates are available
-                if all(key in properties for key in ['southWestLat', 'southWestLon', 'northEastLat', 'northEastLon']):
-                    try:
-                        sw_lat = float(properties['southWestLat'])
-                        sw_lon = float(properties['southWestLon'])
-                        ne_lat = float(properties['northEastLat'])
-                        ne_lon = float(properties['northEastLon'])
-                        
-                        # Create rectangle for area boundary
-                        bounds = [[sw_lat, sw_lon], [ne_lat, ne_lon]]
-                        
-                        # Color based on priority (1=red, 2=orange, 3=yellow, etc.)
-                        priority = properties.get('priority', 1)
-                        colors = ['red', 'orange', 'yellow', 'green', 'blue', 'purple']
-                        color = colors[min(priority - 1, len(colors) - 1)]
-                        
-                        # Add rectangle to map
-                        folium.Rectangle(
-                            bounds=bounds,
-                            color=color,
-                            weight=2,
-                            fill=True,
-                            fillColor=color,
-                            fillOpacity=0.1,
-                            popup=folium.Popup(
-                                f"<b>{properties['name']}</b><br>"
-                                f"Area ID: {properties.get('areaId', 'N/A')}<br>"
-                                f"Priority: {properties.get('priority', 'N/A')}",
-                                max_width=200
-                            ),
-                            tooltip=properties['name']
-                        ).add_to(areas_group)
-                        
-                    except (ValueError, TypeError) as e:
-                        # If coordinates can't be parsed, just add a marker
-                        folium.Marker(
-                            location=[lat, lon],
-                            popup=folium.Popup(
-                                f"<b>{properties['name']}</b><br>"
-                                f"Area ID: {properties.get('areaId', 'N/A')}<br>"
-                                f"Priority: {properties.get('priority', 'N/A')}",
-                                max_width=200
-                            ),
-                            tooltip=properties['name'],
-                            icon=folium.Icon(color='blue', icon='info-sign')
-                        ).add_to(areas_group)
-                else:
-                    # Just add a marker if no bounding box
-                    folium.Marker(
-                        location=[lat, lon],
-                        popup=folium.Popup(
-                            f"<b>{properties['name']}</b><br>"
-                            f"Area ID: {properties.get('areaId', 'N/A')}<br>"
-                            f"Priority: {properties.get('priority', 'N/A')}",
-                            max_width=200
-                        ),
-                        tooltip=properties['name'],
-                        icon=folium.Icon(color='blue', icon='info-sign')
-                    ).add_to(areas_group)
-        
-        # Add areas group to map
-        areas_group.add_to(m)
-
-    marker_cluster = MarkerCluster().add_to(m)
-
-    # Add layer control if areas data is available
-    if areas_data and show_areas:
+    m = folium.Map(location=map_center, zoom_start=DEFAULT_ZOOM, tiles="cartodbpositron")
+
+    # Add the prebuilt area boundary layer to the map
+    if area_layer and show_areas:
+        folium.GeoJson(
+            area_layer,
+            name="Areas",
+            style_function=area_style,
+            tooltip=folium.GeoJsonTooltip(fields=['name'], labels=False),
+            popup=folium.GeoJsonPopup(
+                fields=['name', 'area_id', 'priority'],
+                aliases=['Area', 'Area ID', 'Priority'],
+                max_width=200,
+            ),
+        ).add_to(m)
+
+    # Add the trails from the tiles in view
+    trails = load_visible_tiles(bounds, zoom) if show_trails else None
+    if trails and trails['features']:
+        folium.GeoJson(
+            trails,
+            name="Trails",
+            style_function=trail_style,
+            tooltip=folium.GeoJsonTooltip(fields=['name'], labels=False),
+        ).add_to(m)
+
+    # Cluster large maps server-side; routes alone in their cell stay individual
+    if store is not None and len(filtered_data) > MAP_MARKER_LIMIT and zoom < CLUSTER_EXPAND_ZOOM:
+        clusters, alone = store.clusters(filtered_data, zoom)
+        RouteLayer(build_cluster_rows(clusters[clusters['count'] > 1], zoom), CLUSTER_CALLBACK, name="Clusters").add_to(m)
+        filtered_data = filtered_data[alone]
+
+    # Add route markers, built column-wise and rendered client-side
+    if not filtered_data.empty:
+        RouteLayer(build_marker_rows(filtered_data), MARKER_CALLBACK, name="Routes").add_to(m)
+
+    # Add layer control if the area or trail layer is shown
+    if (area_layer and show_areas) or trails:
         folium.LayerControl().add_to(m)
 
-    # Add route markers
-    for idx, row in filtered_data.iterrows():
-        # Create clickable route name for popup
-        route_link = f"https://bleau.info/{row['area_name'].lower()}/{row['bleau_info_id']}.html"
-        
-        video_info = None
-        image_info = None
-        media_html = "This is not showing a video or image"
-        
-        video_info, image_info = get_media_from_bleau_page(row['area_name'], row['bleau_info_id'])
-        
-        if video_info:
-            media_html = create_video_html(video_info)
-            print(f"DEBUG: Created video HTML for {row['name']}: {media_html[:100]}...")
-        elif image_info:
-            media_html = create_image_html(image_info)
-            print(f"DEBUG: Created image HTML for {row['name']}: {media_html[:100]}...")
-        else:
-            print(f"DEBUG: No media found for {row['name']}")
-        
-        popup_html = f"""
-        <div style="min-width: 300px; max-width: 500px;">
-            <h5><a href="{route_link}" target="_blank">{row['name']} ({row['grade']})</a></h5>
-            <b>Area:</b> {row['area_name']}<br>
-            <b>Steepness:</b> {row['steepness']}<br>
-            <b>Popularity:</b> {row['popularity']}<br>
-            {media_html}
-        </div>
-        """
-        
-        # Make popup wider to accommodate media nicely
-        popup_width = 500 if (video_info or image_info) else 300
-        
-        folium.Marker(
-            location=[row['latitude'], row['longitude']],
-            popup=folium.Popup(popup_html, max_width=popup_width),
-            tooltip=f"{row['name']} ({row['grade']})"
-        ).add_to(marker_cluster)
-
-    return m 
\ No newline at end of file
+    return m
+
+
+def map_cache_key(filtered_data, show_areas=True, zoom=DEFAULT_ZOOM, bounds=None, show_trails=False):
+    """Everything a map built by create_map_with_areas depends on, as a hashable key.
+
+    The routes are identified by a digest of their ids, in order. Trails
+    are identified by the range of tiles they were read from. Popups link
+    to the media server as the session's browser reaches it, so that URL
+    is part of the key too.
+    """
+    ids = np.ascontiguousarray(filtered_data['id'].to_numpy(dtype=np.int64))
+    digest = hashlib.blake2b(ids.tobytes(), digest_size=16).hexdigest()
+    trail_tiles = None
+    if show_trails and os.path.exists(TILE_DB):
+        tile_zoom = min(max(int(round(zoom)), TILE_MIN_ZOOM), TILE_MAX_ZOOM)
+        trail_tiles = (tile_zoom, tile_range(*_view_box(bounds), tile_zoom))
+    return digest, len(ids), bool(show_areas), zoom, trail_tiles, get_media_server_url()
+
+
+def get_map_with_areas(
+    filtered_data, area_layer, show_areas=True, store=None, zoom=DEFAULT_ZOOM, bounds=None, show_trails=False
+):
+    """Memoized create_map_with_areas, keyed by map_cache_key().
+
+    Returns a fresh copy of the cached map each time, because rendering
+    a folium map modifies it. Copies of the same map render to identical
+    HTML, so st_folium does not redraw the map in the browser.
+    """
+    key = map_cache_key(filtered_data, show_areas, zoom, bounds, show_trails)
+    with _map_cache_lock:
+        m = _map_cache.get(key)
+        if m is not None:
+            _map_cache.move_to_end(key)
+    increment("map_cache_total", result="hit" if m is not None else "miss")
+    if m is None:
+        m = create_map_with_areas(filtered_data, area_layer, show_areas, store, zoom, bounds, show_trails)
+        with _map_cache_lock:
+            _map_cache[key] = m
+            if len(_map_cache) > MAP_CACHE_SIZE:
+                _map_cache.popitem(last=False)
+    with span("copy_map"):
+        return copy.deepcopy(m)
+
+
+def _text(series):
+    """Plain string version of a column, with missing values as empty strings."""
+    return series.astype(object).fillna('').astype(str)
+
+
+def build_marker_rows(filtered_data):
+    """Build [lat, lon, popup_html, tooltip, media_url] rows for every route.
+
+    Popups carry no media; each one holds a placeholder and the URL of the
+    local media endpoint, which is only called when the popup is opened.
+    """
+    name = _text(filtered_data['name'])
+    grade = _text(filtered_data['grade'])
+    area_name = _text(filtered_data['area_name'])
+    bleau_info_id = _text(filtered_data['bleau_info_id'])
+
+    media_server_url = get_media_server_url()
+    if media_server_url:
+        media_url = (
+            media_server_url + '/' + bleau_info_id + '?problem=' + filtered_data['id'].astype(str)
+        ).where(bleau_info_id != '', '')
+    else:
+        media_url = pd.Series('', index=filtered_data.index)
+
+    title = name + ' (' + grade + ')'
+    route_link = 'https://bleau.info/' + area_name.str.lower() + '/' + bleau_info_id + '.html'
+    popup_html = (
+        '<div style="min-width: 300px; max-width: 500px;">'
+        '<h5><a href="' + route_link + '" target="_blank">' + title + '</a></h5>'
+        '<b>Area:</b> ' + area_name + '<br>'
+        '<b>Steepness:</b> ' + _text(filtered_data['steepness']) + '<br>'
+        '<b>Popularity:</b> ' + filtered_data['popularity'].astype(str) + '<br>'
+        + (MEDIA_PLACEHOLDER if media_server_url else NO_MEDIA_TEXT) +
+        '</div>'
+    )
+
+    return pd.DataFrame({
+        'latitude': filtered_data['latitude'],
+        'longitude': filtered_data['longitude'],
+        'popup': popup_html,
+        'tooltip': title,
+        'media_url': media_url,
+    }).values.tolist()
+
+
+def build_cluster_rows(clusters, zoom):
+    """Build [lat, lon, count, tooltip, expand_zoom] rows for clusters from RouteStore.clusters."""
+    tooltip = '<b>' + clusters['count'].astype(str) + ' routes</b>'
+    for family in range(1, 10):
+        count = clusters[f'grade_{family}']
+        tooltip += ('<br>Grade ' + str(family) + ': ' + count.astype(str)).where(count > 0, '')
+    expand_zoom = min(zoom + CLUSTER_CLICK_ZOOM_STEP, CLUSTER_EXPAND_ZOOM)
+
+    return pd.DataFrame({
+        'latitude': clusters['latitude'],
+        'longitude': clusters['longitude'],
+        'count': clusters['count'],
+        'tooltip': tooltip,
+        'expand_zoom': expand_zoom,
+    }).values.tolist()
@@ -0,0 +1,237 @@
+import argparse
+import logging
+import os
+import sqlite3
+import time
+
+from data_loader import ROUTE_DB
+from media_index import (
+    HTS_INDEX,
+    MEDIA_INDEX_DB,
+    PROBLEM_PAGE_RE,
+    media_to_row,
+    read_hts_index,
+    row_to_media,
+)
+
+logger = logging.getLogger(__name__)
+
+MEDIA_CACHE_DB = "media_cache.db"
+
+# Entries younger than this are served without asking bleau.info
+MEDIA_CACHE_TTL = 24 * 3600
+# Entries older than this are evicted outright, even if still in use
+MEDIA_CACHE_MAX_AGE = 180 * 24 * 3600
+# Least recently used entries are evicted once the cache grows past this
+MEDIA_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# Reads only record an entry's access time if it is older than this, so most reads write nothing
+MEDIA_CACHE_TOUCH_AFTER = 3600
+
+# (area_name, bleau_info_id) pairs per query, two bound parameters each
+MEDIA_CACHE_BATCH = 400
+
+
+def _connect(db_path):
+    con = sqlite3.connect(db_path)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS media_cache (
+          area_name TEXT NOT NULL,
+          bleau_info_id TEXT NOT NULL,
+          video_type TEXT,
+          video_url TEXT,
+          image_url TEXT,
+          etag TEXT,
+          last_modified TEXT,
+          fetched_at REAL NOT NULL,
+          accessed_at REAL NOT NULL,
+          size INTEGER NOT NULL,
+          PRIMARY KEY (area_name, bleau_info_id)
+        )
+    """)
+    con.execute("CREATE INDEX IF NOT EXISTS media_cache_accessed_at ON media_cache (accessed_at)")
+    return con
+
+
+def get_cached_media_many(routes, db_path=MEDIA_CACHE_DB, ttl=MEDIA_CACHE_TTL):
+    """Look up cached media for several (area_name, bleau_info_id) pairs.
+
+    Returns a dict mapping bleau_info_id to an entry dict with 'media',
+    'etag', 'last_modified' and 'fresh'. Stale entries are returned too so
+    that callers can revalidate them with a conditional GET.
+    Routes without media are cached as entries whose media is (None, None).
+    Access times, which eviction goes by, are kept to within
+    MEDIA_CACHE_TOUCH_AFTER.
+    """
+    keys = list({(area_name, str(bleau_info_id)) for area_name, bleau_info_id in routes if area_name and bleau_info_id})
+    if not keys:
+        return {}
+
+    entries = {}
+    now = time.time()
+    try:
+        con = _connect(db_path)
+    except sqlite3.Error:
+        return entries
+    try:
+        with con:
+            for i in range(0, len(keys), MEDIA_CACHE_BATCH):
+                chunk = keys[i:i + MEDIA_CACHE_BATCH]
+                pairs = f"(area_name, bleau_info_id) IN (VALUES {','.join(['(?, ?)'] * len(chunk))})"
+                params = [value for key in chunk for value in key]
+                rows = con.execute(
+                    "SELECT bleau_info_id, video_type, video_url, image_url, etag, last_modified, fetched_at "
+                    f"FROM media_cache WHERE {pairs}",
+                    params,
+                )
+                for bleau_info_id, video_type, video_url, image_url, etag, last_modified, fetched_at in rows:
+                    entries[bleau_info_id] = {
+                        'media': row_to_media(video_type, video_url, image_url),
+                        'etag': etag,
+                        'last_modified': last_modified,
+                        'fresh': now - fetched_at < ttl,
+                    }
+                con.execute(
+                    f"UPDATE media_cache SET accessed_at = ? WHERE accessed_at < ? AND {pairs}",
+                    [now, now - MEDIA_CACHE_TOUCH_AFTER, *params],
+                )
+    except sqlite3.Error as e:
+        logger.warning("Could not read media cache: %s", e)
+    finally:
+        con.close()
+    return entries
+
+
+def put_cached_media_many(entries, db_path=MEDIA_CACHE_DB):
+    """Store media results in the cache and evict old entries.
+
+    entries is an iterable of dicts with 'area_name', 'bleau_info_id',
+    'media', 'etag', 'last_modified' and optionally 'fetched_at'.
+    """
+    now = time.time()
+    rows = []
+    for entry in entries:
+        video_info, image_info = entry['media']
+        bleau_info_id, video_type, video_url, image_url, _, _ = media_to_row(
+            str(entry['bleau_info_id']), video_info, image_info, None, None
+        )
+        size = sum(len(value or '') for value in (video_url, image_url, entry['etag'], entry['last_modified'])) + 64
+        rows.append((
+            entry['area_name'], bleau_info_id, video_type, video_url, image_url,
+            entry['etag'], entry['last_modified'],
+            entry.get('fetched_at', now), now, size,
+        ))
+    if not rows:
+        return
+
+    try:
+        con = _connect(db_path)
+        try:
+            with con:
+                con.executemany("INSERT OR REPLACE INTO media_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            evict_media_cache(con=con)
+        finally:
+            con.close()
+    except sqlite3.Error as e:
+        logger.warning("Could not store media cache entries: %s", e)
+
+
+def touch_cached_media_many(routes, db_path=MEDIA_CACHE_DB):
+    """Mark cached entries as freshly validated, e.g. after a 304 Not Modified."""
+    now = time.time()
+    try:
+        con = _connect(db_path)
+        try:
+            with con:
+                con.executemany(
+                    "UPDATE media_cache SET fetched_at = ?, accessed_at = ? WHERE area_name = ? AND bleau_info_id = ?",
+                    [(now, now, area_name, str(bleau_info_id)) for area_name, bleau_info_id in routes],
+                )
+        finally:
+            con.close()
+    except sqlite3.Error as e:
+        logger.warning("Could not update media cache entries: %s", e)
+
+
+def evict_media_cache(db_path=MEDIA_CACHE_DB, max_age=MEDIA_CACHE_MAX_AGE, max_bytes=MEDIA_CACHE_MAX_BYTES, con=None):
+    """Drop entries older than max_age, then least recently used ones above max_bytes."""
+    own_connection = con is None
+    if own_connection:
+        con = _connect(db_path)
+    try:
+        with con:
+            con.execute("DELETE FROM media_cache WHERE fetched_at < ?", (time.time() - max_age,))
+            total = con.execute("SELECT COALESCE(SUM(size), 0) FROM media_cache").fetchone()[0]
+            if total > max_bytes:
+                # Walk entries from least to most recently used until we are under budget
+                excess = total - max_bytes
+                victims = []
+                for rowid, size in con.execute("SELECT rowid, size FROM media_cache ORDER BY accessed_at"):
+                    victims.append((rowid,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                con.executemany("DELETE FROM media_cache WHERE rowid = ?", victims)
+    finally:
+        if own_connection:
+            con.close()
+
+
+def seed_media_cache(db_path=MEDIA_CACHE_DB, index_db=MEDIA_INDEX_DB, hts_index=HTS_INDEX, route_db=ROUTE_DB):
+    """Pre-seed the cache with mirror media and the ETags HTTrack recorded.
+
+    Seeded entries take the time the media index was built as their fetch
+    time, so they are revalidated with a cheap conditional GET rather than
+    a full download once they go stale. Returns the number of seeded
+    entries.
+    """
+    validators = {}
+    for record in read_hts_index(hts_index):
+        match = PROBLEM_PAGE_RE.match(record['url'])
+        if match and record['status'] == 200 and (record['etag'] or record['last_modified']):
+            validators[match.group(2)] = record
+
+    con = sqlite3.connect(index_db)
+    try:
+        con.execute("ATTACH DATABASE ? AS routes", (route_db,))
+        rows = con.execute("""
+            SELECT a.name, m.bleau_info_id, m.video_type, m.video_url, m.image_url, m.indexed_at
+            FROM media_index m
+            JOIN routes.problems p ON p.bleau_info_id = m.bleau_info_id
+            JOIN routes.areas a ON a.id = p.area_id
+            WHERE m.source = 'mirror'
+        """).fetchall()
+    finally:
+        con.close()
+
+    entries = []
+    for area_name, bleau_info_id, video_type, video_url, image_url, indexed_at in rows:
+        record = validators.get(bleau_info_id)
+        if record is None:
+            continue
+        entries.append({
+            'area_name': area_name,
+            'bleau_info_id': bleau_info_id,
+            'media': row_to_media(video_type, video_url, image_url),
+            'etag': record['etag'],
+            'last_modified': record['last_modified'],
+            'fetched_at': indexed_at,
+        })
+    put_cached_media_many(entries, db_path)
+    seeded = len(entries)
+    logger.info("Seeded %d media cache entries from %s", seeded, os.path.basename(hts_index))
+    return seeded
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Maintain the persistent media cache.")
+    parser.add_argument("command", choices=["seed", "evict"])
+    parser.add_argument("--db", default=MEDIA_CACHE_DB)
+    parser.add_argument("--index-db", default=MEDIA_INDEX_DB)
+    parser.add_argument("--route-db", default=ROUTE_DB)
+    parser.add_argument("--hts-index", default=HTS_INDEX)
+    args = parser.parse_args()
+    if args.command == "seed":
+        seed_media_cache(args.db, args.index_db, args.hts_index, args.route_db)
+    else:
+        evict_media_cache(args.db)
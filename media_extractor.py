@@ -0,0 +1,275 @@
+from html.parser import HTMLParser
+
+VIDEO_EXTENSIONS = ('.mp4', '.webm', '.ogg')
+
+# Tags html.parser closes immediately; they never contain other elements
+VOID_ELEMENTS = {
+    'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame',
+    'hr', 'image', 'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta',
+    'nextid', 'param', 'source', 'spacer', 'track', 'wbr',
+}
+
+SECTION_MARKERS = ('boulder_mp4s', 'boulder_photos')
+
+
+class _StopParsing(Exception):
+    pass
+
+
+def _image_info_from_src(image_url):
+    if image_url.startswith('http'):
+        return {'url': image_url}
+    if image_url.startswith('/'):
+        return {'url': f"https://bleau.info{image_url}"}
+    return None
+
+
+class _Frame:
+    __slots__ = ('tag', 'role', 'order', 'first_video', 'first_source_for', 'result')
+
+    def __init__(self, tag, role=None, order=0):
+        self.tag = tag
+        self.role = role
+        self.order = order
+        self.first_video = False      # video-js div: has seen its first <video>
+        self.first_source_for = None  # video: frames waiting for this video's first <source>
+        self.result = None            # video / video-js div: url of a playable first <source>
+
+
+class MediaExtractor(HTMLParser):
+    """Streaming extractor for the boulder_mp4s and boulder_photos sections.
+
+    Mirrors the element lookups of extract_media_soup() without building a
+    tree, and stops as soon as every section present in the page has closed.
+    """
+
+    def __init__(self, need_mp4s=True, need_photos=True):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.need_mp4s = need_mp4s
+        self.need_photos = need_photos
+        self.mp4s_state = None    # None -> 'open' -> 'done'
+        self.photos_state = None
+        self.photo_state = None   # first boulder_photo div inside boulder_photos
+        self.order = 0
+
+        self.youtube_url = None
+        self.video_js_divs = []
+        self.videos = []
+        self.fancybox_seen = False
+        self.fancybox_img = None  # src of the first img inside the first fancybox link
+        self.photo_img_src = None
+        self.photo_img_found = False
+
+    def _in_section(self, role):
+        return any(frame.role == role for frame in self.stack)
+
+    def _check_done(self):
+        mp4s_done = not self.need_mp4s or self.mp4s_state == 'done'
+        photos_done = not self.need_photos or self.photos_state == 'done'
+        if mp4s_done and photos_done:
+            raise _StopParsing()
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        self.order += 1
+        frame = _Frame(tag, order=self.order)
+
+        in_mp4s = self.mp4s_state == 'open'
+        in_photos = self.photos_state == 'open'
+
+        if tag == 'div':
+            if self.mp4s_state is None and 'boulder_mp4s' in classes:
+                frame.role = 'mp4s'
+                self.mp4s_state = 'open'
+            elif self.photos_state is None and 'boulder_photos' in classes:
+                frame.role = 'photos'
+                self.photos_state = 'open'
+            elif in_mp4s and 'video-js' in classes:
+                frame.role = 'video_js'
+                self.video_js_divs.append(frame)
+            elif in_photos and self.photo_state is None and 'boulder_photo' in classes:
+                frame.role = 'photo'
+                self.photo_state = 'open'
+
+        if in_mp4s:
+            if tag == 'iframe' and self.youtube_url is None:
+                iframe_src = attrs.get('src') or ''
+                if 'youtube.com/embed/' in iframe_src or 'youtu.be' in iframe_src:
+                    self.youtube_url = iframe_src
+            elif tag == 'video':
+                frame.role = 'video'
+                frame.first_source_for = [frame]
+                self.videos.append(frame)
+                for parent in self.stack:
+                    if parent.role == 'video_js' and not parent.first_video:
+                        parent.first_video = True
+                        frame.first_source_for.append(parent)
+            elif tag == 'source':
+                src = attrs.get('src') or ''
+                playable = src if src and src.lower().endswith(VIDEO_EXTENSIONS) else None
+                for parent in self.stack:
+                    if parent.role == 'video' and parent.first_source_for is not None:
+                        for waiting in parent.first_source_for:
+                            waiting.result = playable
+                        parent.first_source_for = None
+
+        if self.photo_state == 'open':
+            if tag == 'a' and not self.fancybox_seen and 'fancybox' in classes:
+                frame.role = 'fancybox'
+                self.fancybox_seen = True
+            elif tag == 'img':
+                src = attrs.get('src') or ''
+                if not self.photo_img_found:
+                    self.photo_img_found = True
+                    self.photo_img_src = src
+                if self.fancybox_img is None and self._in_section('fancybox'):
+                    self.fancybox_img = src
+
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(frame)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i].tag == tag:
+                break
+        else:
+            # Not open inside the part of the page we parse - ignore it like html.parser does
+            return
+
+        closed = self.stack[i:]
+        del self.stack[i:]
+        for frame in closed:
+            if frame.role == 'mp4s':
+                self.mp4s_state = 'done'
+            elif frame.role == 'photos':
+                self.photos_state = 'done'
+            elif frame.role == 'photo':
+                self.photo_state = 'done'
+        if any(frame.role in ('mp4s', 'photos') for frame in closed):
+            self._check_done()
+
+    def result(self):
+        video_info = None
+        if self.youtube_url is not None:
+            video_info = {'type': 'youtube', 'url': self.youtube_url}
+        else:
+            for frames in (self.video_js_divs, self.videos):
+                playable = [frame for frame in frames if frame.result]
+                if playable:
+                    video_info = {'type': 'mp4', 'url': min(playable, key=lambda f: f.order).result}
+                    break
+
+        image_info = None
+        if self.fancybox_img:
+            image_info = _image_info_from_src(self.fancybox_img)
+        if not image_info and self.photo_img_src:
+            image_info = _image_info_from_src(self.photo_img_src)
+        return video_info, image_info
+
+
+def _decode(content):
+    if isinstance(content, str):
+        return content
+    try:
+        return content.decode('utf-8')
+    except UnicodeDecodeError:
+        return content.decode('cp1252', errors='replace')
+
+
+def extract_media(content):
+    """Extract video and image information from the HTML of a bleau.info problem page.
+
+    Only the boulder_mp4s and boulder_photos sections are parsed, and parsing
+    stops once both have been seen. Returns the same (video_info, image_info)
+    as extract_media_soup(): a YouTube iframe first, then a video.js <source>,
+    then a bare <video>, and the first boulder_photo's fancybox image.
+    """
+    text = _decode(content)
+    positions = [text.find(marker) for marker in SECTION_MARKERS]
+    found = [pos for pos in positions if pos != -1]
+    if not found:
+        return None, None
+
+    # Start at the tag that carries the first section marker
+    start = text.rfind('<', 0, min(found))
+    parser = MediaExtractor(need_mp4s=positions[0] != -1, need_photos=positions[1] != -1)
+    try:
+        parser.feed(text[max(start, 0):])
+        parser.close()
+    except _StopParsing:
+        pass
+    return parser.result()
+
+
+def extract_media_soup(content):
+    """Reference extractor that builds a full BeautifulSoup tree of the page."""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(content, 'html.parser')
+
+    video_info = None
+    image_info = None
+
+    # Look for videos in boulder_mp4s section
+    boulder_mp4s = soup.find('div', class_='boulder_mp4s')
+    if boulder_mp4s:
+        # Look for YouTube embeds (iframes)
+        iframes = boulder_mp4s.find_all('iframe')
+        for iframe in iframes:
+            iframe_src = iframe.get('src', '')
+            if 'youtube.com/embed/' in iframe_src or 'youtu.be' in iframe_src:
+                video_info = {'type': 'youtube', 'url': iframe_src}
+                break
+
+        # Look for direct video files (video.js players or direct video tags)
+        if not video_info:
+            # First try to find video.js players
+            video_js_divs = boulder_mp4s.find_all('div', class_='video-js')
+            for video_js_div in video_js_divs:
+                video_tag = video_js_div.find('video')
+                if video_tag:
+                    source_tag = video_tag.find('source')
+                    if source_tag and source_tag.get('src'):
+                        video_url = source_tag.get('src')
+                        if video_url.lower().endswith(VIDEO_EXTENSIONS):
+                            video_info = {'type': 'mp4', 'url': video_url}
+                            break
+
+            # Fallback: look for direct video tags
+            if not video_info:
+                video_tags = boulder_mp4s.find_all('video')
+                for video_tag in video_tags:
+                    source_tag = video_tag.find('source')
+                    if source_tag and source_tag.get('src'):
+                        video_url = source_tag.get('src')
+                        if video_url.lower().endswith(VIDEO_EXTENSIONS):
+                            video_info = {'type': 'mp4', 'url': video_url}
+                            break
+
+    # Look for images in boulder_photos section
+    boulder_photos = soup.find('div', class_='boulder_photos')
+    if boulder_photos:
+        # Look for the first boulder_photo div
+        boulder_photo = boulder_photos.find('div', class_='boulder_photo')
+        if boulder_photo:
+            # Look for fancybox links with images (most common)
+            fancybox_link = boulder_photo.find('a', class_='fancybox')
+            if fancybox_link:
+                img_tag = fancybox_link.find('img')
+                if img_tag and img_tag.get('src'):
+                    image_info = _image_info_from_src(img_tag.get('src'))
+
+            # Fallback: look for any img tag in boulder_photo
+            if not image_info:
+                img_tag = boulder_photo.find('img')
+                if img_tag and img_tag.get('src'):
+                    image_info = _image_info_from_src(img_tag.get('src'))
+
+    return video_info, image_info
@@ -1,110 +1,188 @@
-import requests
-import streamlit as st
-from bs4 import BeautifulSoup
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
+from media_cache import get_cached_media_many, put_cached_media_many, touch_cached_media_many
+from media_extractor import extract_media
+from media_index import lookup_media_many
+from metrics import increment, span, timed
 
-@st.cache_data(ttl=3600)  # Cache for 1 hour
-def get_media_from_bleau_page(area_name, bleau_info_id):
-    """Fetch video and image information from bleau.info page if available."""
+logger = logging.getLogger(__name__)
+
+BLEAU_INFO_URL = "https://bleau.info"
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+# Network settings for media lookups that miss the offline index
+MEDIA_FETCH_WORKERS = 8
+MEDIA_FETCH_TIMEOUT = 10
+MEDIA_FETCH_RETRIES = 3
+MEDIA_FETCH_BACKOFF = 0.5
+MEDIA_REQUESTS_PER_SECOND = 4  # per host
+
+_session = None
+_session_lock = threading.Lock()
+_rate_limiters = {}
+
+
+class RateLimiter:
+    """Spaces out calls so that at most `rate` of them start per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def get_session():
+    """Return the shared, connection-pooled requests session.
+
+    requests is imported here, on the first network lookup, to keep it out
+    of the app's startup.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=MEDIA_FETCH_RETRIES,
+                backoff_factor=MEDIA_FETCH_BACKOFF,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=('GET',),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MEDIA_FETCH_WORKERS, max_retries=retry)
+            _session = requests.Session()
+            _session.headers.update(HEADERS)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def _rate_limiter_for(url):
+    host = urlparse(url).netloc
+    with _session_lock:
+        if host not in _rate_limiters:
+            _rate_limiters[host] = RateLimiter(MEDIA_REQUESTS_PER_SECOND)
+        return _rate_limiters[host]
+
+
+def fetch_url(url, headers=None, stream=False):
+    """GET a URL over the shared session, rate limited per host.
+
+    With `stream`, the body is left unread; close the response when done.
+    """
+    _rate_limiter_for(url).wait()
+    return get_session().get(url, headers=headers, timeout=MEDIA_FETCH_TIMEOUT, stream=stream)
+
+
+@timed("media_fetch")
+def fetch_media(area_name, bleau_info_id, etag=None, last_modified=None):
+    """Fetch a bleau.info problem page and extract its media.
+
+    Sends a conditional GET when validators from a previous fetch are given.
+    Returns a dict with 'status', 'media', 'etag' and 'last_modified' (media
+    is None for a 304 Not Modified), or None if the request failed.
+    """
     try:
-        url = f"https://bleau.info/{area_name.lower()}/{bleau_info_id}.html"
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
-        response = requests.get(url, headers=headers, timeout=10)
+        url = f"{BLEAU_INFO_URL}/{area_name.lower()}/{bleau_info_id}.html"
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        response = fetch_url(url, headers)
+        if response.status_code == 304:
+            return {'status': 304, 'media': None, 'etag': etag, 'last_modified': last_modified}
+        if response.status_code == 404:
+            # The page is gone, so there is no media to show - worth caching
+            return {'status': 404, 'media': (None, None), 'etag': None, 'last_modified': None}
         if response.status_code != 200:
-            print(f"Failed to fetch {url}: {response.status_code}")
-            return None, None
-            
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        video_info = None
-        image_info = None
-        
-        # Look for videos in boulder_mp4s section
-        boulder_mp4s = soup.find('div', class_='boulder_mp4s')
-        if boulder_mp4s:
-            print(f"Found boulder_mp4s section for {area_name}/{bleau_info_id}")
-            
-            # Look for YouTube embeds (iframes)
-            iframes = boulder_mp4s.find_all('iframe')
-            for iframe in iframes:
-                iframe_src = iframe.get('src', '')
-                if 'youtube.com/embed/' in iframe_src or 'youtu.be' in iframe_src:
-                    video_info = {'type': 'youtube', 'url': iframe_src}
-                    print(f"Found YouTube video: {iframe_src}")
-                    break
-            
-            # Look for direct video files (video.js players or direct video tags)
-            if not video_info:
-                # First try to find video.js players
-                video_js_divs = boulder_mp4s.find_all('div', class_='video-js')
-                for video_js_div in video_js_divs:
-                    video_tag = video_js_div.find('video')
-                    if video_tag:
-                        source_tag = video_tag.find('source')
-                        if source_tag and source_tag.get('src'):
-                            video_url = source_tag.get('src')
-                            if video_url.lower().endswith(('.mp4', '.webm', '.ogg')):
-                                video_info = {'type': 'mp4', 'url': video_url}
-                                print(f"Found MP4 video via video.js: {video_url}")
-                                break
-                
-                # Fallback: look for direct video tags
-                if not video_info:
-                    video_tags = boulder_mp4s.find_all('video')
-                    for video_tag in video_tags:
-                        source_tag = video_tag.find('source')
-                        if source_tag and source_tag.get('src'):
-                            video_url = source_tag.get('src')
-                            if video_url.lower().endswith(('.mp4', '.webm', '.ogg')):
-                                video_info = {'type': 'mp4', 'url': video_url}
-                                print(f"Found MP4 video via direct video tag: {video_url}")
-                                break
-        else:
-            print(f"No boulder_mp4s section found for {area_name}/{bleau_info_id}")
-        
-        # Look for images in boulder_photos section
-        boulder_photos = soup.find('div', class_='boulder_photos')
-        if boulder_photos:
-            print(f"Found boulder_photos section for {area_name}/{bleau_info_id}")
-            
-            # Look for the first boulder_photo div
-            boulder_photo = boulder_photos.find('div', class_='boulder_photo')
-            if boulder_photo:
-                # Look for fancybox links with images (most common)
-                fancybox_link = boulder_photo.find('a', class_='fancybox')
-                if fancybox_link:
-                    img_tag = fancybox_link.find('img')
-                    if img_tag and img_tag.get('src'):
-                        image_url = img_tag.get('src')
-                        if image_url.startswith('http'):
-                            image_info = {'url': image_url}
-                        elif image_url.startswith('/'):
-                            image_info = {'url': f"https://bleau.info{image_url}"}
-                        print(f"Found image via fancybox: {image_info['url'] if image_info else 'None'}")
-                
-                # Fallback: look for any img tag in boulder_photo
-                if not image_info:
-                    img_tag = boulder_photo.find('img')
-                    if img_tag and img_tag.get('src'):
-                        image_url = img_tag.get('src')
-                        if image_url.startswith('http'):
-                            image_info = {'url': image_url}
-                        elif image_url.startswith('/'):
-                            image_info = {'url': f"https://bleau.info{image_url}"}
-                        print(f"Found image via direct img tag: {image_info['url'] if image_info else 'None'}")
-            else:
-                print(f"No boulder_photo div found in boulder_photos for {area_name}/{bleau_info_id}")
-        else:
-            print(f"No boulder_photos section found for {area_name}/{bleau_info_id}")
-        
-        print(f"Final result for {area_name}/{bleau_info_id}: video={video_info}, image={image_info}")
-        return video_info, image_info
+            logger.warning("Failed to fetch %s: %s", url, response.status_code)
+            return None
+        return {
+            'status': 200,
+            'media': extract_media(response.content),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
     except Exception as e:
-        print(f"Error fetching media for {area_name}/{bleau_info_id}: {e}")
-        return None, None
+        logger.warning("Error fetching media for %s/%s: %s", area_name, bleau_info_id, e)
+        return None
+
+
+@timed("media_lookup")
+def get_media_batch(routes, max_workers=MEDIA_FETCH_WORKERS):
+    """Resolve media for many routes with a single call.
+
+    Takes an iterable of (area_name, bleau_info_id) pairs and returns a dict
+    mapping bleau_info_id to (video_info, image_info). Routes are answered,
+    in order, from the persistent media cache, the offline mirror index, and
+    finally bleau.info itself. Network lookups run in parallel over the
+    shared session, rate limited per host, and revalidate stale cache
+    entries with conditional GETs.
+    """
+    routes = {str(bleau_info_id): area_name for area_name, bleau_info_id in routes if bleau_info_id}
+    cached = get_cached_media_many((area_name, bleau_info_id) for bleau_info_id, area_name in routes.items())
+
+    results = {bleau_info_id: entry['media'] for bleau_info_id, entry in cached.items() if entry['fresh']}
+    increment("media_lookups_total", len(results), source="cache")
+    indexed = lookup_media_many(bleau_info_id for bleau_info_id in routes if bleau_info_id not in results)
+    results.update(indexed)
+    increment("media_lookups_total", len(indexed), source="index")
+
+    missing = [(area_name, bleau_info_id) for bleau_info_id, area_name in routes.items() if bleau_info_id not in results]
+    if missing:
+        def fetch(route):
+            entry = cached.get(route[1], {})
+            return fetch_media(*route, etag=entry.get('etag'), last_modified=entry.get('last_modified'))
+
+        with span("media_network"), ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing)))) as executor:
+            fetched = list(executor.map(fetch, missing))
+
+        fresh = []
+        not_modified = []
+        for (area_name, bleau_info_id), response in zip(missing, fetched):
+            stale = cached.get(bleau_info_id)
+            if response is None:
+                # Network failure: serve the stale copy if we have one, but don't cache the miss
+                results[bleau_info_id] = stale['media'] if stale else (None, None)
+                increment("media_lookups_total", source="failed")
+            elif response['status'] == 304 and stale:
+                results[bleau_info_id] = stale['media']
+                not_modified.append((area_name, bleau_info_id))
+                increment("media_lookups_total", source="revalidated")
+            else:
+                increment("media_lookups_total", source="network")
+                results[bleau_info_id] = response['media'] or (None, None)
+                fresh.append({
+                    'area_name': area_name,
+                    'bleau_info_id': bleau_info_id,
+                    'media': results[bleau_info_id],
+                    'etag': response['etag'],
+                    'last_modified': response['last_modified'],
+                })
+        put_cached_media_many(fresh)
+        touch_cached_media_many(not_modified)
+
+    logger.debug("Media for %d routes: %d in cache, %d indexed, %d fetched", len(routes), len(cached), len(indexed), len(missing))
+    return results
 
 
 def create_video_html(video_info):
@@ -146,11 +224,26 @@ def create_video_html(video_info):
     return ""
 
 
-def create_image_html(image_info):
-    """Create HTML for embedding image in popup."""
+def create_image_html(image_info, overlay=""):
+    """Create HTML for embedding image in popup, optionally with an SVG overlay drawn on top."""
     if not image_info:
         return ""
     
+    if overlay:
+        return f"""
+    <div style="margin-top: 10px; text-align: center;">
+        <div style="position: relative; display: inline-block; max-width: 100%;">
+            <img 
+                src="{image_info['url']}" 
+                width="320" 
+                style="display: block; max-width: 100%; height: auto; border-radius: 8px;"
+                alt="Route image"
+            >
+            {overlay}
+        </div>
+    </div>
+    """
+
     return f"""
     <div style="margin-top: 10px; text-align: center;">
         <img 
@@ -160,4 +253,4 @@ def create_image_html(image_info):
             alt="Route image"
         >
     </div>
-    """ 
\ No newline at end of file
+    """
@@ -0,0 +1,219 @@
+import argparse
+import logging
+import os
+import re
+import sqlite3
+import time
+from urllib.parse import unquote
+
+from data_loader import ROUTE_DB
+from media_extractor import extract_media
+
+logger = logging.getLogger(__name__)
+
+# Kept out of the route database, which is source data and read-only
+MEDIA_INDEX_DB = os.environ.get("MEDIA_INDEX_DB", "media_index.db")
+MIRROR_DIR = "bleau.info"
+HTS_INDEX = os.path.join("hts-cache", "new.txt")
+
+# Entries older than this are considered stale and refetched from bleau.info
+MEDIA_INDEX_MAX_AGE = 30 * 24 * 3600
+
+PROBLEM_PAGE_RE = re.compile(r"^https://bleau\.info/([^/]+)/(\d+)\.html$")
+
+
+def create_media_index_table(con):
+    """Create the media_index table if it does not exist yet."""
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS media_index (
+          bleau_info_id TEXT NOT NULL PRIMARY KEY,
+          video_type TEXT,
+          video_url TEXT,
+          image_url TEXT,
+          source TEXT NOT NULL,
+          indexed_at REAL NOT NULL
+        )
+    """)
+
+
+def read_hts_index(path=HTS_INDEX):
+    """Parse the HTTrack new.txt log into a list of record dicts."""
+    records = []
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        next(f, None)  # header line
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9:
+                continue
+            etag = last_modified = None
+            validator = unquote(fields[6])
+            if validator.startswith('etag:'):
+                etag = validator[len('etag:'):]
+            elif validator.startswith('date:'):
+                last_modified = validator[len('date:'):]
+            records.append({
+                'status': int(fields[3]) if fields[3].isdigit() else None,
+                'mime': fields[5],
+                'etag': etag,
+                'last_modified': last_modified,
+                'url': fields[7],
+                'localfile': fields[8],
+            })
+    return records
+
+
+def iter_mirror_pages(mirror_dir=MIRROR_DIR, hts_index=HTS_INDEX):
+    """Yield (bleau_info_id, area_slug, local_path) for every mirrored problem page.
+
+    Uses the HTTrack index when available and falls back to scanning the
+    mirror directory otherwise. When a problem was mirrored under several
+    area slugs, the last crawled copy wins.
+    """
+    pages = {}
+    if os.path.exists(hts_index):
+        base_dir = os.path.dirname(os.path.abspath(mirror_dir))
+        for record in read_hts_index(hts_index):
+            match = PROBLEM_PAGE_RE.match(record['url'])
+            if not match or record['status'] != 200 or not record['localfile']:
+                continue
+            path = os.path.normpath(os.path.join(base_dir, record['localfile']))
+            if os.path.exists(path):
+                pages[match.group(2)] = (match.group(1), path)
+    else:
+        for area_slug in sorted(os.listdir(mirror_dir)):
+            area_dir = os.path.join(mirror_dir, area_slug)
+            if not os.path.isdir(area_dir):
+                continue
+            for filename in sorted(os.listdir(area_dir)):
+                stem, ext = os.path.splitext(filename)
+                if ext == '.html' and stem.isdigit():
+                    pages[stem] = (area_slug, os.path.join(area_dir, filename))
+
+    for bleau_info_id, (area_slug, path) in pages.items():
+        yield bleau_info_id, area_slug, path
+
+
+def media_to_row(bleau_info_id, video_info, image_info, source, indexed_at):
+    return (
+        bleau_info_id,
+        video_info['type'] if video_info else None,
+        video_info['url'] if video_info else None,
+        image_info['url'] if image_info else None,
+        source,
+        indexed_at,
+    )
+
+
+def row_to_media(video_type, video_url, image_url):
+    video_info = {'type': video_type, 'url': video_url} if video_url else None
+    image_info = {'url': image_url} if image_url else None
+    return video_info, image_info
+
+
+def problem_bleau_info_ids(route_db=ROUTE_DB):
+    """The bleau.info IDs of every problem in the route database."""
+    con = sqlite3.connect(route_db)
+    try:
+        return {row[0] for row in con.execute("SELECT bleau_info_id FROM problems WHERE bleau_info_id IS NOT NULL")}
+    finally:
+        con.close()
+
+
+def build_media_index(db_path=MEDIA_INDEX_DB, mirror_dir=MIRROR_DIR, hts_index=HTS_INDEX, all_pages=False,
+                      route_db=ROUTE_DB):
+    """Parse the local bleau.info mirror once into the media_index table.
+
+    Only pages referenced by problems.bleau_info_id in `route_db` are indexed unless
+    all_pages is set. Entries are stamped with the build time, not the
+    page's mtime, so they stay fresh for MEDIA_INDEX_MAX_AGE however old
+    the mirror is; mirror_refresh.py keeps them fresh after that. Returns
+    the number of indexed pages.
+    """
+    con = sqlite3.connect(db_path)
+    try:
+        create_media_index_table(con)
+        wanted = None if all_pages else problem_bleau_info_ids(route_db)
+
+        rows = []
+        start, now = time.perf_counter(), time.time()
+        for bleau_info_id, area_slug, path in iter_mirror_pages(mirror_dir, hts_index):
+            if wanted is not None and bleau_info_id not in wanted:
+                continue
+            with open(path, 'rb') as f:
+                video_info, image_info = extract_media(f.read())
+            rows.append(media_to_row(bleau_info_id, video_info, image_info, 'mirror', now))
+
+        with con:
+            con.executemany("INSERT OR REPLACE INTO media_index VALUES (?, ?, ?, ?, ?, ?)", rows)
+        logger.info("Indexed %d mirror pages in %.1fs", len(rows), time.perf_counter() - start)
+        return len(rows)
+    finally:
+        con.close()
+
+
+def lookup_media_many(bleau_info_ids, db_path=MEDIA_INDEX_DB, max_age=MEDIA_INDEX_MAX_AGE):
+    """Look up indexed media for several routes at once.
+
+    Returns a dict mapping bleau_info_id to (video_info, image_info). IDs that
+    are missing from the index or older than max_age are left out.
+    """
+    ids = list({str(i) for i in bleau_info_ids if i})
+    if not ids:
+        return {}
+
+    results = {}
+    oldest = time.time() - max_age
+    try:
+        con = sqlite3.connect(db_path)
+    except sqlite3.Error:
+        return results
+    try:
+        # Stay well below SQLite's bound parameter limit
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            query = (
+                "SELECT bleau_info_id, video_type, video_url, image_url FROM media_index "
+                f"WHERE indexed_at >= ? AND bleau_info_id IN ({placeholders})"
+            )
+            for bleau_info_id, video_type, video_url, image_url in con.execute(query, [oldest, *chunk]):
+                results[bleau_info_id] = row_to_media(video_type, video_url, image_url)
+    except sqlite3.Error:
+        # No index built yet - everything goes to the network
+        pass
+    finally:
+        con.close()
+    return results
+
+
+def store_media_many(media, db_path=MEDIA_INDEX_DB, source='network'):
+    """Record freshly fetched media results, given as {bleau_info_id: (video_info, image_info)}."""
+    if not media:
+        return
+    now = time.time()
+    rows = [
+        media_to_row(str(bleau_info_id), video_info, image_info, source, now)
+        for bleau_info_id, (video_info, image_info) in media.items()
+    ]
+    try:
+        con = sqlite3.connect(db_path)
+        try:
+            with con:
+                create_media_index_table(con)
+                con.executemany("INSERT OR REPLACE INTO media_index VALUES (?, ?, ?, ?, ?, ?)", rows)
+        finally:
+            con.close()
+    except sqlite3.Error as e:
+        logger.warning("Could not store media index entries: %s", e)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Build the offline media index from the local bleau.info mirror.")
+    parser.add_argument("--db", default=MEDIA_INDEX_DB)
+    parser.add_argument("--route-db", default=ROUTE_DB)
+    parser.add_argument("--mirror", default=MIRROR_DIR)
+    parser.add_argument("--hts-index", default=HTS_INDEX)
+    parser.add_argument("--all-pages", action="store_true", help="Also index pages not referenced by any problem")
+    args = parser.parse_args()
+    build_media_index(args.db, args.mirror, args.hts_index, args.all_pages, args.route_db)
@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse, urlsplit
+
+import streamlit as st
+
+from media_fetcher import create_image_html, create_video_html, get_media_batch
+from metrics import registry
+from route_store import get_route_store
+from thumbnails import (
+    DIGEST_RE,
+    THUMBNAIL_CONTENT_TYPE,
+    THUMBNAIL_EXTENSION,
+    get_thumbnail_pipeline,
+    thumbnail_path,
+)
+from topo_store import first_topo_lines, get_topo_store, topo_photo_url, topo_svg, topo_thumbnail_uri
+
+logger = logging.getLogger(__name__)
+
+# Endpoint that map popups call for their media when opened, one per app process. Browsers
+# reach it on the host they loaded the app from, so by default it binds the address Streamlit
+# serves on (server.address, all interfaces if unset). Port 0, or a port another process
+# already holds, gives each process a free port of its own
+MEDIA_SERVER_HOST = os.environ.get("MEDIA_SERVER_HOST", "")
+MEDIA_SERVER_PORT = int(os.environ.get("MEDIA_SERVER_PORT", "0"))
+
+# Base URL browsers reach the media server at, e.g. behind a reverse proxy, with {port} standing
+# for the process's port; by default the host the browser loaded the app from, on that port
+MEDIA_SERVER_PUBLIC_URL = os.environ.get("MEDIA_SERVER_PUBLIC_URL", "")
+
+# Popup width once media has been injected
+MEDIA_POPUP_WIDTH = 500
+
+
+def _bind_host():
+    return MEDIA_SERVER_HOST or st.get_option("server.address") or ""
+
+
+def problem_route(bleau_info_id, problem_id=None):
+    """The route with a bleau.info ID, as a row of the route store, or None if there is none.
+
+    `problem_id` picks between problems sharing the ID.
+    """
+    routes = get_route_store().project_routes([str(bleau_info_id)])
+    if routes.empty:
+        return None
+    chosen = routes[routes['id'] == problem_id]
+    return (chosen if not chosen.empty else routes).iloc[0]
+
+
+def media_popup(area_name, bleau_info_id, problem_id=None):
+    """Resolve a route's media and return it as {'html', 'width'} for a map popup.
+
+    The problem's topo lines are drawn over the Boolder topo photo they
+    were traced on, or on a plain background if topo photos are not
+    configured; bleau.info photos are shown as they are, since they were
+    taken from elsewhere and the lines would not match them.
+    """
+    video_info, image_info = get_media_batch([(area_name, bleau_info_id)]).get(str(bleau_info_id), (None, None))
+    topo_store = get_topo_store() if problem_id is not None else None
+    lines = topo_store.lines(problem_id) if topo_store is not None else []
+    if video_info:
+        return {'html': create_video_html(video_info), 'width': MEDIA_POPUP_WIDTH}
+    html = ""
+    if lines:
+        photo_url = topo_photo_url(lines[0][0])
+        if photo_url:
+            html = create_image_html({'url': photo_url}, topo_svg(first_topo_lines(lines)))
+        elif not image_info:
+            html = create_image_html({'url': topo_thumbnail_uri(lines, 320, 240)})
+    if image_info:
+        image_info = {**image_info, 'url': local_image_urls([image_info['url']], 'popup')[image_info['url']]}
+        html += create_image_html(image_info)
+    return {'html': html, 'width': MEDIA_POPUP_WIDTH if html else None}
+
+
+def local_image_urls(image_urls, size='table'):
+    """Map remote image URLs to their cached thumbnails on this server.
+
+    Images without a thumbnail yet keep their remote URL and are queued
+    for the thumbnail pipeline, as are all of them if the server is not
+    running.
+    """
+    ready = get_thumbnail_pipeline().lookup(image_urls, size)
+    server_url = get_media_server_url()
+    if server_url is None:
+        ready = {}
+    base_url = server_url.rsplit('/', 1)[0] if server_url else ""
+    return {
+        url: f"{base_url}/thumbnails/{ready[url]}.{THUMBNAIL_EXTENSION}" if url in ready else url
+        for url in image_urls
+    }
+
+
+class MediaRequestHandler(BaseHTTPRequestHandler):
+    """Answers GET /media/<bleau_info_id>?problem=<id> with the popup media as JSON.
+
+    The area the media is fetched for is looked up in the route store,
+    so only known problems are ever fetched or cached.
+
+    GET /thumbnails/<digest>.<ext> serves a cached thumbnail and GET
+    /metrics the process's metrics in the Prometheus text format.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            self._send_metrics()
+            return
+        if url.path.startswith('/thumbnails/'):
+            self._send_thumbnail(url.path.rsplit('/', 1)[-1])
+            return
+        parts = url.path.strip('/').split('/')
+        problem_id = parse_qs(url.query).get('problem', [''])[0]
+        route = None
+        if len(parts) == 2 and parts[0] == 'media' and parts[1].isdigit():
+            route = problem_route(parts[1], int(problem_id) if problem_id.isdigit() else None)
+        if route is None or not isinstance(route['area_name'], str):
+            self._send(404, {'error': 'not found'})
+            return
+        self._send(200, media_popup(route['area_name'], parts[1], int(route['id'])))
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        # The map is rendered in a component iframe with its own origin
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'max-age=3600')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_thumbnail(self, filename):
+        digest, _, extension = filename.partition('.')
+        if not DIGEST_RE.match(digest) or extension != THUMBNAIL_EXTENSION:
+            self._send(404, {'error': 'not found'})
+            return
+        try:
+            with open(thumbnail_path(digest), 'rb') as f:
+                body = f.read()
+        except OSError:
+            self._send(404, {'error': 'not found'})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', THUMBNAIL_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        # Named after their content, so they never change
+        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+        self.send_header('ETag', f'"{digest}"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_metrics(self):
+        body = registry.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+@st.cache_resource
+def start_media_server():
+    """Start the media endpoint once per process and return the port it listens on.
+
+    Falls back to a free port when MEDIA_SERVER_PORT is taken, e.g. by
+    another worker. Returns None if no port can be bound; popups then
+    link to bleau.info without loading media.
+    """
+    host = _bind_host()
+    for port in dict.fromkeys([MEDIA_SERVER_PORT, 0]):
+        try:
+            server = ThreadingHTTPServer((host, port), MediaRequestHandler)
+            break
+        except OSError as e:
+            logger.warning("Media server not started on %s:%s: %s", host, port, e)
+    else:
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="media-server", daemon=True).start()
+    return server.server_port
+
+
+def _browser_host():
+    """Host name the current session's browser loaded the app from, or None outside a session."""
+    host = st.context.headers.get('Host') if st.runtime.exists() else None
+    hostname = urlsplit(f"//{host}").hostname if host else None
+    if hostname and ':' in hostname:
+        return f"[{hostname}]"
+    return hostname
+
+
+def get_media_server_url():
+    """URL of this process's media endpoint as the current session's browser can reach it.
+
+    Uses MEDIA_SERVER_PUBLIC_URL if set, else the browser's host on the
+    server's port; outside a session, the bind address. Returns None if
+    the server is not running.
+    """
+    port = start_media_server()
+    if port is None:
+        return None
+    if MEDIA_SERVER_PUBLIC_URL:
+        return MEDIA_SERVER_PUBLIC_URL.format(port=port).rstrip('/') + "/media"
+    host = _browser_host()
+    if host is None:
+        host = "127.0.0.1" if _bind_host() in ("", "0.0.0.0") else _bind_host()
+    return f"http://{host}:{port}/media"
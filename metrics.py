@@ -0,0 +1,235 @@
+import argparse
+import bisect
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+# Prefix of every exported metric name
+METRICS_PREFIX = "bleau_"
+
+# Upper bounds, in seconds, of the stage latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# If set, a snapshot of every metric is appended to this JSON-lines file every METRICS_INTERVAL seconds
+METRICS_JSONL = os.environ.get("METRICS_JSONL")
+METRICS_INTERVAL = float(os.environ.get("METRICS_INTERVAL", "60"))
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram in the Prometheus layout."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside its bucket, like PromQL's histogram_quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """Per-process counters and stage latency histograms.
+
+    Counters and histograms are keyed by name and a sorted tuple of label
+    pairs, so `increment("media_lookups_total", source="cache")` and
+    `observe("stage_seconds", 0.01, stage="load_data")` each feed one series.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def counter(self, name, **labels):
+        """Current value of a counter, summed over every series matching the given labels."""
+        with self.lock:
+            return sum(
+                value for (series, series_labels), value in self.counters.items()
+                if series == name and set(labels.items()) <= set(series_labels)
+            )
+
+    def histogram(self, name, **labels):
+        with self.lock:
+            return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def prometheus_text(self):
+        """Render every metric in the Prometheus text exposition format."""
+        def series(name, labels, extra=()):
+            pairs = ",".join(f'{key}="{value}"' for key, value in (*labels, *extra))
+            return f"{METRICS_PREFIX}{name}{{{pairs}}}" if pairs else f"{METRICS_PREFIX}{name}"
+
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {METRICS_PREFIX}{name} counter")
+                for (series_name, labels), value in sorted(self.counters.items()):
+                    if series_name == name:
+                        lines.append(f"{series(name, labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {METRICS_PREFIX}{name} histogram")
+                for (series_name, labels), histogram in sorted(self.histograms.items()):
+                    if series_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{series(name + '_bucket', labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{series(name + '_sum', labels)} {histogram.sum:.6f}")
+                    lines.append(f"{series(name + '_count', labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Every metric as a JSON-serializable dict, with p50/p99 estimates for each histogram."""
+        with self.lock:
+            return {
+                'time': time.time(),
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'histograms': [
+                    {
+                        'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                        'p50': histogram.quantile(0.5), 'p99': histogram.quantile(0.99),
+                        'buckets': dict(zip(map(str, (*histogram.buckets, "+Inf")), histogram.counts)),
+                    }
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                ],
+            }
+
+
+# The process-wide registry every module reports to
+registry = Metrics()
+
+
+def increment(name, value=1, **labels):
+    registry.increment(name, value, **labels)
+
+
+@contextmanager
+def span(stage):
+    """Time the enclosed block into the stage_seconds histogram, labelled with the stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe("stage_seconds", elapsed, stage=stage)
+        logger.debug("%s took %.1f ms", stage, elapsed * 1000)
+
+
+def timed(stage):
+    """Decorator form of span()."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write_snapshot(path):
+    with open(path, 'a') as f:
+        f.write(json.dumps(registry.snapshot()) + "\n")
+
+
+@st.cache_resource
+def start_metrics_log(path=METRICS_JSONL, interval=METRICS_INTERVAL):
+    """Append a metrics snapshot to `path` every `interval` seconds, once per process.
+
+    Does nothing unless a path is given (METRICS_JSONL). Returns the
+    writer thread, or None.
+    """
+    if not path:
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                write_snapshot(path)
+            except OSError as e:
+                logger.warning("Could not write metrics to %s: %s", path, e)
+
+    thread = threading.Thread(target=run, name="metrics-log", daemon=True)
+    thread.start()
+    return thread
+
+
+def summarize(path):
+    """Print the latest snapshot of each process in a JSON-lines metrics file."""
+    latest = {}
+    with open(path) as f:
+        for line in f:
+            snapshot = json.loads(line)
+            latest[(snapshot['host'], snapshot['pid'])] = snapshot
+    for (host, pid), snapshot in sorted(latest.items()):
+        print(f"{host} pid {pid}:")
+        for histogram in snapshot['histograms']:
+            labels = ",".join(f"{key}={value}" for key, value in histogram['labels'].items())
+            print(
+                f"  {histogram['name']}[{labels}] n={histogram['count']} "
+                f"p50={(histogram['p50'] or 0) * 1000:.1f} ms p99={(histogram['p99'] or 0) * 1000:.1f} ms"
+            )
+        lookups = {
+            counter['labels'].get('source'): counter['value']
+            for counter in snapshot['counters'] if counter['name'] == 'media_lookups_total'
+        }
+        if lookups:
+            total = sum(lookups.values())
+            hits = lookups.get('cache', 0) + lookups.get('index', 0)
+            print(f"  media hit ratio {hits / total:.1%} of {total} lookups")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a JSON-lines metrics file written by the app.")
+    parser.add_argument("path", nargs="?", default=METRICS_JSONL)
+    args = parser.parse_args()
+    summarize(args.path)
@@ -0,0 +1,221 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+from media_extractor import extract_media
+from media_fetcher import BLEAU_INFO_URL, MEDIA_FETCH_WORKERS, fetch_url
+from data_loader import ROUTE_DB
+from media_index import (
+    HTS_INDEX, MEDIA_INDEX_DB, MIRROR_DIR, PROBLEM_PAGE_RE, create_media_index_table, problem_bleau_info_ids,
+    read_hts_index, store_media_many
+)
+from metrics import increment
+
+logger = logging.getLogger(__name__)
+
+# Validators and progress of the last refresh, read by the next one
+REFRESH_MANIFEST = os.path.join("hts-cache", "refresh.json")
+
+# Concurrent conditional GETs; requests to one host are still rate limited by fetch_url
+REFRESH_WORKERS = MEDIA_FETCH_WORKERS
+
+# Results between manifest and media index writes, i.e. the most work a crash can lose
+REFRESH_CHECKPOINT_EVERY = 200
+
+
+def read_manifest(path=REFRESH_MANIFEST):
+    """Return the manifest of the last refresh, or an empty one."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'started_at': None, 'finished_at': None, 'pages': {}}
+
+
+def write_manifest(manifest, path=REFRESH_MANIFEST):
+    temporary = f"{path}.tmp"
+    with open(temporary, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temporary, path)
+
+
+def problem_pages(route_db=ROUTE_DB, mirror_dir=MIRROR_DIR, hts_index=HTS_INDEX):
+    """{bleau_info_id: HTTrack record} for the mirrored pages of problems in the route database.
+
+    Each record gets a 'path' to its local copy. As in iter_mirror_pages(),
+    the last crawled copy of a problem wins.
+    """
+    wanted = problem_bleau_info_ids(route_db)
+
+    base_dir = os.path.dirname(os.path.abspath(mirror_dir))
+    pages = {}
+    for record in read_hts_index(hts_index):
+        match = PROBLEM_PAGE_RE.match(record['url'])
+        if not match or match.group(2) not in wanted or record['status'] != 200 or not record['localfile']:
+            continue
+        path = os.path.normpath(os.path.join(base_dir, record['localfile']))
+        if os.path.exists(path):
+            pages[match.group(2)] = {**record, 'path': path}
+    return pages
+
+
+def revalidate_page(url, path, etag=None, last_modified=None):
+    """Conditionally GET one page and rewrite its local copy if the content changed.
+
+    Returns a dict with the response 'status', whether the file 'changed',
+    the new validators and, for changed or vanished pages, the 'media' to
+    index. Returns None if the request failed.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    try:
+        response = fetch_url(url, headers)
+    except Exception as e:
+        logger.warning("Error refreshing %s: %s", url, e)
+        return None
+
+    result = {'status': response.status_code, 'changed': False, 'etag': etag, 'last_modified': last_modified}
+    if response.status_code == 304:
+        return result
+    if response.status_code == 404:
+        # Keep the old copy, but its media is no longer on bleau.info
+        return {**result, 'media': (None, None)}
+    if response.status_code != 200:
+        logger.warning("Failed to refresh %s: %s", url, response.status_code)
+        return None
+
+    result['etag'] = response.headers.get('ETag')
+    result['last_modified'] = response.headers.get('Last-Modified')
+    with open(path, 'rb') as f:
+        unchanged = f.read() == response.content
+    if not unchanged:
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(response.content)
+        os.replace(temporary, path)
+        result.update(changed=True, media=extract_media(response.content))
+    return result
+
+
+def _touch_media_index(bleau_info_ids, db_path, now):
+    """Mark the index entries of revalidated pages as fresh again."""
+    ids = list(bleau_info_ids)
+    if not ids:
+        return
+    try:
+        con = sqlite3.connect(db_path)
+        try:
+            with con:
+                create_media_index_table(con)
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    con.execute(
+                        f"UPDATE media_index SET indexed_at = ? WHERE bleau_info_id IN ({','.join('?' * len(chunk))})",
+                        [now, *chunk],
+                    )
+        finally:
+            con.close()
+    except sqlite3.Error as e:
+        logger.warning("Could not touch media index entries: %s", e)
+
+
+def refresh_mirror(base_url=BLEAU_INFO_URL, db_path=MEDIA_INDEX_DB, mirror_dir=MIRROR_DIR, hts_index=HTS_INDEX,
+                   manifest_path=REFRESH_MANIFEST, workers=REFRESH_WORKERS, limit=None, route_db=ROUTE_DB):
+    """Revalidate the mirrored problem pages against `base_url` and refresh what changed.
+
+    Revalidates the pages of the problems in `route_db`, sending a
+    conditional GET per page with the validators HTTrack recorded, or
+    those of the last refresh from the manifest. Only pages the server
+    reports as changed, and whose content really differs, are rewritten and
+    have their media re-extracted into the index at `db_path`; entries for
+    unchanged pages are marked fresh. Progress is checkpointed to the manifest, so a
+    run that did not finish is resumed instead of started over. Pages that
+    failed are retried by the next run. Returns counts per outcome.
+    """
+    manifest = read_manifest(manifest_path)
+    if manifest['started_at'] is None or manifest['finished_at'] is not None:
+        manifest.update(started_at=time.time(), finished_at=None)
+    else:
+        logger.info("Resuming the refresh started at %s", time.ctime(manifest['started_at']))
+
+    pages = problem_pages(route_db, mirror_dir, hts_index)
+    todo = []
+    for bleau_info_id, record in sorted(pages.items()):
+        checked = manifest['pages'].get(bleau_info_id)
+        if checked and checked['checked_at'] >= manifest['started_at']:
+            continue
+        validators = checked or record
+        url = base_url.rstrip('/') + urlparse(record['url']).path
+        todo.append((bleau_info_id, url, record['path'], validators['etag'], validators['last_modified']))
+    counts = {'unchanged': 0, 'changed': 0, 'gone': 0, 'failed': 0, 'skipped': len(pages) - len(todo)}
+    remaining, todo = len(todo), todo[:limit or None]
+    media, fresh = {}, []
+
+    def checkpoint():
+        store_media_many(media, db_path, source='mirror')
+        _touch_media_index(fresh, db_path, time.time())
+        media.clear()
+        fresh.clear()
+        write_manifest(manifest, manifest_path)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mirror-refresh") as executor:
+        futures = {
+            executor.submit(revalidate_page, url, path, etag, last_modified): bleau_info_id
+            for bleau_info_id, url, path, etag, last_modified in todo
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            bleau_info_id, result = futures[future], future.result()
+            if result is None:
+                outcome = 'failed'
+            else:
+                outcome = 'gone' if result['status'] == 404 else 'changed' if result['changed'] else 'unchanged'
+                if 'media' in result:
+                    media[bleau_info_id] = result['media']
+                else:
+                    fresh.append(bleau_info_id)
+                manifest['pages'][bleau_info_id] = {
+                    'status': result['status'], 'etag': result['etag'],
+                    'last_modified': result['last_modified'], 'checked_at': time.time(),
+                }
+            counts[outcome] += 1
+            increment("mirror_pages_total", result=outcome)
+            if done % REFRESH_CHECKPOINT_EVERY == 0:
+                checkpoint()
+                logger.info("Revalidated %d of %d pages", done, len(todo))
+
+    if not counts['failed'] and len(todo) == remaining:
+        manifest['finished_at'] = time.time()
+    checkpoint()
+    logger.info(
+        "Refreshed %d pages in %.1fs: %d changed, %d unchanged, %d gone, %d failed, %d already done",
+        len(todo), time.perf_counter() - start,
+        counts['changed'], counts['unchanged'], counts['gone'], counts['failed'], counts['skipped'],
+    )
+    return counts
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Revalidate the mirrored problem pages and refresh the ones that changed.")
+    parser.add_argument("--base-url", default=BLEAU_INFO_URL, help="Server to revalidate against")
+    parser.add_argument("--db", default=MEDIA_INDEX_DB)
+    parser.add_argument("--route-db", default=ROUTE_DB)
+    parser.add_argument("--mirror", default=MIRROR_DIR)
+    parser.add_argument("--hts-index", default=HTS_INDEX)
+    parser.add_argument("--manifest", default=REFRESH_MANIFEST)
+    parser.add_argument("--workers", type=int, default=REFRESH_WORKERS)
+    parser.add_argument("--limit", type=int, default=0, help="Only revalidate the next N pages")
+    args = parser.parse_args()
+    refresh_mirror(
+        args.base_url, args.db, args.mirror, args.hts_index, args.manifest, args.workers, args.limit, args.route_db
+    )
@@ -0,0 +1,90 @@
+import re
+import unicodedata
+from collections import defaultdict
+
+import numpy as np
+
+# Default number of search results
+SEARCH_LIMIT = 100
+
+# Share of the query's trigrams a name must contain to match; lower tolerates more typos
+MIN_TRIGRAM_MATCH = 0.5
+
+_NOT_ALNUM = re.compile(r'[^a-z0-9]')
+
+
+def normalize_name(text):
+    """Lowercase a name and strip accents, spaces and punctuation ("La Traversée" -> "latraversee")."""
+    if not isinstance(text, str):
+        return ""
+    decomposed = unicodedata.normalize('NFKD', text)
+    ascii_text = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return _NOT_ALNUM.sub('', ascii_text.lower())
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class NameIndex:
+    """Trigram and prefix index over problem names for typo-tolerant search.
+
+    Each row may have several names (name, name_en, name_searchable); all
+    are normalized with normalize_name() and indexed together. Queries of
+    three or more characters are matched by the share of their trigrams a
+    name contains, so a typo or two still finds the problem; shorter
+    queries are matched as name prefixes. Results are ranked by match
+    quality, then popularity.
+    """
+
+    def __init__(self, names, popularity):
+        self.size = len(popularity)
+        self.popularity = np.asarray(popularity, dtype=np.int64)
+
+        postings = defaultdict(set)
+        prefixes = []
+        for position, row in enumerate(names):
+            for name in {normalize_name(name) for name in row} - {""}:
+                prefixes.append((name, position))
+                for trigram in trigrams(name):
+                    postings[trigram].add(position)
+        self.postings = {trigram: np.array(sorted(rows), dtype=np.int32) for trigram, rows in postings.items()}
+        prefixes.sort()
+        self.prefix_names = np.array([name for name, position in prefixes])
+        self.prefix_positions = np.array([position for name, position in prefixes], dtype=np.int32)
+
+    def _prefix_matches(self, query, exact=False):
+        start = np.searchsorted(self.prefix_names, query, side='left')
+        stop = np.searchsorted(self.prefix_names, query if exact else query + '\x7f', side='right')
+        return np.unique(self.prefix_positions[start:stop])
+
+    def search(self, query, positions=None, limit=SEARCH_LIMIT):
+        """Return the row positions best matching `query`, best first.
+
+        If `positions` is given, only those rows are considered, so the
+        search combines with the sidebar filters.
+        """
+        query = normalize_name(query)
+        if not query:
+            return np.empty(0, dtype=np.int64)
+
+        score = np.zeros(self.size, dtype=np.float32)
+        query_trigrams = trigrams(query)
+        if query_trigrams:
+            lists = [self.postings[trigram] for trigram in query_trigrams if trigram in self.postings]
+            if lists:
+                hits = np.bincount(np.concatenate(lists), minlength=self.size)
+                share = hits / len(query_trigrams)
+                score = np.where(share >= MIN_TRIGRAM_MATCH, share, 0).astype(np.float32)
+        # Exact names rank first, then names starting with the query, then trigram matches
+        score[self._prefix_matches(query)] += 1
+        score[self._prefix_matches(query, exact=True)] += 1
+
+        if positions is not None:
+            allowed = np.zeros(self.size, dtype=bool)
+            allowed[np.asarray(positions, dtype=np.int64)] = True
+            score[~allowed] = 0
+
+        candidates = np.flatnonzero(score > 0)
+        order = np.lexsort((-self.popularity[candidates], -score[candidates]))
+        return candidates[order[:limit]]
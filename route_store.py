@@ -0,0 +1,164 @@
+import os
+from dataclasses import dataclass
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from cluster_index import ClusterIndex
+from data_loader import load_data
+from facet_cube import FacetCube
+from filter_engine import FilterEngine
+from grade_utils import grade_to_numeric
+from name_search import SEARCH_LIMIT, NameIndex
+from shared_store import attach_store, current_version
+from similarity_index import SIMILAR_LIMIT, SimilarityIndex
+from spatial_index import SpatialIndex
+from sql_backend import SqlRouteStore
+
+# "memory" keeps the typed table in pandas; "sqlite" answers queries from boolder.db
+ROUTE_BACKEND = os.environ.get("ROUTE_BACKEND", "memory")
+
+
+@dataclass(frozen=True)
+class RouteStore:
+    """Immutable, typed table of every route, shared by all filters and views.
+
+    Treat `data` as read-only: derive new frames from it instead of
+    assigning columns in place. Its index is a RangeIndex, so index labels
+    double as the row positions returned by the store's indexes.
+    """
+    data: pd.DataFrame
+
+    def __len__(self):
+        return len(self.data)
+
+    @cached_property
+    def filter_engine(self):
+        """Bitset and sorted-array indexes used by apply_filters."""
+        return FilterEngine(self.data)
+
+    @cached_property
+    def spatial_index(self):
+        """Grid index for radius, viewport and nearest-route queries."""
+        return SpatialIndex(self.data['latitude'], self.data['longitude'])
+
+    @cached_property
+    def cluster_index(self):
+        """Per-zoom grid clusters for the map."""
+        return ClusterIndex(self.data['latitude'], self.data['longitude'], self.data['grade_numeric'])
+
+    @cached_property
+    def name_index(self):
+        """Trigram index over the route names for search."""
+        names = zip(self.data['name'], self.data['name_en'], self.data['name_searchable'])
+        return NameIndex(names, self.data['popularity'])
+
+    @cached_property
+    def facet_cube(self):
+        """Route counts per filter option for the sidebar and summary statistics."""
+        return FacetCube(self.data)
+
+    @cached_property
+    def similarity_index(self):
+        """Feature vectors of every route for the similar problems recommender."""
+        return SimilarityIndex(self.data)
+
+    def apply_filters(self, filters):
+        """Return the routes matching the sidebar filter dict."""
+        return self.filter_engine.apply(filters)
+
+    def facet_counts(self, filters):
+        """Routes each filter option would match given the other filters; see FacetCube.counts."""
+        return self.facet_cube.counts(filters)
+
+    def facet_summary(self, filters):
+        """Summary statistics of the routes matching the filters; see FacetCube.summary."""
+        return self.facet_cube.summary(filters)
+
+    @cached_property
+    def _options(self):
+        data = self.data
+        return {
+            'grades': sorted(data.loc[data['grade'] != '', 'grade'].unique(), key=grade_to_numeric),
+            'steepness': sorted(data['steepness'].dropna().unique()),
+            'areas': sorted(data['area_name'].dropna().unique()),
+            'popularity_range': (int(data['popularity'].min()), int(data['popularity'].max())),
+        }
+
+    def filter_options(self):
+        """Values offered by the sidebar filters."""
+        return self._options
+
+    def project_routes(self, bleau_info_ids):
+        """Return the routes with the given bleau.info IDs."""
+        if not bleau_info_ids:
+            return pd.DataFrame()
+        return self.data[self.data['bleau_info_id'].isin(bleau_info_ids)]
+
+    @cached_property
+    def _without_bleau_info_id(self):
+        return np.flatnonzero(self.data['bleau_info_id'].isna() | (self.data['bleau_info_id'] == ''))
+
+    def similar_routes(self, bleau_info_ids, limit=SIMILAR_LIMIT):
+        """Return the routes most like any of the given ones, most similar first; see SimilarityIndex.
+
+        The given routes, and routes that cannot be added to a project
+        list for lack of a bleau.info ID, are left out.
+        """
+        positions = np.flatnonzero(self.data['bleau_info_id'].isin(list(bleau_info_ids)))
+        best, _ = self.similarity_index.nearest(positions, limit, self._without_bleau_info_id)
+        return self.data.iloc[best]
+
+    @cached_property
+    def _id_index(self):
+        return pd.Index(self.data['id'])
+
+    def routes_by_id(self, problem_ids):
+        """Return the routes with the given problem IDs, skipping unknown ones."""
+        positions = self._id_index.get_indexer(list(problem_ids))
+        return self.data.iloc[positions[positions >= 0]]
+
+    def routes_in_bounds(self, routes, south, west, north, east):
+        """Keep the routes that lie inside a lat/lon bounding box."""
+        in_view = self.spatial_index.within_bounds(south, west, north, east)
+        return routes[routes.index.isin(in_view)]
+
+    def search(self, routes, query, limit=SEARCH_LIMIT):
+        """Return the routes among `routes` whose names best match `query`, best first."""
+        positions = self.name_index.search(query, routes.index.to_numpy(), limit)
+        return self.data.iloc[positions]
+
+    def clusters(self, routes, zoom):
+        """Cluster a subset of the routes for a zoom level; see ClusterIndex.clusters."""
+        return self.cluster_index.clusters(routes.index.to_numpy(), zoom)
+
+
+@st.cache_resource
+def _local_route_store():
+    """Build the route store once per process."""
+    if ROUTE_BACKEND == "sqlite":
+        return SqlRouteStore()
+    return RouteStore(load_data())
+
+
+@st.cache_resource(max_entries=1)
+def _shared_route_store(version):
+    """Attach to a published route store once per process and version."""
+    return attach_store(version)
+
+
+def get_route_store():
+    """Return the route store shared by every session of the process.
+
+    With the memory backend, a store published by shared_store.py is
+    mapped rather than built, so worker processes share one copy of the
+    routes and indexes. The published version is checked on every call,
+    so a newly published dataset is picked up by the next rerun without
+    a restart; otherwise the store is built in this process.
+    """
+    version = current_version() if ROUTE_BACKEND == "memory" else None
+    if version:
+        return _shared_route_store(version)
+    return _local_route_store()
@@ -0,0 +1,90 @@
+import argparse
+import logging
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from data_loader import ROUTE_DB
+
+logger = logging.getLogger(__name__)
+
+# Standard deviation, in meters, of the offset between a synthetic problem and the one it was copied from
+JITTER_METERS = 25
+
+# Spread of the multiplicative noise applied to copied popularity values
+POPULARITY_NOISE = 0.3
+
+METERS_PER_DEGREE = 111_320
+
+
+def scale_problems(problems, areas, factor, seed=0):
+    """Return `factor - 1` synthetic copies of the problems table, as one frame.
+
+    Every copy draws, per area, as many problems as the area really has
+    (with replacement), so areas keep their size and each synthetic row
+    keeps the grade, steepness, sit start and circuit of a real problem.
+    Coordinates are jittered by JITTER_METERS and kept inside the area's
+    bounding box, popularity gets log-normal noise, and names get a copy
+    number. Synthetic problems have fresh ids and no bleau.info page.
+    """
+    rng = np.random.default_rng(seed)
+    areas = areas.set_index('id')
+    next_id = int(problems['id'].max()) + 1
+    copies = []
+    for copy_number in range(2, factor + 1):
+        positions = np.concatenate([
+            rng.choice(rows, size=len(rows)) for rows in problems.groupby('area_id').indices.values()
+        ])
+        copy = problems.iloc[positions].reset_index(drop=True)
+        copy['id'] = np.arange(next_id, next_id + len(copy))
+        next_id += len(copy)
+
+        bounds = areas.loc[copy['area_id']]
+        latitude = copy['latitude'] + rng.normal(0, JITTER_METERS / METERS_PER_DEGREE, len(copy))
+        longitude = copy['longitude'] + rng.normal(
+            0, JITTER_METERS / (METERS_PER_DEGREE * np.cos(np.radians(copy['latitude']))), len(copy)
+        )
+        copy['latitude'] = np.clip(latitude, bounds['south_west_lat'].to_numpy(), bounds['north_east_lat'].to_numpy())
+        copy['longitude'] = np.clip(longitude, bounds['south_west_lon'].to_numpy(), bounds['north_east_lon'].to_numpy())
+
+        popularity = copy['popularity'] * rng.lognormal(0, POPULARITY_NOISE, len(copy))
+        copy['popularity'] = popularity.round().astype('Int64')
+        for column in ('name', 'name_en', 'name_searchable'):
+            copy[column] = copy[column].where(copy[column].isna(), copy[column] + f" {copy_number}")
+        copy['bleau_info_id'] = None
+        copy['parent_id'] = None
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def scale_dataset(out_path, factor, db_path=ROUTE_DB, seed=0):
+    """Write a copy of the route database with `factor` times as many problems."""
+    source = sqlite3.connect(db_path)
+    target = sqlite3.connect(out_path)
+    try:
+        source.backup(target)
+        problems = pd.read_sql("SELECT * FROM problems", source)
+        areas = pd.read_sql(
+            "SELECT id, south_west_lat, south_west_lon, north_east_lat, north_east_lon FROM areas", source
+        )
+        synthetic = scale_problems(problems, areas, factor, seed)
+        with target:
+            synthetic.to_sql("problems", target, if_exists="append", index=False)
+        count = target.execute("SELECT COUNT(*) FROM problems").fetchone()[0]
+    finally:
+        source.close()
+        target.close()
+    logger.info("Wrote %d problems (%dx %d) to %s", count, factor, len(problems), out_path)
+    return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Write a scaled-up copy of the route database for benchmarks.")
+    parser.add_argument("--factor", type=int, default=10)
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--db", default=ROUTE_DB)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    scale_dataset(args.out, args.factor, args.db, args.seed)
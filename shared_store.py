@@ -0,0 +1,136 @@
+import argparse
+import logging
+import mmap
+import os
+import pickle
+import struct
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Published route store segments and the CURRENT pointer to the active one
+ROUTE_SEGMENTS = os.environ.get("ROUTE_SEGMENTS", "route_segments")
+
+# Route store indexes built before publishing, so no process has to build its own
+SHARED_INDEXES = (
+    'filter_engine', 'spatial_index', 'cluster_index', 'name_index', 'facet_cube', '_options', '_id_index',
+    'similarity_index', '_without_bleau_info_id',
+)
+
+# Segments kept on disk: the current one and those processes may still be switching away from
+SEGMENTS_KEPT = 2
+
+# Every array in a segment starts on a multiple of this many bytes
+SEGMENT_ALIGNMENT = 64
+
+_HEADER = struct.Struct('<QQ')
+
+
+def _aligned(offset):
+    return -(-offset // SEGMENT_ALIGNMENT) * SEGMENT_ALIGNMENT
+
+
+def segment_path(version, directory=ROUTE_SEGMENTS):
+    return os.path.join(directory, f"routes-{version}.seg")
+
+
+def write_segment(obj, path):
+    """Pickle `obj` into a file that read_segment() can map without copying its arrays.
+
+    Uses pickle protocol 5: NumPy and Arrow buffers are written out of band,
+    each aligned, after the pickle stream and a table of their offsets.
+    """
+    buffers = []
+    payload = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    views = [buffer.raw() for buffer in buffers]
+    table_size = 16 * len(views)
+    offset = _aligned(_HEADER.size + table_size + len(payload))
+    table = []
+    for view in views:
+        table.extend((offset, view.nbytes))
+        offset = _aligned(offset + view.nbytes)
+
+    temporary = f"{path}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(_HEADER.pack(len(views), len(payload)))
+        f.write(struct.pack(f'<{len(table)}Q', *table))
+        f.write(payload)
+        for (start, _), view in zip(zip(table[::2], table[1::2]), views):
+            f.seek(start)
+            f.write(view)
+        f.truncate(offset)
+    os.replace(temporary, path)
+    return offset
+
+
+def read_segment(path):
+    """Map a segment written by write_segment() and unpickle it.
+
+    The arrays are read-only views of the mapping, so every process that
+    reads the same segment shares its pages through the OS page cache.
+    """
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    count, payload_size = _HEADER.unpack_from(mapped)
+    table = struct.unpack_from(f'<{2 * count}Q', mapped, _HEADER.size)
+    start = _HEADER.size + 16 * count
+    buffers = [view[offset:offset + size] for offset, size in zip(table[::2], table[1::2])]
+    return pickle.loads(view[start:start + payload_size], buffers=buffers)
+
+
+def current_version(directory=ROUTE_SEGMENTS):
+    """The version of the published route store, or None if nothing was published."""
+    try:
+        with open(os.path.join(directory, "CURRENT")) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def publish_store(store, directory=ROUTE_SEGMENTS):
+    """Build every index of a RouteStore, write it as a new segment and make it current.
+
+    Processes pick the new version up on their next get_route_store()
+    call. Older segments beyond SEGMENTS_KEPT are removed; processes that
+    still have one mapped keep reading it until they switch. Returns the
+    new version.
+    """
+    for name in SHARED_INDEXES:
+        getattr(store, name)
+    os.makedirs(directory, exist_ok=True)
+    version = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    size = write_segment(store, segment_path(version, directory))
+
+    pointer = os.path.join(directory, "CURRENT")
+    with open(f"{pointer}.tmp", 'w') as f:
+        f.write(version)
+    os.replace(f"{pointer}.tmp", pointer)
+    logger.info("Published %d routes as version %s (%.1f MiB)", len(store), version, size / 2 ** 20)
+
+    segments = sorted(name for name in os.listdir(directory) if name.startswith("routes-") and name.endswith(".seg"))
+    for name in segments[:-SEGMENTS_KEPT]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError as e:
+            logger.warning("Could not remove old segment %s: %s", name, e)
+    return version
+
+
+def attach_store(version, directory=ROUTE_SEGMENTS):
+    """Map a published route store without copying its data or indexes."""
+    store = read_segment(segment_path(version, directory))
+    logger.info("Attached route store version %s (%d routes)", version, len(store))
+    return store
+
+
+if __name__ == "__main__":
+    from data_loader import ROUTE_DB, load_data
+    from route_store import RouteStore
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Publish the route store as a shared, memory-mapped segment.")
+    parser.add_argument("--db", default=ROUTE_DB)
+    parser.add_argument("--dir", default=ROUTE_SEGMENTS)
+    args = parser.parse_args()
+    publish_store(RouteStore(load_data(args.db)), args.dir)
@@ -0,0 +1,108 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+from spatial_index import EARTH_RADIUS
+
+# Problems suggested next to the project list
+SIMILAR_LIMIT = 10
+
+# Scale of each feature, in distance units per unit of the feature: one grade step (6a to 6a+)
+# weighs as much as a kilometre of walking, a different steepness or circuit colour a little more
+SIMILARITY_WEIGHTS = {
+    'grade': 1.0,        # per numeric grade step
+    'steepness': 1.0,    # per one-hot column, so a different steepness is sqrt(2)
+    'sit_start': 1.0,
+    'popularity': 0.5,   # per e-fold of popularity + 1
+    'location': 1.0,     # per kilometre
+    'circuit': 0.75,     # per one-hot circuit colour column, no circuit being all zeros
+}
+
+# Rows compared against the query problems at a time, bounding the distance matrix held in memory
+SIMILARITY_BLOCK_ROWS = 32_768
+
+
+def _one_hot(column, weight):
+    codes, values = pd.factorize(column)
+    features = np.zeros((len(codes), len(values)))
+    known = codes >= 0
+    features[np.flatnonzero(known), codes[known]] = weight
+    return features
+
+
+def problem_features(data):
+    """Weighted feature vector of every problem, one row each; see SIMILARITY_WEIGHTS.
+
+    Columns are centred, so squared norms stay small and the
+    norm-expansion distances in SimilarityIndex lose no precision.
+    """
+    w = SIMILARITY_WEIGHTS
+    latitudes = data['latitude'].to_numpy(dtype=np.float64)
+    longitudes = data['longitude'].to_numpy(dtype=np.float64)
+    cos_ref = math.cos(math.radians(latitudes.mean())) if len(latitudes) else 1.0
+    features = np.column_stack([
+        data['grade_numeric'].to_numpy(dtype=np.float64) * w['grade'],
+        (data['sit_start'].to_numpy(dtype=np.float64) != 0) * w['sit_start'],
+        np.log1p(data['popularity'].to_numpy(dtype=np.float64)) * w['popularity'],
+        np.radians(longitudes) * EARTH_RADIUS * cos_ref / 1000 * w['location'],
+        np.radians(latitudes) * EARTH_RADIUS / 1000 * w['location'],
+        _one_hot(data['steepness'], w['steepness']),
+        _one_hot(data['circuit_color'], w['circuit']),
+    ])
+    return features - features.mean(axis=0) if len(features) else features
+
+
+class SimilarityIndex:
+    """Exact k-nearest-neighbour index over problem feature vectors.
+
+    The features and their squared norms are computed once; a query is a
+    few matrix products against blocks of SIMILARITY_BLOCK_ROWS rows,
+    which numpy hands to BLAS, keeping a running top k between blocks.
+    """
+
+    def __init__(self, data):
+        self.features = problem_features(data)
+        self.norms = np.einsum('ij,ij->i', self.features, self.features)
+
+    def __len__(self):
+        return len(self.features)
+
+    def nearest(self, positions, k, excluded=None):
+        """Row positions and distances of the k problems closest to any of the problems at `positions`.
+
+        A problem's distance is to the nearest query problem, so a project
+        list mixing styles gets suggestions for each of them rather than
+        for their average. The query problems themselves and any row
+        positions in `excluded` are never returned. Nearest first.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        skip = np.zeros(len(self), dtype=bool)
+        skip[positions] = True
+        if excluded is not None:
+            skip[excluded] = True
+        k = min(k, len(self) - int(skip.sum()))
+        if len(positions) == 0 or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        queries, query_norms = self.features[positions], self.norms[positions]
+        best, best_distances = np.empty(0, dtype=np.int64), np.empty(0)
+        for start in range(0, len(self), SIMILARITY_BLOCK_ROWS):
+            stop = min(start + SIMILARITY_BLOCK_ROWS, len(self))
+            # |q - x|^2 = |q|^2 - 2 q.x + |x|^2, minimized over the queries before adding |x|^2
+            products = queries @ self.features[start:stop].T
+            products *= -2
+            products += query_norms[:, None]
+            distances = products.min(axis=0) + self.norms[start:stop]
+            distances[skip[start:stop]] = np.inf
+            keep = np.argpartition(distances, k - 1)[:k] if stop - start > k else np.arange(stop - start)
+            best = np.concatenate([best, keep + start])
+            best_distances = np.concatenate([best_distances, distances[keep]])
+            if len(best) > k:
+                keep = np.argpartition(best_distances, k - 1)[:k]
+                best, best_distances = best[keep], best_distances[keep]
+
+        order = np.lexsort((best, best_distances))
+        best, best_distances = best[order], best_distances[order]
+        found = np.isfinite(best_distances)
+        return best[found], np.sqrt(np.maximum(best_distances[found], 0))
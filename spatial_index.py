@@ -0,0 +1,100 @@
+import math
+
+import numpy as np
+
+EARTH_RADIUS = 6_371_000  # metres
+
+# Grid cell edge in metres; roughly the spread of a typical boulder circuit
+DEFAULT_CELL_SIZE = 250
+
+
+class SpatialIndex:
+    """Uniform grid index over route coordinates.
+
+    Coordinates are projected once to local equirectangular metres, which
+    is accurate to well under a metre across the forest. Points are sorted
+    by grid cell (row-major) so that every query only touches a few
+    contiguous slices of the sorted arrays.
+    """
+
+    def __init__(self, latitudes, longitudes, cell_size=DEFAULT_CELL_SIZE):
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        self.cell_size = float(cell_size)
+        self.ref_lat = float(latitudes.mean()) if len(latitudes) else 48.4
+        self.cos_ref = math.cos(math.radians(self.ref_lat))
+
+        x, y = self._project(latitudes, longitudes)
+        self.x_min = float(x.min()) if len(x) else 0.0
+        self.y_min = float(y.min()) if len(y) else 0.0
+        cx, cy = self._cell(x, y)
+        self.columns = int(cx.max()) + 1 if len(cx) else 1
+        self.rows = int(cy.max()) + 1 if len(cy) else 1
+
+        cell_ids = cy * self.columns + cx
+        self.order = np.argsort(cell_ids, kind='stable')
+        self.x = x[self.order]
+        self.y = y[self.order]
+        self.cell_start = np.searchsorted(cell_ids[self.order], np.arange(self.rows * self.columns + 1))
+
+    def __len__(self):
+        return len(self.order)
+
+    def _project(self, latitudes, longitudes):
+        x = np.radians(longitudes) * EARTH_RADIUS * self.cos_ref
+        y = np.radians(latitudes) * EARTH_RADIUS
+        return x, y
+
+    def _cell(self, x, y):
+        cx = np.floor((np.asarray(x) - self.x_min) / self.cell_size).astype(np.int64)
+        cy = np.floor((np.asarray(y) - self.y_min) / self.cell_size).astype(np.int64)
+        return cx, cy
+
+    def _candidates(self, x0, y0, x1, y1):
+        """Sorted-array offsets of every point in the grid cells overlapping a box."""
+        (cx0, cx1), (cy0, cy1) = self._cell([x0, x1], [y0, y1])
+        cx0, cx1 = max(int(cx0), 0), min(int(cx1), self.columns - 1)
+        cy0, cy1 = max(int(cy0), 0), min(int(cy1), self.rows - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.empty(0, dtype=np.int64)
+        rows = np.arange(cy0, cy1 + 1) * self.columns
+        starts = self.cell_start[rows + cx0]
+        stops = self.cell_start[rows + cx1 + 1]
+        return np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)])
+
+    def within_radius(self, lat, lon, radius):
+        """Row positions of routes within `radius` metres of a point, nearest first."""
+        x, y = self._project(lat, lon)
+        slots = self._candidates(x - radius, y - radius, x + radius, y + radius)
+        distances = np.hypot(self.x[slots] - x, self.y[slots] - y)
+        inside = distances <= radius
+        slots, distances = slots[inside], distances[inside]
+        nearest_first = np.argsort(distances, kind='stable')
+        return self.order[slots[nearest_first]]
+
+    def within_bounds(self, south, west, north, east):
+        """Row positions of routes inside a lat/lon bounding box, in row order."""
+        x0, y0 = self._project(south, west)
+        x1, y1 = self._project(north, east)
+        slots = self._candidates(x0, y0, x1, y1)
+        inside = (self.x[slots] >= x0) & (self.x[slots] <= x1) & (self.y[slots] >= y0) & (self.y[slots] <= y1)
+        return np.sort(self.order[slots[inside]])
+
+    def nearest(self, lat, lon, k):
+        """Row positions and distances in metres of the k routes closest to a point."""
+        k = min(k, len(self))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        x, y = self._project(lat, lon)
+        radius = self.cell_size
+        extent = max(self.columns, self.rows) * self.cell_size + abs(x - self.x_min) + abs(y - self.y_min)
+        while True:
+            slots = self._candidates(x - radius, y - radius, x + radius, y + radius)
+            distances = np.hypot(self.x[slots] - x, self.y[slots] - y)
+            # Only points inside the search circle are guaranteed to beat anything outside the box
+            if np.count_nonzero(distances <= radius) >= k or radius > extent:
+                break
+            radius *= 2
+        best = np.argpartition(distances, k - 1)[:k] if len(distances) > k else np.arange(len(distances))
+        best = best[np.argsort(distances[best], kind='stable')]
+        return self.order[slots[best]], distances[best]
@@ -0,0 +1,297 @@
+import argparse
+import math
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from cluster_index import ClusterIndex
+from data_loader import PROBLEM_COLUMNS, ROUTE_DB, prepare_routes
+from facet_cube import GRADE_LEVELS
+from filter_engine import SIT_START_VALUES
+from grade_utils import GRADE_TO_NUMERIC
+from name_search import SEARCH_LIMIT, NameIndex
+from similarity_index import SIMILAR_LIMIT, SIMILARITY_WEIGHTS
+from spatial_index import EARTH_RADIUS
+
+# Numeric grade computed in SQL, used when the grade_numeric column has not been added yet
+GRADE_NUMERIC_EXPR = "CASE TRIM(p.grade) {} ELSE 0 END".format(
+    " ".join(f"WHEN '{grade}' THEN {numeric}" for grade, numeric in GRADE_TO_NUMERIC.items() if grade)
+)
+
+INDEXES = {
+    'problems_area_grade': "problems (area_id, grade_numeric)",
+    'problems_grade_numeric': "problems (grade_numeric)",
+    'problems_steepness': "problems (steepness)",
+    'problems_popularity': "problems (popularity)",
+    'problems_bleau_info_id': "problems (bleau_info_id)",
+}
+
+
+def prepare_database(db_path=ROUTE_DB):
+    """Add the grade_numeric column and the filter indexes to the database.
+
+    Safe to run repeatedly; grade_numeric is recomputed every time.
+    """
+    con = sqlite3.connect(db_path)
+    try:
+        with con:
+            columns = {row[1] for row in con.execute("PRAGMA table_info(problems)")}
+            if 'grade_numeric' not in columns:
+                con.execute("ALTER TABLE problems ADD COLUMN grade_numeric INTEGER")
+            con.execute(f"UPDATE problems AS p SET grade_numeric = {GRADE_NUMERIC_EXPR}")
+            for name, target in INDEXES.items():
+                con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+            con.execute("ANALYZE")
+    finally:
+        con.close()
+
+
+def connect_readonly(db_path=ROUTE_DB):
+    """Open a read-only connection that may be shared between threads."""
+    return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+
+
+def build_filter_query(filters, grade_numeric="p.grade_numeric"):
+    """Translate the sidebar filter dict into a parameterized SQL query."""
+    conditions = [f"{grade_numeric} BETWEEN ? AND ?"]
+    params = list(filters['selected_grade_range'])
+
+    if filters['selected_steepness']:
+        conditions.append(f"p.steepness IN ({','.join('?' * len(filters['selected_steepness']))})")
+        params.extend(filters['selected_steepness'])
+
+    if filters['selected_areas']:
+        conditions.append(f"a.name IN ({','.join('?' * len(filters['selected_areas']))})")
+        params.extend(filters['selected_areas'])
+
+    if filters['sit_start_option'] == "Sit Start Only":
+        conditions.append("p.sit_start = 1")
+    elif filters['sit_start_option'] == "Standing Start Only":
+        conditions.append("p.sit_start = 0")
+
+    if filters['selected_popularity']:
+        conditions.append("COALESCE(p.popularity, 0) BETWEEN ? AND ?")
+        params.extend(filters['selected_popularity'])
+
+    return " AND ".join(conditions), params
+
+
+class SqlRouteStore:
+    """Route store that answers every query from SQLite instead of holding the table.
+
+    Offers the same query methods as route_store.RouteStore, so the app can
+    switch backends without other changes. Filters, facet counts, summaries
+    and similar problems are computed in SQL, so only query results are
+    held in pandas. Name search is the exception: fuzzy ranking has no SQL
+    equivalent, so it keeps a NameIndex over every id and name.
+    """
+
+    def __init__(self, db_path=ROUTE_DB):
+        self.db_path = db_path
+        self.con = connect_readonly(db_path)
+        self.lock = threading.Lock()
+        columns = {row[1] for row in self.con.execute("PRAGMA table_info(problems)")}
+        self.grade_numeric = "p.grade_numeric" if 'grade_numeric' in columns else GRADE_NUMERIC_EXPR
+        self._options = None
+        self._name_index = None
+        self._cos_ref = None
+        try:
+            self.con.execute("SELECT ln(1)")
+        except sqlite3.OperationalError:
+            # SQLite built without its math functions
+            self.con.create_function("ln", 1, math.log, deterministic=True)
+
+    def _read(self, where="1", params=()):
+        selected = ", ".join(f"p.{column}" for column in PROBLEM_COLUMNS if column != 'grade')
+        query = (
+            f"SELECT {selected}, TRIM(p.grade) AS grade, a.name AS area_name "
+            "FROM problems p LEFT JOIN areas a ON a.id = p.area_id "
+            f"WHERE {where} ORDER BY p.id"
+        )
+        with self.lock:
+            df = pd.read_sql(query, self.con, params=list(params))
+        return prepare_routes(df[PROBLEM_COLUMNS + ['area_name']])
+
+    def __len__(self):
+        with self.lock:
+            return self.con.execute("SELECT COUNT(*) FROM problems").fetchone()[0]
+
+    def apply_filters(self, filters):
+        """Return the routes matching the sidebar filter dict."""
+        where, params = build_filter_query(filters, self.grade_numeric)
+        return self._read(where, params)
+
+    def _count_by(self, key, filters):
+        where, params = build_filter_query(filters, self.grade_numeric)
+        query = (
+            f"SELECT {key}, COUNT(*) FROM problems p LEFT JOIN areas a ON a.id = p.area_id "
+            f"WHERE {where} GROUP BY 1"
+        )
+        with self.lock:
+            return dict(self.con.execute(query, params).fetchall())
+
+    def facet_counts(self, filters):
+        """Routes each filter option would match given the other filters; see FacetCube.counts.
+
+        One GROUP BY query per filter, each leaving that filter out.
+        """
+        filters = {'selected_popularity': None} | filters
+        options = self.filter_options()
+        areas = self._count_by("a.name", filters | {'selected_areas': []})
+        grades = self._count_by(
+            f"MIN(MAX({self.grade_numeric}, 0), {GRADE_LEVELS - 1})",
+            filters | {'selected_grade_range': (0, GRADE_LEVELS - 1)},
+        )
+        steepness = self._count_by("p.steepness", filters | {'selected_steepness': []})
+        sit_start = self._count_by("p.sit_start != 0", filters | {'sit_start_option': "All"})
+        per_grade = np.zeros(GRADE_LEVELS, dtype=np.int64)
+        for grade, count in grades.items():
+            per_grade[grade] = count
+        return {
+            'total': sum(self._count_by("1", filters).values()),
+            'areas': {area: areas.get(area, 0) for area in options['areas']},
+            'grades': per_grade,
+            'steepness': {value: steepness.get(value, 0) for value in options['steepness']},
+            'sit_start': {
+                option: sit_start.get(value, 0) for option, value in SIT_START_VALUES.items()
+            } | {"All": sum(count for value, count in sit_start.items() if value is not None)},
+        }
+
+    def facet_summary(self, filters):
+        """Summary statistics of the routes matching the filters; see FacetCube.summary."""
+        where, params = build_filter_query({'selected_popularity': None} | filters, self.grade_numeric)
+        query = (
+            f"SELECT COUNT(*), AVG(MIN(MAX({self.grade_numeric}, 0), {GRADE_LEVELS - 1})), "
+            "AVG(COALESCE(p.popularity, 0)), COUNT(DISTINCT a.name) "
+            f"FROM problems p LEFT JOIN areas a ON a.id = p.area_id WHERE {where}"
+        )
+        with self.lock:
+            count, mean_grade, mean_popularity, areas = self.con.execute(query, params).fetchone()
+        return {'count': count, 'mean_grade': mean_grade, 'mean_popularity': mean_popularity, 'areas': areas}
+
+    def filter_options(self):
+        """Values offered by the sidebar filters."""
+        if self._options is None:
+            with self.lock:
+                grades = [row[0] for row in self.con.execute(
+                    "SELECT DISTINCT TRIM(grade) FROM problems WHERE TRIM(grade) != ''"
+                )]
+                steepness = [row[0] for row in self.con.execute("SELECT DISTINCT steepness FROM problems")]
+                areas = [row[0] for row in self.con.execute(
+                    "SELECT DISTINCT a.name FROM problems p JOIN areas a ON a.id = p.area_id"
+                )]
+                popularity = self.con.execute(
+                    "SELECT MIN(COALESCE(popularity, 0)), MAX(COALESCE(popularity, 0)) FROM problems"
+                ).fetchone()
+            self._options = {
+                'grades': sorted(grades, key=lambda grade: GRADE_TO_NUMERIC.get(grade, 0)),
+                'steepness': sorted(steepness),
+                'areas': sorted(areas),
+                'popularity_range': (int(popularity[0]), int(popularity[1])),
+            }
+        return self._options
+
+    def project_routes(self, bleau_info_ids):
+        """Return the routes with the given bleau.info IDs."""
+        ids = list(bleau_info_ids)
+        if not ids:
+            return pd.DataFrame()
+        return self._read(f"p.bleau_info_id IN ({','.join('?' * len(ids))})", ids)
+
+    def routes_by_id(self, problem_ids):
+        """Return the routes with the given problem IDs, skipping unknown ones."""
+        ids = [int(problem_id) for problem_id in problem_ids]
+        if not ids:
+            return pd.DataFrame()
+        return self._read(f"p.id IN ({','.join('?' * len(ids))})", ids)
+
+    def _similarity_features(self, where):
+        """SELECT of the weighted features of problems, the columns of similarity_index.problem_features."""
+        w = SIMILARITY_WEIGHTS
+        if self._cos_ref is None:
+            with self.lock:
+                mean_latitude = self.con.execute("SELECT AVG(latitude) FROM problems").fetchone()[0]
+            self._cos_ref = math.cos(math.radians(mean_latitude)) if mean_latitude is not None else 1.0
+        km_per_degree = math.radians(1) * EARTH_RADIUS / 1000 * w['location']
+        return (
+            f"SELECT p.id, p.bleau_info_id, {self.grade_numeric} * {w['grade']} AS grade, "
+            f"(p.sit_start != 0) * {w['sit_start']} AS sit_start, "
+            f"ln(COALESCE(p.popularity, 0) + 1) * {w['popularity']} AS popularity, "
+            f"p.longitude * {km_per_degree * self._cos_ref} AS x, p.latitude * {km_per_degree} AS y, "
+            f"p.steepness, p.circuit_color FROM problems p WHERE {where}"
+        )
+
+    def similar_routes(self, bleau_info_ids, limit=SIMILAR_LIMIT):
+        """Return the routes most like any of the given ones, most similar first; see SimilarityIndex.
+
+        Distances are computed in SQL against each project route, keeping
+        the smallest, with the same weights as SimilarityIndex.
+        """
+        ids = list(bleau_info_ids)
+        if not ids:
+            return pd.DataFrame()
+        w = SIMILARITY_WEIGHTS
+
+        def squared(column):
+            return f"(c.{column} - q.{column}) * (c.{column} - q.{column})"
+
+        def one_hot(column, weight):
+            # One-hot columns: a different value differs in two columns, a missing one in one
+            return (
+                f"CASE WHEN c.{column} IS q.{column} THEN 0 "
+                f"WHEN c.{column} IS NULL OR q.{column} IS NULL THEN {weight ** 2} ELSE {2 * weight ** 2} END"
+            )
+
+        distance = " + ".join([
+            *(squared(column) for column in ('grade', 'sit_start', 'popularity', 'x', 'y')),
+            one_hot('steepness', w['steepness']), one_hot('circuit_color', w['circuit']),
+        ])
+        marks = ','.join('?' * len(ids))
+        candidates = f"p.bleau_info_id != '' AND p.bleau_info_id NOT IN ({marks})"
+        query = (
+            f"WITH q AS MATERIALIZED ({self._similarity_features(f'p.bleau_info_id IN ({marks})')}) "
+            f"SELECT c.id, MIN({distance}) AS distance "
+            f"FROM ({self._similarity_features(candidates)}) c CROSS JOIN q "
+            "GROUP BY c.id ORDER BY distance, c.id LIMIT ?"
+        )
+        with self.lock:
+            ranked = [row[0] for row in self.con.execute(query, [*ids, *ids, limit])]
+        if not ranked:
+            return pd.DataFrame()
+        routes = self.routes_by_id(ranked)
+        rank = pd.Series(np.arange(len(ranked)), index=ranked)
+        return routes.iloc[np.argsort(routes['id'].map(rank).to_numpy())]
+
+    def routes_in_bounds(self, routes, south, west, north, east):
+        """Keep the routes that lie inside a lat/lon bounding box."""
+        return routes[
+            routes['latitude'].between(south, north) & routes['longitude'].between(west, east)
+        ]
+
+    def search(self, routes, query, limit=SEARCH_LIMIT):
+        """Return the routes among `routes` whose names best match `query`, best first."""
+        if self._name_index is None:
+            with self.lock:
+                rows = self.con.execute(
+                    "SELECT id, name, name_en, name_searchable, COALESCE(popularity, 0) FROM problems ORDER BY id"
+                ).fetchall()
+            self._name_ids = np.array([row[0] for row in rows], dtype=np.int64)
+            self._name_index = NameIndex([row[1:4] for row in rows], [row[4] for row in rows])
+        positions = np.searchsorted(self._name_ids, routes['id'].to_numpy())
+        ranked = self._name_ids[self._name_index.search(query, positions, limit)]
+        rank = pd.Series(np.arange(len(ranked)), index=ranked)
+        return routes.iloc[np.argsort(routes['id'].map(rank).to_numpy(na_value=np.inf))[:len(ranked)]]
+
+    def clusters(self, routes, zoom):
+        """Cluster query results for a zoom level; see ClusterIndex.clusters."""
+        index = ClusterIndex(routes['latitude'], routes['longitude'], routes['grade_numeric'])
+        return index.clusters(np.arange(len(routes)), zoom)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add grade_numeric and the filter indexes to the route database.")
+    parser.add_argument("--db", default=ROUTE_DB)
+    args = parser.parse_args()
+    prepare_database(args.db)
@@ -0,0 +1,28 @@
+import shutil
+
+import pytest
+
+from data_loader import ROUTE_DB, prepare_routes, read_problems
+from route_store import RouteStore
+from sql_backend import SqlRouteStore, prepare_database
+
+
+@pytest.fixture(scope="session")
+def route_db(tmp_path_factory):
+    """Copy of boolder.db prepared by sql_backend.prepare_database(), so the working database is left untouched."""
+    db_path = tmp_path_factory.mktemp("routes") / "boolder.db"
+    shutil.copyfile(ROUTE_DB, db_path)
+    prepare_database(db_path)
+    return str(db_path)
+
+
+@pytest.fixture(scope="session")
+def memory_store(route_db):
+    return RouteStore(prepare_routes(read_problems(route_db)))
+
+
+@pytest.fixture(scope="session")
+def sql_store(route_db):
+    store = SqlRouteStore(route_db)
+    yield store
+    store.con.close()
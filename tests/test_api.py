@@ -0,0 +1,139 @@
+import gzip
+import json
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+import pytest
+import uvicorn
+
+import api
+from api import encode_cursor
+from grade_utils import GRADE_TO_NUMERIC
+from ui_components import apply_filters
+
+# Sidebar filter dicts paged through /problems, each with its query string
+ALL_GRADES = (0, max(GRADE_TO_NUMERIC.values()))
+FILTERS = [
+    ({'selected_grade_range': ALL_GRADES, 'selected_steepness': [], 'selected_areas': [],
+      'sit_start_option': "All", 'selected_popularity': None}, []),
+    ({'selected_grade_range': (GRADE_TO_NUMERIC['6a'], GRADE_TO_NUMERIC['7b+']),
+      'selected_steepness': ['wall', 'slab'], 'selected_areas': [],
+      'sit_start_option': "All", 'selected_popularity': (10, 2 ** 31)},
+     [('grade_min', '6a'), ('grade_max', '7b+'), ('steepness', 'wall'), ('steepness', 'slab'),
+      ('popularity_min', '10')]),
+    ({'selected_grade_range': ALL_GRADES, 'selected_steepness': [],
+      'selected_areas': ['Franchard Isatis', 'Cuvier Rempart'],
+      'sit_start_option': "Sit Start Only", 'selected_popularity': None},
+     [('area', 'Franchard Isatis'), ('area', 'Cuvier Rempart'), ('sit_start', 'sit')]),
+    ({'selected_grade_range': (20, 24), 'selected_steepness': [], 'selected_areas': [],
+      'sit_start_option': "Standing Start Only", 'selected_popularity': None},
+     [('grade_min', '20'), ('grade_max', '24'), ('sit_start', 'standing')]),
+]
+
+
+@pytest.fixture(scope="module")
+def base_url(memory_store):
+    """The API served by uvicorn on a free port, answering from the test copy of the route store."""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(api, 'get_route_store', lambda: memory_store)
+        patch.setattr(api, 'source_fingerprint', lambda: "test")
+        server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=0, log_level="warning"))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            time.sleep(0.01)
+        yield f"http://127.0.0.1:{server.servers[0].sockets[0].getsockname()[1]}"
+        server.should_exit = True
+        thread.join()
+
+
+def get(base_url, path, headers=None):
+    try:
+        with urlopen(Request(base_url + path, headers=headers or {})) as response:
+            return response.status, {k.lower(): v for k, v in response.headers.items()}, response.read()
+    except HTTPError as e:
+        return e.code, {k.lower(): v for k, v in e.headers.items()}, e.read()
+
+
+@pytest.mark.parametrize("filters, params", FILTERS)
+def test_cursor_pages_match_apply_filters(base_url, memory_store, filters, params):
+    expected = apply_filters(memory_store, {**filters, 'search_query': ''})['id'].tolist()
+    ids, cursor, pages = [], None, 0
+    while True:
+        status, _, body = get(base_url, '/problems?' + urlencode(params + [('limit', 700)] + (
+            [('cursor', cursor)] if cursor else [])))
+        assert status == 200
+        page = json.loads(body)
+        assert page['count'] == len(expected)
+        ids += [problem['id'] for problem in page['problems']]
+        pages += 1
+        if not (cursor := page['next_cursor']):
+            break
+    assert ids == expected
+    assert pages == max(1, -(-len(expected) // 700))
+
+
+def test_gzip_matches_plain_response(base_url):
+    status, headers, body = get(base_url, '/problems?limit=1000', {'Accept-Encoding': 'gzip'})
+    assert status == 200 and headers['content-encoding'] == 'gzip'
+    assert gzip.decompress(body) == get(base_url, '/problems?limit=1000')[2]
+
+
+def test_matching_etag_gets_304(base_url):
+    status, headers, _ = get(base_url, '/problems?grade_min=7a')
+    assert status == 200 and headers['etag'].startswith('W/')
+    status, revalidated, body = get(base_url, '/problems?grade_min=7a', {'If-None-Match': headers['etag']})
+    assert status == 304 and body == b'' and revalidated['etag'] == headers['etag']
+    assert get(base_url, '/problems?grade_min=7b', {'If-None-Match': headers['etag']})[0] == 200
+
+
+def test_cursor_from_older_dataset_gets_410(base_url, monkeypatch):
+    cursor = json.loads(get(base_url, '/problems?limit=10')[2])['next_cursor']
+    etag = get(base_url, '/problems?limit=10')[1]['etag']
+    monkeypatch.setattr(api, 'source_fingerprint', lambda: "edited")
+    assert get(base_url, f'/problems?limit=10&cursor={cursor}')[0] == 410
+    assert get(base_url, '/problems?limit=10', {'If-None-Match': etag})[0] == 200
+    assert get(base_url, f"/problems?cursor={encode_cursor('old', 100)}")[0] == 410
+
+
+@pytest.mark.parametrize("cursor", [
+    'NQ',  # base64 of the JSON 5
+    encode_cursor("test", -100),
+    'not a cursor',
+    encode_cursor("test", 'ten'),
+])
+def test_malformed_cursor_gets_400(base_url, cursor):
+    status, _, body = get(base_url, '/problems?' + urlencode({'cursor': cursor}))
+    assert status == 400 and json.loads(body)['error'] == "invalid cursor"
+
+
+@pytest.mark.parametrize("query", [
+    'grade_min=9z', 'limit=ten', 'sit_start=hanging', 'bbox=48.4,2.6', 'popularity_min=x',
+])
+def test_bad_parameters_get_400(base_url, query):
+    assert get(base_url, f'/problems?{query}')[0] == 400
+
+
+def test_unencoded_plus_in_grades(base_url):
+    unencoded = get(base_url, '/problems?grade_min=6a+&limit=1000')
+    assert unencoded[0] == 200
+    assert unencoded[2] == get(base_url, '/problems?grade_min=6a%2B&limit=1000')[2]
+
+
+def test_areas_cover_every_problem(base_url, memory_store):
+    status, _, body = get(base_url, '/areas')
+    assert status == 200
+    assert sum(area['problems'] for area in json.loads(body)) == len(memory_store)
+
+
+def test_media(base_url, memory_store):
+    data = memory_store.data
+    problem_id = int(data.loc[data['bleau_info_id'] == '', 'id'].iloc[0])
+    status, headers, body = get(base_url, f'/problems/{problem_id}/media')
+    assert status == 200
+    assert json.loads(body) == {'id': problem_id, 'bleau_info_id': '', 'video': None, 'image': None}
+    assert get(base_url, f'/problems/{problem_id}/media', {'If-None-Match': headers['etag']})[0] == 304
+    assert get(base_url, '/problems/999999999/media')[0] == 404
@@ -0,0 +1,63 @@
+import shutil
+import sqlite3
+
+import pytest
+from pyarrow import feather
+
+from data_loader import ROUTE_DB, build_snapshot, prepare_routes, read_problems, read_snapshot, source_fingerprint
+from sql_backend import prepare_database
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    """(snapshot path, database path) of a snapshot built from a copy of boolder.db."""
+    db_path = str(tmp_path / "boolder.db")
+    shutil.copyfile(ROUTE_DB, db_path)
+    path = str(tmp_path / "routes.arrow")
+    build_snapshot(path, db_path)
+    return path, db_path
+
+
+def write(db_path, statement):
+    con = sqlite3.connect(db_path)
+    with con:
+        con.execute(statement)
+    con.close()
+
+
+def test_snapshot_matches_sqlite_path(snapshot):
+    path, db_path = snapshot
+    routes = prepare_routes(read_problems(db_path))
+    loaded = read_snapshot(path, db_path)
+    assert loaded.equals(routes)
+    assert loaded.dtypes.equals(routes.dtypes)
+
+
+def test_missing_snapshot(tmp_path):
+    assert read_snapshot(str(tmp_path / "missing.arrow"), ROUTE_DB) is None
+
+
+def test_writes_to_other_tables_keep_the_snapshot(snapshot):
+    path, db_path = snapshot
+    write(db_path, "CREATE TABLE media_index (bleau_info_id TEXT PRIMARY KEY, indexed_at REAL)")
+    write(db_path, "INSERT INTO media_index VALUES ('1', 0)")
+    assert read_snapshot(path, db_path) is not None
+    # The new size and mtime are recorded, so the next load takes the cheap check
+    assert feather.read_table(path).schema.metadata[b'source'].decode() == source_fingerprint(db_path)
+
+
+def test_columns_the_app_does_not_read_keep_the_snapshot(snapshot):
+    path, db_path = snapshot
+    prepare_database(db_path)
+    assert read_snapshot(path, db_path) is not None
+
+
+@pytest.mark.parametrize("statement", [
+    "UPDATE problems SET grade = '9a' WHERE id = (SELECT MIN(id) FROM problems)",
+    "UPDATE areas SET name = name || ' (renamed)' WHERE id = (SELECT MIN(id) FROM areas)",
+    "DELETE FROM problems WHERE id = (SELECT MAX(id) FROM problems)",
+], ids=["grade edited", "area renamed", "problem deleted"])
+def test_edits_to_the_route_rows_make_the_snapshot_stale(snapshot, statement):
+    path, db_path = snapshot
+    write(db_path, statement)
+    assert read_snapshot(path, db_path) is None
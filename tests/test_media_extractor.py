@@ -0,0 +1,96 @@
+import pytest
+
+from media_extractor import extract_media, extract_media_soup
+from media_index import iter_mirror_pages
+
+# Mirror pages checked against the reference; the benchmark times all of them
+MIRROR_SAMPLE = 300
+
+VIDEO_JS = '<div class="video-js"><video><source src="{}"></video></div>'
+PHOTO = '<div class="boulder_photo">{}</div>'
+
+PAGES = {
+    'empty': '',
+    'no sections': '<html><body><p>Nothing here</p></body></html>',
+    'youtube after video.js': (
+        '<div class="boulder_mp4s">' + VIDEO_JS.format('/a.mp4')
+        + '<iframe src="https://www.youtube.com/embed/xyz"></iframe></div>'
+    ),
+    'youtu.be': '<div class="boulder_mp4s"><iframe src="https://youtu.be/xyz"></iframe></div>',
+    'other iframe': '<div class="boulder_mp4s"><iframe src="https://vimeo.com/1"></iframe></div>',
+    'unplayable first video.js': (
+        '<div class="boulder_mp4s">' + VIDEO_JS.format('/a.mov') + VIDEO_JS.format('/b.webm') + '</div>'
+    ),
+    'only first source counts': (
+        '<div class="boulder_mp4s"><div class="video-js"><video>'
+        '<source src="/a.avi"><source src="/b.mp4"></video></div></div>'
+    ),
+    'second video of a video.js div': (
+        '<div class="boulder_mp4s"><div class="video-js"><video><source src="/a.avi"></video>'
+        '<video><source src="/b.mp4"></video></div></div>'
+    ),
+    'bare video fallback': '<div class="boulder_mp4s"><video><source src="/clip.OGG"></video></div>',
+    'source without src': '<div class="boulder_mp4s"><video><source></video></div>',
+    'self-closing source': '<div class="boulder_mp4s"><video><source src="/a.mp4"/></video></div>',
+    'nested video.js divs': (
+        '<div class="boulder_mp4s"><div class="video-js"><div class="video-js">'
+        '<video><source src="/inner.mp4"></video></div></div></div>'
+    ),
+    'second mp4s section ignored': (
+        '<div class="boulder_mp4s"></div><div class="boulder_mp4s">' + VIDEO_JS.format('/a.mp4') + '</div>'
+    ),
+    'video outside the section': '<div>' + VIDEO_JS.format('/a.mp4') + '</div><div class="boulder_mp4s"></div>',
+    'fancybox image': (
+        '<div class="boulder_photos">'
+        + PHOTO.format('<img src="/thumb.jpg"><a class="fancybox" href="#"><img src="/full.jpg"></a>') + '</div>'
+    ),
+    'fancybox without image': (
+        '<div class="boulder_photos">'
+        + PHOTO.format('<a class="fancybox" href="#">photo</a><img src="https://cdn.example/p.jpg">') + '</div>'
+    ),
+    'image in a second fancybox link': (
+        '<div class="boulder_photos">'
+        + PHOTO.format('<a class="fancybox"></a><a class="fancybox"><img src="/b.jpg"></a>') + '</div>'
+    ),
+    'only first photo counts': (
+        '<div class="boulder_photos">' + PHOTO.format('<span></span>') + PHOTO.format('<img src="/b.jpg">') + '</div>'
+    ),
+    'relative image src': '<div class="boulder_photos">' + PHOTO.format('<img src="img/p.jpg">') + '</div>',
+    'self-closing img': '<div class="boulder_photos">' + PHOTO.format('<img src="/p.jpg"/>') + '</div>',
+    'photos before videos': (
+        '<div class="boulder_photos">' + PHOTO.format('<img src="/p.jpg">') + '</div>'
+        '<div class="boulder_mp4s">' + VIDEO_JS.format('/a.mp4') + '</div>'
+    ),
+    'stray and unclosed tags': (
+        '<div class="boulder_mp4s"></span><div class="video-js"><video><source src="/a.mp4">'
+        '</div></div><div class="boulder_photos"><div class="boulder_photo"><p><img src="/p.jpg"></div>'
+    ),
+    'marker in text before the section': (
+        '<p>See boulder_photos below</p><div class="boulder_photos">' + PHOTO.format('<img src="/p.jpg">') + '</div>'
+    ),
+    'character references': (
+        '<div class="boulder_photos">' + PHOTO.format('<img src="/p.jpg?a=1&amp;b=2">') + '</div>'
+    ),
+}
+
+
+@pytest.mark.parametrize("html", PAGES.values(), ids=PAGES.keys())
+def test_matches_reference(html):
+    assert extract_media(html) == extract_media_soup(html)
+
+
+def test_bytes_are_decoded_like_the_reference():
+    html = '<div class="boulder_photos"><div class="boulder_photo"><img src="/caf\xe9.jpg"></div></div>'
+    for encoding in ('utf-8', 'cp1252'):
+        content = html.encode(encoding)
+        assert extract_media(content) == extract_media_soup(content)
+
+
+def test_matches_reference_on_mirror_pages():
+    pages = list(iter_mirror_pages())[:MIRROR_SAMPLE]
+    if not pages:
+        pytest.skip("no mirrored pages")
+    for _, _, path in pages:
+        with open(path, 'rb') as f:
+            content = f.read()
+        assert extract_media(content) == extract_media_soup(content), path
@@ -0,0 +1,148 @@
+import os
+import shutil
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, urlparse
+
+import pytest
+
+import media_fetcher
+from media_index import lookup_media_many
+from mirror_refresh import problem_pages, read_manifest, refresh_mirror
+
+# Mirrored pages the stand-in serves
+PAGE_COUNT = 40
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """bleau.info stand-in answering conditional GETs from the `pages` {path: (content, etag)} of its server."""
+
+    def do_GET(self):
+        pages, seen = self.server.pages, self.server.seen
+        if self.path not in pages:
+            seen.append((self.path, 404))
+            self.send_response(404)
+            self.end_headers()
+            return
+        content, etag = pages[self.path]
+        if self.headers.get('If-None-Match') == etag:
+            seen.append((self.path, 304))
+            self.send_response(304)
+            self.end_headers()
+            return
+        seen.append((self.path, 200))
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def mirror(tmp_path, monkeypatch):
+    """A copy of PAGE_COUNT mirrored pages with their HTTrack index, and a stand-in server for them.
+
+    On the server, every tenth page has been edited, every tenth but one
+    only got a new ETag, and the last page is gone.
+    """
+    records = sorted(problem_pages().items())[:PAGE_COUNT]
+    if len(records) < PAGE_COUNT:
+        pytest.skip("not enough mirrored pages")
+    edited = {bleau_info_id for bleau_info_id, _ in records[::10]}
+    retagged = {bleau_info_id for bleau_info_id, _ in records[1::10]}
+    removed = records[-1][0]
+
+    pages, hts_lines = {}, []
+    for bleau_info_id, record in records:
+        url_path = urlparse(record['url']).path
+        local = tmp_path / "bleau.info" / url_path.lstrip('/')
+        local.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(record['path'], local)
+        content, etag = local.read_bytes(), record['etag']
+        if bleau_info_id in edited:
+            content, etag = content.replace(b"</body>", b"<!-- edited --></body>"), f'W/"edited-{bleau_info_id}"'
+        elif bleau_info_id in retagged:
+            etag = f'W/"retagged-{bleau_info_id}"'
+        if bleau_info_id != removed:
+            pages[url_path] = (content, etag)
+        hts_lines.append("\t".join([
+            "00:00:00", "0/0", "------", "200", "added ('OK')", "text/html",
+            f"etag:{quote(record['etag'] or '')}", record['url'], f"./bleau.info{url_path}", "(from )",
+        ]))
+    (tmp_path / "hts-cache").mkdir()
+    hts_index = tmp_path / "hts-cache" / "new.txt"
+    hts_index.write_text("header\n" + "\n".join(hts_lines) + "\n")
+    route_db = str(tmp_path / "routes.db")
+    con = sqlite3.connect(route_db)
+    with con:
+        con.execute("CREATE TABLE problems (bleau_info_id TEXT)")
+        con.executemany("INSERT INTO problems VALUES (?)", [(bleau_info_id,) for bleau_info_id, _ in records])
+    con.close()
+
+    # The stand-in is local, so lift the per-host politeness limit
+    monkeypatch.setattr(media_fetcher, 'MEDIA_REQUESTS_PER_SECOND', 0)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.pages, server.seen = pages, []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    manifest = str(tmp_path / "hts-cache" / "refresh.json")
+    index_db = str(tmp_path / "media_index.db")
+
+    def refresh(limit=None):
+        return refresh_mirror(
+            f"http://127.0.0.1:{server.server_port}", index_db, str(tmp_path / "bleau.info"), str(hts_index),
+            manifest, limit=limit, route_db=route_db,
+        )
+
+    def modified():
+        return {
+            bleau_info_id: os.path.getmtime(tmp_path / "bleau.info" / urlparse(record['url']).path.lstrip('/'))
+            for bleau_info_id, record in records
+        }
+
+    yield {
+        'refresh': refresh, 'modified': modified, 'seen': server.seen, 'manifest': manifest, 'index_db': index_db,
+        'ids': [bleau_info_id for bleau_info_id, _ in records], 'edited': edited, 'retagged': retagged,
+    }
+    server.shutdown()
+    server.server_close()
+
+
+def test_cut_short_run_is_resumed(mirror):
+    half = PAGE_COUNT // 2
+    partial = mirror['refresh'](half)
+    assert read_manifest(mirror['manifest'])['finished_at'] is None
+    resumed = mirror['refresh']()
+    assert resumed['skipped'] == half
+    assert read_manifest(mirror['manifest'])['finished_at'] is not None
+
+    totals = {key: partial[key] + resumed[key] for key in ('changed', 'unchanged', 'gone', 'failed')}
+    assert totals == {
+        'changed': len(mirror['edited']), 'unchanged': PAGE_COUNT - len(mirror['edited']) - 1, 'gone': 1, 'failed': 0,
+    }
+    # Each page was asked for once across both runs
+    assert len(mirror['seen']) == PAGE_COUNT
+
+
+def test_only_edited_pages_are_rewritten_and_reindexed(mirror):
+    before = mirror['modified']()
+    mirror['refresh']()
+    after = mirror['modified']()
+    rewritten = {bleau_info_id for bleau_info_id in before if after[bleau_info_id] != before[bleau_info_id]}
+    assert rewritten == mirror['edited']
+    assert mirror['edited'] <= lookup_media_many(mirror['ids'], mirror['index_db']).keys()
+
+
+def test_second_refresh_only_gets_304(mirror):
+    mirror['refresh']()
+    full = sum(status == 200 for _, status in mirror['seen'])
+    assert full == len(mirror['edited']) + len(mirror['retagged'])
+    del mirror['seen'][:]
+
+    again = mirror['refresh']()
+    assert again['changed'] == 0 and again['unchanged'] == PAGE_COUNT - 1 and again['gone'] == 1
+    # Pages that came back with new validators are revalidated with those
+    assert sorted(status for _, status in mirror['seen']) == [304] * (PAGE_COUNT - 1) + [404]
@@ -0,0 +1,87 @@
+import random
+
+import numpy as np
+import pytest
+
+FILTER_COUNT = 40
+
+
+def filter_combinations(data, count=FILTER_COUNT, seed=0):
+    rng = random.Random(seed)
+    steepness = sorted(data['steepness'].dropna().unique())
+    areas = sorted(data['area_name'].dropna().unique())
+    max_popularity = int(data['popularity'].max())
+    combinations = [{
+        'selected_grade_range': (0, 34),
+        'selected_steepness': [],
+        'selected_areas': [],
+        'sit_start_option': "All",
+        'selected_popularity': None,
+    }]
+    while len(combinations) < count:
+        low = rng.randint(0, 30)
+        combinations.append({
+            'selected_grade_range': (low, rng.randint(low, 34)),
+            'selected_steepness': rng.sample(steepness, rng.randint(0, len(steepness))),
+            'selected_areas': rng.sample(areas, rng.choice([0, 1, 1, 2, 5])),
+            'sit_start_option': rng.choice(["All", "Sit Start Only", "Standing Start Only"]),
+            'selected_popularity': rng.choice([None, (0, max_popularity), (10, max_popularity), (3, 40)]),
+        })
+    return combinations
+
+
+@pytest.fixture(scope="module")
+def combinations(memory_store):
+    return filter_combinations(memory_store.data)
+
+
+def test_apply_filters_matches_memory(memory_store, sql_store, combinations):
+    for filters in combinations:
+        if filters['selected_popularity'] is None:
+            continue
+        expected = memory_store.apply_filters(filters).reset_index(drop=True).astype(object)
+        assert expected.equals(sql_store.apply_filters(filters).astype(object)), filters
+
+
+def test_facet_counts_match_memory(memory_store, sql_store, combinations):
+    for filters in combinations:
+        expected = memory_store.facet_counts(filters)
+        result = sql_store.facet_counts(filters)
+        assert result.keys() == expected.keys()
+        for key in ('total', 'areas', 'steepness', 'sit_start'):
+            assert result[key] == expected[key], (key, filters)
+        np.testing.assert_array_equal(result['grades'], expected['grades'])
+
+
+def test_facet_summary_matches_memory(memory_store, sql_store, combinations):
+    for filters in combinations:
+        expected = memory_store.facet_summary(filters)
+        result = sql_store.facet_summary(filters)
+        assert result['count'] == expected['count']
+        assert result['areas'] == expected['areas']
+        for key in ('mean_grade', 'mean_popularity'):
+            assert result[key] == pytest.approx(expected[key]), (key, filters)
+
+
+@pytest.mark.parametrize("query", ["la marie", "Rose", "abbatoir", "dalle", "zz"])
+def test_search_matches_memory(memory_store, sql_store, combinations, query):
+    for filters in combinations[:10]:
+        if filters['selected_popularity'] is None:
+            continue
+        routes = memory_store.apply_filters(filters)
+        expected = memory_store.search(routes, query)['id'].tolist()
+        assert sql_store.search(sql_store.apply_filters(filters), query)['id'].tolist() == expected
+
+
+def test_similar_routes_match_memory(memory_store, sql_store):
+    rng = random.Random(0)
+    listed = sorted(memory_store.data['bleau_info_id'].dropna().loc[lambda ids: ids != ''].unique())
+    for size in (1, 1, 2, 3, 5, 8):
+        projects = rng.sample(listed, size)
+        expected = memory_store.similar_routes(projects)['id'].tolist()
+        assert sql_store.similar_routes(projects)['id'].tolist() == expected, projects
+
+
+def test_similar_routes_without_projects(sql_store):
+    assert sql_store.similar_routes([]).empty
+    assert sql_store.similar_routes(['no-such-problem']).empty
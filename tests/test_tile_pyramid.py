@@ -0,0 +1,94 @@
+import gzip
+import json
+import sqlite3
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+from cluster_index import TILE_SIZE, world_coordinates
+from tile_pyramid import (
+    COORDINATE_DECIMALS,
+    SIMPLIFY_PIXELS,
+    TILE_MAX_ZOOM,
+    TILE_MIN_ZOOM,
+    TRAILS_GEOJSON,
+    build_tile_pyramid,
+)
+
+
+@pytest.fixture(scope="module")
+def tile_db(tmp_path_factory, route_db):
+    db_path = str(tmp_path_factory.mktemp("tiles") / "tiles.mbtiles")
+    build_tile_pyramid(db_path, route_db)
+    return db_path
+
+
+@pytest.fixture(scope="module")
+def trails():
+    """World coordinates of every trail in trails.geojson."""
+    with open(TRAILS_GEOJSON) as f:
+        features = json.load(f)['features']
+    lines = []
+    for feature in features:
+        if feature['geometry']['type'] == 'LineString':
+            lon, lat = np.array(feature['geometry']['coordinates'], dtype=np.float64).T
+            lines.append(np.column_stack(world_coordinates(lat, lon)))
+    return lines
+
+
+def trail_segments(tile_db, zoom):
+    """Trail segments of every tile at a zoom, in world coordinates, keyed by XYZ tile."""
+    n = 2 ** zoom
+    con = sqlite3.connect(tile_db)
+    try:
+        rows = con.execute(
+            "SELECT tile_column, tile_row, tile_data FROM tiles WHERE zoom_level = ?", (zoom,)
+        ).fetchall()
+    finally:
+        con.close()
+    segments = defaultdict(list)
+    for tx, tms_row, tile_data in rows:
+        for feature in json.loads(gzip.decompress(tile_data))['features']:
+            if feature['properties']['layer'] != 'trails':
+                continue
+            geometry = feature['geometry']
+            parts = [geometry['coordinates']] if geometry['type'] == 'LineString' else geometry['coordinates']
+            for part in parts:
+                lon, lat = np.array(part, dtype=np.float64).T
+                points = np.column_stack(world_coordinates(lat, lon))
+                segments[(tx, n - 1 - tms_row)].append(np.stack([points[:-1], points[1:]], axis=1))
+    return {tile: np.concatenate(parts) for tile, parts in segments.items()}
+
+
+def distances_to_segments(points, segments):
+    """Distance from each point to the nearest of the segments."""
+    start, stop = segments[:, 0], segments[:, 1]
+    direction = stop - start
+    length = np.maximum(np.einsum('ij,ij->i', direction, direction), 1e-30)
+    offset = points[:, None, :] - start[None, :, :]
+    t = np.clip(np.einsum('pij,ij->pi', offset, direction) / length, 0, 1)
+    nearest = start[None] + t[..., None] * direction[None]
+    return np.hypot(*(points[:, None, :] - nearest).transpose(2, 0, 1)).min(axis=1)
+
+
+@pytest.mark.parametrize("zoom", range(TILE_MIN_ZOOM, TILE_MAX_ZOOM + 1))
+def test_trails_are_tiled_within_tolerance(tile_db, trails, zoom):
+    n = 2 ** zoom
+    pixels = TILE_SIZE * n
+    segments = trail_segments(tile_db, zoom)
+    points = np.concatenate(trails)
+    tiles = np.floor(points * n).astype(np.int64)
+    assert {tuple(tile) for tile in tiles} <= segments.keys()
+
+    # Rounding the coordinates moves a vertex by at most half a unit of the last decimal in each axis
+    rounding = 10 ** -COORDINATE_DECIMALS / 360 * pixels * 2
+    worst = 0.0
+    for tile in {tuple(tile) for tile in tiles}:
+        nearby = [
+            segments[(tile[0] + dx, tile[1] + dy)]
+            for dx in (-1, 0, 1) for dy in (-1, 0, 1) if (tile[0] + dx, tile[1] + dy) in segments
+        ]
+        in_tile = points[(tiles == tile).all(axis=1)]
+        worst = max(worst, distances_to_segments(in_tile, np.concatenate(nearby)).max() * pixels)
+    assert worst <= SIMPLIFY_PIXELS + rounding
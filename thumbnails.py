@@ -0,0 +1,256 @@
+import argparse
+import hashlib
+import io
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import unquote, urlparse
+
+import streamlit as st
+from PIL import Image, ImageOps, features
+
+from media_cache import MEDIA_CACHE_DB
+from media_fetcher import fetch_url
+from media_index import MEDIA_INDEX_DB, MIRROR_DIR
+from metrics import increment, span
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_DIR = "thumbnails"
+
+# Bounding box of each rendition; both are made from a single download
+THUMBNAIL_SIZES = {'table': (160, 120), 'popup': (320, 240)}
+
+THUMBNAIL_FORMAT = 'WEBP' if features.check('webp') else 'JPEG'
+THUMBNAIL_EXTENSION = THUMBNAIL_FORMAT.lower().replace('jpeg', 'jpg')
+THUMBNAIL_CONTENT_TYPE = f"image/{THUMBNAIL_FORMAT.lower()}"
+THUMBNAIL_QUALITY = 70
+
+# Background downloads: worker threads, and how many images may wait for one
+THUMBNAIL_WORKERS = 4
+THUMBNAIL_QUEUE_LIMIT = 256
+
+# Images that could not be fetched or decoded are retried after this long
+THUMBNAIL_RETRY_AFTER = 24 * 3600
+
+# Source images larger than this are not downloaded: refused on their Content-Length, or cut
+# off once that many bytes have arrived when the server does not send one
+THUMBNAIL_MAX_SOURCE_BYTES = 20 * 1024 * 1024
+THUMBNAIL_CHUNK_BYTES = 64 * 1024
+
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def _connect(db_path):
+    con = sqlite3.connect(db_path)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS thumbnails (
+          source_url TEXT NOT NULL,
+          size TEXT NOT NULL,
+          digest TEXT,
+          created_at REAL NOT NULL,
+          PRIMARY KEY (source_url, size)
+        )
+    """)
+    return con
+
+
+def read_source(url, mirror_dir=MIRROR_DIR):
+    """Return the bytes of a source image, from the local mirror when it has a copy.
+
+    Raises OSError for bleau.info paths that resolve outside the mirror and
+    for images over THUMBNAIL_MAX_SOURCE_BYTES.
+    """
+    parsed = urlparse(url)
+    if parsed.netloc == 'bleau.info':
+        root = os.path.realpath(mirror_dir)
+        path = os.path.realpath(os.path.join(root, unquote(parsed.path).lstrip('/')))
+        if os.path.commonpath([root, path]) != root:
+            raise OSError(f"{url} resolves outside the mirror")
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                return f.read()
+    with fetch_url(url, stream=True) as response:
+        if response.status_code != 200:
+            raise OSError(f"HTTP {response.status_code}")
+        length = response.headers.get('Content-Length', '')
+        if length.isdigit() and int(length) > THUMBNAIL_MAX_SOURCE_BYTES:
+            raise OSError(f"image too large ({length} bytes)")
+        content = bytearray()
+        for chunk in response.iter_content(THUMBNAIL_CHUNK_BYTES):
+            content += chunk
+            if len(content) > THUMBNAIL_MAX_SOURCE_BYTES:
+                raise OSError(f"image too large (over {THUMBNAIL_MAX_SOURCE_BYTES} bytes)")
+    return bytes(content)
+
+
+def make_thumbnail(content, size):
+    """Shrink an encoded image to fit `size` and re-encode it as THUMBNAIL_FORMAT."""
+    with Image.open(io.BytesIO(content)) as image:
+        # Let the JPEG decoder downscale by a power of two while decoding
+        image.draft('RGB', (size[0] * 2, size[1] * 2))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        image.thumbnail(size, Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+    return out.getvalue()
+
+
+def thumbnail_path(digest, directory=THUMBNAIL_DIR):
+    return os.path.join(directory, digest[:2], f"{digest}.{THUMBNAIL_EXTENSION}")
+
+
+def store_blob(data, directory=THUMBNAIL_DIR):
+    """Write a thumbnail under its SHA-256 digest, once, and return the digest."""
+    digest = hashlib.sha256(data).hexdigest()
+    path = thumbnail_path(digest, directory)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+    return digest
+
+
+def build_thumbnails(url, directory=THUMBNAIL_DIR, db_path=MEDIA_CACHE_DB, mirror_dir=MIRROR_DIR):
+    """Download an image once and store every THUMBNAIL_SIZES rendition of it.
+
+    Returns {size: digest}, or None if the image could not be fetched or
+    decoded; the failure is recorded so it is not retried for a while.
+    """
+    try:
+        with span("thumbnail_build"):
+            content = read_source(url, mirror_dir)
+            digests = {size: store_blob(make_thumbnail(content, box), directory) for size, box in THUMBNAIL_SIZES.items()}
+        increment("thumbnails_built_total", result="ok")
+    except Exception as e:
+        logger.info("No thumbnail for %s: %s", url, e)
+        increment("thumbnails_built_total", result="failed")
+        digests = None
+
+    now = time.time()
+    rows = [(url, size, (digests or {}).get(size), now) for size in THUMBNAIL_SIZES]
+    try:
+        con = _connect(db_path)
+        try:
+            with con:
+                con.executemany("INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?)", rows)
+        finally:
+            con.close()
+    except sqlite3.Error as e:
+        logger.warning("Could not record thumbnails for %s: %s", url, e)
+    return digests
+
+
+class ThumbnailPipeline:
+    """Looks up cached thumbnails and builds missing ones on a bounded background pool.
+
+    lookup() never waits for a download: images without a thumbnail yet
+    are queued (at most THUMBNAIL_QUEUE_LIMIT at a time) and show up on a
+    later call once built.
+    """
+
+    def __init__(self, directory=THUMBNAIL_DIR, db_path=MEDIA_CACHE_DB, workers=THUMBNAIL_WORKERS,
+                 mirror_dir=MIRROR_DIR):
+        self.directory = directory
+        self.db_path = db_path
+        self.mirror_dir = mirror_dir
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnails")
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def _known(self, urls, size):
+        """{url: digest or None} for the urls with a recorded attempt that should not be retried yet."""
+        known = {}
+        try:
+            con = _connect(self.db_path)
+        except sqlite3.Error:
+            return known
+        try:
+            retry_before = time.time() - THUMBNAIL_RETRY_AFTER
+            for i in range(0, len(urls), 500):
+                chunk = urls[i:i + 500]
+                query = (
+                    "SELECT source_url, digest, created_at FROM thumbnails "
+                    f"WHERE size = ? AND source_url IN ({','.join('?' * len(chunk))})"
+                )
+                for url, digest, created_at in con.execute(query, [size, *chunk]):
+                    if digest and os.path.exists(thumbnail_path(digest, self.directory)):
+                        known[url] = digest
+                    elif not digest and created_at >= retry_before:
+                        known[url] = None
+        except sqlite3.Error as e:
+            logger.warning("Could not read thumbnails: %s", e)
+        finally:
+            con.close()
+        return known
+
+    def lookup(self, urls, size='table'):
+        """Return {url: digest} for the urls whose thumbnail is ready, queueing the others."""
+        urls = list({url for url in urls if url})
+        known = self._known(urls, size)
+        ready = {url: digest for url, digest in known.items() if digest}
+        increment("thumbnail_lookups_total", len(ready), result="hit")
+        increment("thumbnail_lookups_total", len(urls) - len(ready), result="miss")
+        for url in urls:
+            if url not in known:
+                self.submit(url)
+        return ready
+
+    def submit(self, url):
+        with self.lock:
+            if url in self.pending or len(self.pending) >= THUMBNAIL_QUEUE_LIMIT:
+                return
+            self.pending[url] = self.executor.submit(self._build, url)
+
+    def _build(self, url):
+        try:
+            return build_thumbnails(url, self.directory, self.db_path, self.mirror_dir)
+        finally:
+            with self.lock:
+                self.pending.pop(url, None)
+
+    def drain(self, timeout=None):
+        """Wait for the queued thumbnails to be built."""
+        with self.lock:
+            futures = list(self.pending.values())
+        wait(futures, timeout=timeout)
+
+
+@st.cache_resource
+def get_thumbnail_pipeline():
+    """Create the thumbnail pipeline once per process."""
+    return ThumbnailPipeline()
+
+
+def _known_image_urls(media_db=MEDIA_INDEX_DB, cache_db=MEDIA_CACHE_DB):
+    urls = set()
+    for db_path, table in ((media_db, 'media_index'), (cache_db, 'media_cache')):
+        try:
+            con = sqlite3.connect(db_path)
+            try:
+                urls.update(row[0] for row in con.execute(f"SELECT image_url FROM {table} WHERE image_url IS NOT NULL"))
+            finally:
+                con.close()
+        except sqlite3.Error:
+            continue
+    return sorted(urls)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Build thumbnails for every image in the media index and cache.")
+    parser.add_argument("--limit", type=int, default=0, help="Only the first N images")
+    args = parser.parse_args()
+    urls = _known_image_urls()[:args.limit or None]
+    pipeline = ThumbnailPipeline()
+    ready = pipeline.lookup(urls)
+    while pipeline.pending:
+        pipeline.drain()
+        ready = pipeline.lookup(urls)
+    logger.info("%d of %d images have thumbnails in %s", len(ready), len(urls), THUMBNAIL_DIR)
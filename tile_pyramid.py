@@ -0,0 +1,264 @@
+import argparse
+import gzip
+import json
+import logging
+import math
+import os
+import sqlite3
+from collections import defaultdict
+
+import numpy as np
+
+from cluster_index import TILE_SIZE, world_coordinates
+
+logger = logging.getLogger(__name__)
+
+TILE_DB = "tiles.mbtiles"
+TRAILS_GEOJSON = "trails.geojson"
+AREAS_GEOJSON = "areas.geojson"
+ROUTE_DB = "boolder.db"
+
+TILE_MIN_ZOOM = 10
+TILE_MAX_ZOOM = 16
+
+# Problem points are only tiled from this zoom on; below it the map shows clusters
+PROBLEM_MIN_ZOOM = 15
+
+# Douglas-Peucker tolerance in screen pixels at each tile's zoom level
+SIMPLIFY_PIXELS = 1.0
+
+# Coordinates are rounded to this many decimals (about 10 cm)
+COORDINATE_DECIMALS = 6
+
+
+def to_lonlat(x, y):
+    """Inverse of cluster_index.world_coordinates."""
+    lon = np.asarray(x) * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * np.asarray(y)))))
+    return lon, lat
+
+
+def simplify(x, y, tolerance):
+    """Douglas-Peucker simplification; returns a mask of the points to keep."""
+    keep = np.zeros(len(x), dtype=bool)
+    if len(x) == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    stack = [(0, len(x) - 1)]
+    while stack:
+        start, stop = stack.pop()
+        if stop - start < 2:
+            continue
+        dx, dy = x[stop] - x[start], y[stop] - y[start]
+        px, py = x[start + 1:stop] - x[start], y[start + 1:stop] - y[start]
+        length = math.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(px * dy - py * dx) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, stop))
+    return keep
+
+
+def _read_line_features():
+    """(layer, properties, x, y) for every trail and area boundary, in world coordinates."""
+    features = []
+    with open(TRAILS_GEOJSON) as f:
+        for feature in json.load(f)['features']:
+            if feature['geometry']['type'] == 'LineString':
+                lon, lat = np.array(feature['geometry']['coordinates'], dtype=np.float64).T
+                properties = {'name': feature['properties'].get('name'), 'color': feature['properties'].get('color')}
+                features.append(('trails', properties, *world_coordinates(lat, lon)))
+    with open(AREAS_GEOJSON) as f:
+        for feature in json.load(f)['features']:
+            if feature['geometry']['type'] == 'Polygon':
+                properties = {'name': feature['properties'].get('name'), 'area_id': feature['properties'].get('areaId')}
+                for ring in feature['geometry']['coordinates']:
+                    lon, lat = np.array(ring, dtype=np.float64).T
+                    features.append(('areas', properties, *world_coordinates(lat, lon)))
+    return features
+
+
+def _read_point_features(route_db):
+    """(layer, properties, x, y) for area labels and problem points, in world coordinates."""
+    features = []
+    with open(AREAS_GEOJSON) as f:
+        for feature in json.load(f)['features']:
+            if feature['geometry']['type'] == 'Point':
+                lon, lat = feature['geometry']['coordinates']
+                properties = {'name': feature['properties'].get('name'), 'area_id': feature['properties'].get('areaId')}
+                features.append(('area_labels', properties, *world_coordinates([lat], [lon])))
+
+    con = sqlite3.connect(route_db)
+    try:
+        rows = con.execute("SELECT id, name, TRIM(grade), latitude, longitude FROM problems").fetchall()
+    finally:
+        con.close()
+    if rows:
+        x, y = world_coordinates([row[3] for row in rows], [row[4] for row in rows])
+        for row, px, py in zip(rows, x, y):
+            features.append(('problems', {'id': row[0], 'name': row[1], 'grade': row[2]}, np.array([px]), np.array([py])))
+    return features
+
+
+def _lonlat_list(x, y):
+    lon, lat = to_lonlat(x, y)
+    return np.round(np.column_stack([lon, lat]), COORDINATE_DECIMALS).tolist()
+
+
+def _line_tiles(x, y, zoom):
+    """Split a simplified line into the runs of segments that touch each tile."""
+    n = 2 ** zoom
+    segments = defaultdict(list)
+    for i in range(len(x) - 1):
+        tx0, tx1 = sorted((int(x[i] * n), int(x[i + 1] * n)))
+        ty0, ty1 = sorted((int(y[i] * n), int(y[i + 1] * n)))
+        for tx in range(tx0, tx1 + 1):
+            for ty in range(ty0, ty1 + 1):
+                segments[(tx, ty)].append(i)
+
+    for tile, indexes in segments.items():
+        runs, run = [], [indexes[0]]
+        for i in indexes[1:]:
+            if i != run[-1] + 1:
+                runs.append(run)
+                run = []
+            run.append(i)
+        runs.append(run)
+        yield tile, [_lonlat_list(x[run[0]:run[-1] + 2], y[run[0]:run[-1] + 2]) for run in runs]
+
+
+def build_tile_pyramid(db_path=TILE_DB, route_db=ROUTE_DB, min_zoom=TILE_MIN_ZOOM, max_zoom=TILE_MAX_ZOOM):
+    """Tile trails, area boundaries and problem points into an MBTiles file.
+
+    Every tile is a gzipped GeoJSON FeatureCollection whose features carry
+    a 'layer' property (trails, areas, area_labels or problems). Lines are
+    simplified with Douglas-Peucker to SIMPLIFY_PIXELS at each zoom level
+    and cut into the runs of segments that cross the tile.
+    """
+    lines = _read_line_features()
+    points = _read_point_features(route_db)
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    con = sqlite3.connect(db_path)
+    try:
+        with con:
+            con.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+            con.execute(
+                "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+            )
+            con.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+
+            all_x = np.concatenate([feature[2] for feature in lines + points])
+            all_y = np.concatenate([feature[3] for feature in lines + points])
+            west, north = to_lonlat(all_x.min(), all_y.min())
+            east, south = to_lonlat(all_x.max(), all_y.max())
+            con.executemany("INSERT INTO metadata VALUES (?, ?)", [
+                ('name', 'bleau-route-finder'),
+                ('format', 'geojson'),
+                ('minzoom', str(min_zoom)),
+                ('maxzoom', str(max_zoom)),
+                ('bounds', f"{west:.6f},{south:.6f},{east:.6f},{north:.6f}"),
+            ])
+
+            tile_count = 0
+            for zoom in range(min_zoom, max_zoom + 1):
+                n = 2 ** zoom
+                tolerance = SIMPLIFY_PIXELS / (TILE_SIZE * n)
+                tiles = defaultdict(list)
+                for layer, properties, x, y in lines:
+                    keep = simplify(x, y, tolerance)
+                    for tile, parts in _line_tiles(x[keep], y[keep], zoom):
+                        geometry = (
+                            {'type': 'LineString', 'coordinates': parts[0]} if len(parts) == 1
+                            else {'type': 'MultiLineString', 'coordinates': parts}
+                        )
+                        tiles[tile].append({
+                            'type': 'Feature', 'geometry': geometry, 'properties': {'layer': layer, **properties},
+                        })
+                for layer, properties, x, y in points:
+                    if layer == 'problems' and zoom < PROBLEM_MIN_ZOOM:
+                        continue
+                    tiles[(int(x[0] * n), int(y[0] * n))].append({
+                        'type': 'Feature',
+                        'geometry': {'type': 'Point', 'coordinates': _lonlat_list(x, y)[0]},
+                        'properties': {'layer': layer, **properties},
+                    })
+
+                con.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)", [
+                    # MBTiles rows count from the south (TMS scheme)
+                    (zoom, tx, n - 1 - ty, gzip.compress(json.dumps({
+                        'type': 'FeatureCollection', 'features': features,
+                    }, separators=(',', ':')).encode('utf-8')))
+                    for (tx, ty), features in tiles.items()
+                ])
+                tile_count += len(tiles)
+    finally:
+        con.close()
+    logger.info("Wrote %d tiles for zoom %d-%d to %s", tile_count, min_zoom, max_zoom, db_path)
+
+
+def tile_range(south, west, north, east, zoom):
+    """XYZ tile columns and rows covering a lat/lon bounding box."""
+    n = 2 ** zoom
+    x, y = world_coordinates([north, south], [west, east])
+    x = np.clip((x * n).astype(np.int64), 0, n - 1)
+    y = np.clip((y * n).astype(np.int64), 0, n - 1)
+    return (int(x[0]), int(x[1])), (int(y[0]), int(y[1]))
+
+
+def read_tiles(south, west, north, east, zoom, layers=None, db_path=TILE_DB):
+    """Merge the tiles covering a bounding box into one GeoJSON FeatureCollection.
+
+    The zoom is clamped to the pyramid's levels, so deeper zooms reuse the
+    most detailed tiles. Only features whose 'layer' is in `layers` are
+    kept, if given.
+    """
+    zoom = min(max(int(round(zoom)), TILE_MIN_ZOOM), TILE_MAX_ZOOM)
+    (x0, x1), (y0, y1) = tile_range(south, west, north, east, zoom)
+    n = 2 ** zoom
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        rows = con.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? "
+            "AND tile_row BETWEEN ? AND ?",
+            (zoom, x0, x1, n - 1 - y1, n - 1 - y0),
+        ).fetchall()
+    finally:
+        con.close()
+
+    features = []
+    for (tile_data,) in rows:
+        for feature in json.loads(gzip.decompress(tile_data))['features']:
+            if layers is None or feature['properties']['layer'] in layers:
+                features.append(feature)
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def read_bounds(db_path=TILE_DB):
+    """The (south, west, north, east) extent stored in the MBTiles metadata."""
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        west, south, east, north = map(float, con.execute(
+            "SELECT value FROM metadata WHERE name = 'bounds'"
+        ).fetchone()[0].split(','))
+    finally:
+        con.close()
+    return south, west, north, east
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Build the MBTiles tile pyramid for trails, areas and problems.")
+    parser.add_argument("--out", default=TILE_DB)
+    parser.add_argument("--db", default=ROUTE_DB)
+    parser.add_argument("--min-zoom", type=int, default=TILE_MIN_ZOOM)
+    parser.add_argument("--max-zoom", type=int, default=TILE_MAX_ZOOM)
+    args = parser.parse_args()
+    build_tile_pyramid(args.out, args.db, args.min_zoom, args.max_zoom)
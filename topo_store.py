@@ -0,0 +1,148 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+from urllib.parse import quote
+
+import numpy as np
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+TOPO_DB = "boolder.db"
+TOPO_STORE_DIR = "topo_lines"
+
+# Arrays written by build_topo_store, one .npy file each
+TOPO_ARRAYS = ('line_ids', 'topo_ids', 'problem_start', 'offsets', 'coordinates')
+
+TOPO_LINE_COLOR = "#e74c3c"
+
+# URL of the Boolder topo photo lines were traced on, with {topo_id} standing for its id; lines
+# are only ever drawn over that photo, and on a plain background when this is not set
+TOPO_PHOTO_URL = os.environ.get("TOPO_PHOTO_URL", "")
+
+
+def build_topo_store(db_path=TOPO_DB, store_dir=TOPO_STORE_DIR):
+    """Decode every topo line once and write them as packed arrays.
+
+    Lines are sorted by (problem_id, id). problem_start[p]:problem_start[p + 1]
+    are the rows of problem p's lines, offsets[row]:offsets[row + 1] the
+    points of a row, and coordinates an (n, 2) float32 buffer of normalized
+    x/y positions on the topo photo.
+    """
+    con = sqlite3.connect(db_path)
+    try:
+        rows = con.execute(
+            "SELECT id, problem_id, topo_id, coordinates FROM lines ORDER BY problem_id, id"
+        ).fetchall()
+    finally:
+        con.close()
+
+    problem_ids = np.array([row[1] for row in rows], dtype=np.int64)
+    points = [json.loads(row[3] or 'null') or [] for row in rows]
+    lengths = np.array([len(line) for line in points], dtype=np.int64)
+    arrays = {
+        'line_ids': np.array([row[0] for row in rows], dtype=np.int32),
+        'topo_ids': np.array([row[2] for row in rows], dtype=np.int32),
+        'problem_start': np.searchsorted(
+            problem_ids, np.arange((problem_ids.max() + 2) if len(rows) else 1)
+        ).astype(np.int32),
+        'offsets': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        'coordinates': np.array(
+            [(point['x'], point['y']) for line in points for point in line], dtype=np.float32
+        ).reshape(-1, 2),
+    }
+
+    os.makedirs(store_dir, exist_ok=True)
+    for name in TOPO_ARRAYS:
+        np.save(os.path.join(store_dir, f"{name}.npy"), arrays[name])
+    logger.info("Wrote %d topo lines (%d points) to %s", len(rows), len(arrays['coordinates']), store_dir)
+
+
+class TopoStore:
+    """Memory-mapped topo lines with O(1) lookup by problem id."""
+
+    def __init__(self, store_dir=TOPO_STORE_DIR):
+        for name in TOPO_ARRAYS:
+            setattr(self, name, np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.line_ids)
+
+    def lines(self, problem_id):
+        """Return [(topo_id, points)] for a problem, points being an (n, 2) float32 view."""
+        problem_id = int(problem_id)
+        if not 0 <= problem_id < len(self.problem_start) - 1:
+            return []
+        start, stop = self.problem_start[problem_id], self.problem_start[problem_id + 1]
+        return [
+            (int(self.topo_ids[row]), self.coordinates[self.offsets[row]:self.offsets[row + 1]])
+            for row in range(start, stop)
+        ]
+
+
+@st.cache_resource
+def get_topo_store():
+    """Open the topo line store once per process, or return None if it has not been built."""
+    if not os.path.exists(os.path.join(TOPO_STORE_DIR, "offsets.npy")):
+        logger.info("No topo line store in %s; run `python topo_store.py` to build it", TOPO_STORE_DIR)
+        return None
+    return TopoStore()
+
+
+def _polylines(lines):
+    return "".join(
+        f'<polyline points="{" ".join(f"{x:.4f},{y:.4f}" for x, y in points.tolist())}" fill="none" '
+        f'stroke="{TOPO_LINE_COLOR}" stroke-width="3" stroke-linecap="round" stroke-linejoin="round" '
+        'vector-effect="non-scaling-stroke"/>'
+        for topo_id, points in lines if len(points)
+    )
+
+
+def topo_photo_url(topo_id):
+    """URL of the Boolder topo photo with the given id, or None if TOPO_PHOTO_URL is not set."""
+    return TOPO_PHOTO_URL.format(topo_id=topo_id) if TOPO_PHOTO_URL else None
+
+
+def topo_svg(lines):
+    """Draw topo lines as an SVG overlay that stretches over their topo photo.
+
+    Points are normalized 0-1 coordinates on the Boolder topo photo the
+    lines were traced on, so only draw lines over that photo, never over
+    another one of the same boulder. The SVG uses a unit viewBox and is
+    positioned absolutely on top of the image.
+    """
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 1 1" preserveAspectRatio="none" '
+        'style="position: absolute; top: 0; left: 0; width: 100%; height: 100%; pointer-events: none;">'
+        f'{_polylines(lines)}</svg>'
+    )
+
+
+def first_topo_lines(lines):
+    """The lines traced on the first topo photo among `lines`, as (topo_id, points) pairs."""
+    return [line for line in lines if line[0] == lines[0][0]] if lines else []
+
+
+def topo_thumbnail_uri(lines, width=120, height=90, background="#f4f1ea"):
+    """Draw topo lines on a plain background as a data URI for st.column_config.ImageColumn.
+
+    Only the first topo's lines are drawn, since lines traced on different
+    photos do not share coordinates.
+    """
+    svg = (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 1 1" preserveAspectRatio="none" '
+        f'width="{width}" height="{height}"><rect width="1" height="1" fill="{background}"/>'
+        f'{_polylines(first_topo_lines(lines))}</svg>'
+    )
+    return "data:image/svg+xml;utf8," + quote(svg)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Decode the lines table into a packed topo line store.")
+    parser.add_argument("--db", default=TOPO_DB)
+    parser.add_argument("--out", default=TOPO_STORE_DIR)
+    args = parser.parse_args()
+    build_topo_store(args.db, args.out)
@@ -1,32 +1,107 @@
+import hashlib
+import re
 from datetime import datetime
 
 import pandas as pd
 import streamlit as st
 
 from grade_utils import grade_to_numeric, numeric_to_grade
-from media_fetcher import get_media_from_bleau_page
+from media_fetcher import get_media_batch
+from media_server import local_image_urls
+from metrics import timed
+from topo_store import get_topo_store, topo_thumbnail_uri
 
 
-def create_sidebar_filters(data):
-    """Create sidebar filters for the application."""
+# Keys of the fragments that show the project list; project edits rerun both and leave the map alone
+PROJECT_LIST_FRAGMENT = "project_list"
+TABLE_FRAGMENT = "table"
+
+# " (1,234)" route count that the sidebar appends to option labels
+COUNT_SUFFIX_RE = re.compile(r" \([\d,]+\)$")
+
+
+def _with_count(counts):
+    """format_func that shows how many routes each option would match."""
+    return lambda option: f"{option} ({counts.get(option, 0):,})"
+
+
+def _restore_state(key, default, options):
+    """Put a filter widget's current value back into session state, as plain options.
+
+    Widgets send back the label they showed, and labels carry route
+    counts; writing the value back before the widget is drawn keeps it
+    valid when the counts change. Values that are no longer options, or
+    still carry an old count, are mapped back or dropped.
+    """
+    value = st.session_state.get(key, default)
+    values = value if isinstance(value, list) else [value]
+    restored = [v if v in options else COUNT_SUFFIX_RE.sub("", str(v)) for v in values]
+    restored = [v for v in restored if v in options]
+    if isinstance(value, list):
+        st.session_state[key] = restored
+    else:
+        st.session_state[key] = restored[0] if restored else default
+    return st.session_state[key]
+
+
+def create_sidebar_filters(store):
+    """Create sidebar filters for the application.
+
+    Every option is labelled with the number of routes it would match
+    combined with the other current filters, from the store's facet counts.
+    """
+    options = store.filter_options()
     st.sidebar.image("boulder_logo.png", use_column_width=True)
     st.sidebar.header("🎯 Filter Routes")
 
+    # Name search, combined with the filters below
+    search_query = st.sidebar.text_input(
+        "🔍 Search by Name",
+        placeholder="e.g. Marie-Rose",
+        help="Accents and small typos are ignored",
+    )
+
+    # Current filter values, restored before any widget is drawn so the counts can use all of them
+    available_grades = options['grades']
+    steepness_options = options['steepness']
+    area_options = options['areas']
+    sit_start_options = ["All", "Sit Start Only", "Standing Start Only"]
+    min_popularity, max_popularity = options['popularity_range']
+    current = {
+        'selected_grade_range': (0, 34),
+        'selected_steepness': _restore_state('steepness', steepness_options, steepness_options),
+        'selected_areas': _restore_state('areas', [], area_options),
+        'sit_start_option': _restore_state('sit_start', "All", sit_start_options),
+        'selected_popularity': st.session_state.setdefault('popularity', (0, max_popularity)),
+    }
+    if available_grades:
+        min_grade = _restore_state('min_grade', '6a' if '6a' in available_grades else available_grades[0], available_grades)
+        max_grade = _restore_state('max_grade', '7c+' if '7c+' in available_grades else available_grades[-1], available_grades)
+        current['selected_grade_range'] = (grade_to_numeric(min_grade), grade_to_numeric(max_grade))
+    counts = store.facet_counts(current)
+
     # Grade filter - min/max selectboxes with actual grade strings
-    available_grades = sorted(data[data['grade'] != '']['grade'].unique(), key=grade_to_numeric)
     if available_grades:
+        per_grade = counts['grades']
+        low, high = current['selected_grade_range']
         col1, col2 = st.sidebar.columns(2)
         with col1:
             min_grade = st.selectbox(
                 "Min Grade", 
                 options=available_grades,
-                index=available_grades.index('6a') if '6a' in available_grades else 0
+                key='min_grade',
+                format_func=_with_count({
+                    grade: int(per_grade[grade_to_numeric(grade):high + 1].sum()) for grade in available_grades
+                }),
             )
         with col2:
             max_grade = st.selectbox(
                 "Max Grade", 
                 options=available_grades,
-                index=available_grades.index('7c+') if '7c+' in available_grades else len(available_grades)-1
+                key='max_grade',
+                format_func=_with_count({
+                    grade: int(per_grade[low:grade_to_numeric(grade) + 1].sum()) for grade in available_grades
+                }),
             )
         
         # Convert to numeric for filtering
@@ -35,48 +110,57 @@ def create_sidebar_filters(data):
         selected_grade_range = (0, 34)
 
     # Steepness filter
-    steepness_options = sorted(data['steepness'].unique())
-    selected_steepness = st.sidebar.multiselect("Steepness", steepness_options, default=steepness_options)
+    selected_steepness = st.sidebar.multiselect(
+        "Steepness", steepness_options, key='steepness', format_func=_with_count(counts['steepness'])
+    )
 
     # Area filter
-    area_options = sorted(data['area_name'].dropna().unique())
-    selected_areas = st.sidebar.multiselect("Area", area_options)
+    selected_areas = st.sidebar.multiselect(
+        "Area", area_options, key='areas', format_func=_with_count(counts['areas'])
+    )
 
     # Sit start filter
-    sit_start_option = st.sidebar.radio("Start Type", ["All", "Sit Start Only", "Standing Start Only"], index=0)
+    sit_start_option = st.sidebar.radio(
+        "Start Type", sit_start_options, key='sit_start', format_func=_with_count(counts['sit_start'])
+    )
 
     # Popularity filter
-    min_popularity, max_popularity = int(data['popularity'].min()), int(data['popularity'].max())
-    selected_popularity = st.sidebar.slider("Popularity Range", min_popularity, max_popularity, (0, max_popularity))
+    selected_popularity = st.sidebar.slider("Popularity Range", min_popularity, max_popularity, key='popularity')
+    st.sidebar.caption(f"{counts['total']:,} routes match these filters")
 
     # Map display options
     st.sidebar.header("🗺️ Map Options")
     show_areas = st.sidebar.checkbox("Show Areas", value=True, help="Display area boundaries and markers on the map")
+    show_trails = st.sidebar.checkbox("Show Trails", value=True, help="Display the hiking trails on the map")
+    viewport_only = st.sidebar.checkbox("Follow Map View", value=True, help="Only show routes inside the current map view")
 
     return {
+        'search_query': search_query.strip(),
         'selected_grade_range': selected_grade_range,
         'selected_steepness': selected_steepness,
         'selected_areas': selected_areas,
         'sit_start_option': sit_start_option,
         'selected_popularity': selected_popularity,
-        'show_areas': show_areas
+        'show_areas': show_areas,
+        'show_trails': show_trails,
+        'viewport_only': viewport_only,
     }
 
 
-def create_project_list_section(data):
-    """Create project list management section in sidebar."""
-    st.sidebar.header("📋 Project List")
+def create_project_list_section(store):
+    """Create project list management section; call it inside `with st.sidebar:`."""
+    st.header("📋 Project List")
     project_count = len(st.session_state.project_list)
-    st.sidebar.write(f"**{project_count} routes** in your project list")
+    st.write(f"**{project_count} routes** in your project list")
 
     if project_count > 0:
-        if st.sidebar.button("🗑️ Clear All Projects"):
+        if st.button("🗑️ Clear All Projects"):
             st.session_state.project_list.clear()
             st.rerun()
         
         # Export functionality
-        if st.sidebar.button("📤 Export Project List"):
-            project_routes = get_project_routes(data)
+        if st.button("📤 Export Project List"):
+            project_routes = get_project_routes(store)
             if not project_routes.empty:
                 # Check which columns are available
                 available_columns = ['name', 'grade', 'steepness', 'area_name']
@@ -105,7 +189,7 @@ def create_project_list_section(data):
                 csv = export_df.to_csv(index=False)
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                 
-                st.sidebar.download_button(
+                st.download_button(
                     label="📥 Download CSV",
                     data=csv,
                     file_name=f"fontainebleau_projects_{timestamp}.csv",
@@ -113,47 +197,50 @@ def create_project_list_section(data):
                 )
 
 
-def get_project_routes(data):
+def get_project_routes(store):
     """Get all routes that are in the project list."""
-    if not st.session_state.project_list:
-        return pd.DataFrame()
-    return data[data['bleau_info_id'].isin(st.session_state.project_list)]
+    return store.project_routes(st.session_state.project_list)
 
 
-def apply_filters(data, filters):
-    """Apply filters to the data."""
-    filtered_data = data.copy()
+@timed("apply_filters")
+def apply_filters(store, filters):
+    """Apply filters to the route store and return the matching routes.
 
-    # Filter by grade range
-    filtered_data = filtered_data[
-        (filtered_data['grade_numeric'] >= filters['selected_grade_range'][0]) &
-        (filtered_data['grade_numeric'] <= filters['selected_grade_range'][1])
-    ]
+    With a search query, only the best name matches among them are kept.
+    """
+    filtered_data = store.apply_filters(filters)
+    if filters.get('search_query'):
+        filtered_data = store.search(filtered_data, filters['search_query'])
+    return filtered_data
 
-    if filters['selected_steepness']:
-        filtered_data = filtered_data[filtered_data['steepness'].isin(filters['selected_steepness'])]
 
-    if filters['selected_areas']:
-        filtered_data = filtered_data[filtered_data['area_name'].isin(filters['selected_areas'])]
+def routes_in_view(store, routes, bounds):
+    """Restrict routes to the map bounds reported by st_folium, if any."""
+    try:
+        south_west, north_east = bounds['_southWest'], bounds['_northEast']
+        return store.routes_in_bounds(
+            routes, south_west['lat'], south_west['lng'], north_east['lat'], north_east['lng']
+        )
+    except (KeyError, TypeError):
+        # No map view reported yet
+        return routes
 
-    if filters['sit_start_option'] == "Sit Start Only":
-        filtered_data = filtered_data[filtered_data['sit_start'] == 1]
-    elif filters['sit_start_option'] == "Standing Start Only":
-        filtered_data = filtered_data[filtered_data['sit_start'] == 0]
 
-    if filters['selected_popularity']:
-        filtered_data = filtered_data[
-            (filtered_data['popularity'] >= filters['selected_popularity'][0]) &
-            (filtered_data['popularity'] <= filters['selected_popularity'][1])
-        ]
+def limit_to_viewport(store, filtered_data, bounds, budget):
+    """Restrict routes to the map bounds and keep at most `budget` of them.
 
-    return filtered_data
+    Returns the routes to render, most popular first when over budget, and
+    how many routes matched inside the bounds.
+    """
+    filtered_data = routes_in_view(store, filtered_data, bounds)
+    total = len(filtered_data)
+    if total > budget:
+        filtered_data = filtered_data.nlargest(budget, 'popularity')
+    return filtered_data, total
 
 
-def create_data_table(filtered_data, data):
-    """Create the data table with project management."""
-    # Combine filtered data with project routes (projects always shown)
-    project_routes = get_project_routes(data)
+def combine_with_projects(filtered_data, project_routes, project_list):
+    """Combine filtered routes with the project routes, which are always shown, marking each with is_project."""
     if not project_routes.empty:
         # Mark project routes
         project_routes = project_routes.copy()
@@ -161,63 +248,125 @@ def create_data_table(filtered_data, data):
         
         # Mark filtered routes
         filtered_data_marked = filtered_data.copy()
-        filtered_data_marked['is_project'] = filtered_data_marked['bleau_info_id'].isin(st.session_state.project_list)
+        filtered_data_marked['is_project'] = filtered_data_marked['bleau_info_id'].isin(project_list)
         
         # Combine: projects + filtered non-projects
-        combined_data = pd.concat([
+        return pd.concat([
             project_routes,
             filtered_data_marked[~filtered_data_marked['bleau_info_id'].isin(project_routes['bleau_info_id'])]
-        ]).drop_duplicates(subset=['bleau_info_id'])
-    else:
-        combined_data = filtered_data.copy()
-        combined_data['is_project'] = False
+        ]).drop_duplicates(subset=['id'])
+
+    combined_data = filtered_data.copy()
+    combined_data['is_project'] = False
+    return combined_data
+
+
+def route_link(row):
+    """bleau.info URL of a route, carrying its name for the LinkColumn display text."""
+    return f"https://bleau.info/{row['area_name'].lower()}/{row['bleau_info_id']}.html?route_name={row['name']}"
+
+
+def build_editor_frame(combined_data, media):
+    """Prepare the data editor's rows from combine_with_projects() output, projects first.
+
+    media maps bleau_info_id to (video_info, image_info), as returned by
+    get_media_batch; routes missing from it get no image.
+    """
+    # Prepare data for data_editor
+    editor_columns = ['name', 'grade', 'steepness', 'area_name', 'popularity', 'bleau_info_id', 'is_project']
+    combined_data = combined_data.copy()
+
+    # Draw each route's topo lines, if the topo line store has been built
+    topo_store = get_topo_store()
+    if topo_store is not None:
+        topo_lines = combined_data['id'].map(topo_store.lines)
+        combined_data['Topo'] = topo_lines.map(lambda lines: topo_thumbnail_uri(lines) if lines else None)
+        editor_columns.append('Topo')
+
+    editor_df = combined_data[editor_columns].copy()
+    editor_df = editor_df.sort_values(['is_project', 'popularity'], ascending=[False, False])
+    
+    # Add media columns
+    def create_image_column(row):
+        """Create image column with image if available."""
+        video_info, image_info = media.get(str(row['bleau_info_id']), (None, None))
+        if image_info:
+            return image_info['url']
+        return None
+    
+    # Create media column and replace route names with URLs for LinkColumn
+    editor_df['Image'] = editor_df.apply(create_image_column, axis=1)
+    
+    # Replace route names with URLs for LinkColumn functionality
+    editor_df['name'] = editor_df.apply(route_link, axis=1)
+    
+    # Rename columns for display
+    return editor_df.rename(columns={
+        'name': 'Route Name',
+        'grade': 'Grade',
+        'steepness': 'Steepness', 
+        'area_name': 'Area',
+        'popularity': 'Popularity',
+        'is_project': 'Project'
+    })
+
+
+def _project_editor_key(name, editor_df):
+    """Widget key of a project checkbox editor, new whenever its rows or their project flags change.
+
+    A keyed data editor keeps its edits while its rows keep their shape,
+    which would replay old checkbox edits onto different routes.
+    """
+    rows = editor_df['bleau_info_id'].astype(str) + ':' + editor_df['Project'].astype(str)
+    return f"{name}_{hashlib.md5(','.join(rows).encode('utf-8')).hexdigest()}"
+
+
+def _update_projects(editor_key, bleau_info_ids):
+    """on_change callback of the project checkboxes: apply the edits to the project list.
+
+    Reruns the project list and table fragments together, so the sidebar
+    count and export follow the table while the map is left alone.
+    """
+    projects = set(st.session_state.project_list)
+    for position, changes in st.session_state[editor_key]['edited_rows'].items():
+        if 'Project' in changes:
+            bleau_info_id = bleau_info_ids.iloc[int(position)]
+            if changes['Project']:
+                projects.add(bleau_info_id)
+            else:
+                projects.discard(bleau_info_id)
+    st.session_state.project_list = projects
+    st.rerun([PROJECT_LIST_FRAGMENT, TABLE_FRAGMENT])
+
+
+@timed("create_data_table")
+def create_data_table(filtered_data, store):
+    """Create the data table with project management.
+
+    Must run inside the TABLE_FRAGMENT fragment; see _update_projects.
+    """
+    # Combine filtered data with project routes (projects always shown)
+    project_routes = get_project_routes(store)
+    combined_data = combine_with_projects(filtered_data, project_routes, st.session_state.project_list)
 
     st.header(f"Found {len(filtered_data)} routes" + (f" + {len(project_routes)} projects" if not project_routes.empty else ""))
 
     if not combined_data.empty:
-        # Prepare data for data_editor
-        editor_df = combined_data[['name', 'grade', 'steepness', 'area_name', 'popularity', 'bleau_info_id', 'is_project']].copy()
-        editor_df = editor_df.sort_values(['is_project', 'popularity'], ascending=[False, False])
-        
-        # Add route links to Route Name column and media columns
-        def create_route_link(row):
-            route_link = f"https://bleau.info/{row['area_name'].lower()}/{row['bleau_info_id']}.html?route_name={row['name']}"
-            return route_link
-        
-        def create_image_column(row):
-            """Create image column with image if available (only for ≤100 total routes)."""
-            total_routes = len(combined_data)
-            if total_routes > 100:
-                return None
-            
-            try:
-                video_info, image_info = get_media_from_bleau_page(row['area_name'], row['bleau_info_id'])
-                
-                if image_info:
-                    return image_info['url']
-                
-                return None
-            except Exception as e:
-                return None
-        
-        # Create media column and replace route names with URLs for LinkColumn
-        editor_df['Image'] = editor_df.apply(create_image_column, axis=1)
-        
-        # Replace route names with URLs for LinkColumn functionality
-        editor_df['name'] = editor_df.apply(create_route_link, axis=1)
-        
-        # Rename columns for display
-        editor_df = editor_df.rename(columns={
-            'name': 'Route Name',
-            'grade': 'Grade',
-            'steepness': 'Steepness', 
-            'area_name': 'Area',
-            'popularity': 'Popularity',
-            'is_project': 'Project'
-        })
+        # Resolve media for all rows in one batch (only for ≤100 total routes)
+        media = {}
+        if len(combined_data) <= 100:
+            media = get_media_batch(zip(combined_data['area_name'], combined_data['bleau_info_id']))
+            # Show cached thumbnails instead of the full-size photos where they are ready
+            shown = local_image_urls([image['url'] for video, image in media.values() if image])
+            media = {
+                bleau_info_id: (video, {**image, 'url': shown[image['url']]} if image else None)
+                for bleau_info_id, (video, image) in media.items()
+            }
+        editor_df = build_editor_frame(combined_data, media)
         
         # Create data editor with checkbox for projects
-        edited_df = st.data_editor(
+        editor_key = _project_editor_key("projects", editor_df)
+        st.data_editor(
             editor_df,
             column_config={
                 "Project": st.column_config.CheckboxColumn(
@@ -251,32 +400,76 @@ def create_data_table(filtered_data, data):
                     "📸 Image",
                     help="Route image from bleau.info",
                 ),
+                "Topo": st.column_config.ImageColumn(
+                    "〰️ Topo",
+                    help="Route line on its topo photo",
+                ),
             },
             hide_index=True,
             use_container_width=True,
+            key=editor_key,
+            on_change=_update_projects,
+            args=(editor_key, editor_df['bleau_info_id']),
         )
-        
-        # Update project list based on checkbox changes
-        if edited_df is not None:
-            # Get current project status from edited dataframe
-            current_projects = set(edited_df[edited_df['Project'] == True]['bleau_info_id'].tolist())
-            
-            # Update session state if there are changes
-            if current_projects != st.session_state.project_list:
-                st.session_state.project_list = current_projects
-                st.rerun()
 
     else:
         st.write("No routes found matching your criteria.")
 
 
-def show_too_many_routes_message(filtered_data):
-    """Show message when too many routes are selected."""
+@timed("similar_routes")
+def create_similar_routes_section(store):
+    """Suggest routes like the ones in the project list, with a checkbox to add each.
+
+    Must run in the same fragment as create_data_table, so it follows
+    project edits made in the table.
+    """
+    if not st.session_state.project_list:
+        return
+    similar = store.similar_routes(st.session_state.project_list)
+    if similar.empty:
+        return
+
+    st.subheader("🧭 Similar Problems")
+    st.caption("Closest to your projects in grade, steepness, sit start, circuit, popularity and location.")
+    similar_df = similar[['name', 'grade', 'steepness', 'area_name', 'popularity', 'bleau_info_id']].copy()
+    similar_df['name'] = similar_df.apply(route_link, axis=1)
+    similar_df['is_project'] = False
+    similar_df = similar_df.rename(columns={
+        'name': 'Route Name', 'grade': 'Grade', 'steepness': 'Steepness', 'area_name': 'Area',
+        'popularity': 'Popularity', 'is_project': 'Project',
+    })
+    editor_key = _project_editor_key("similar", similar_df)
+    st.data_editor(
+        similar_df,
+        column_config={
+            "Project": st.column_config.CheckboxColumn("📋 Project", help="Add to your **project list**"),
+            "Route Name": st.column_config.LinkColumn(
+                "Route Name",
+                help="Click to view on bleau.info",
+                display_text=r"https:\/\/bleau\.info\/.*?\?route_name=([^&]*)",
+            ),
+            "bleau_info_id": None,
+        },
+        disabled=['Route Name', 'Grade', 'Steepness', 'Area', 'Popularity'],
+        hide_index=True,
+        use_container_width=True,
+        key=editor_key,
+        on_change=_update_projects,
+        args=(editor_key, similar_df['bleau_info_id']),
+    )
+
+
+def show_too_many_routes_message(store, filters, max_routes=100):
+    """Show message when too many routes are selected.
+
+    The statistics come from the store's facet counts, not from the rows.
+    """
+    summary = store.facet_summary(filters)
     st.header("🗺️ Map & Table")
     st.info(f"""
-    📍 **{len(filtered_data)} routes found** - too many to display efficiently!
+    📍 **{summary['count']} routes found** - too many to display efficiently!
     
-    **Please filter down to 100 or fewer routes** to see:
+    **Please filter down to {max_routes} or fewer routes** to see:
     - 🗺️ Interactive map with route locations
     - 📊 Detailed table with project management
     - 🔗 Direct links to bleau.info pages
@@ -293,14 +486,13 @@ def show_too_many_routes_message(filtered_data):
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        st.metric("Total Routes", len(filtered_data))
+        st.metric("Total Routes", summary['count'])
     with col2:
-        avg_grade = filtered_data['grade_numeric'].mean()
-        avg_grade_text = numeric_to_grade(int(avg_grade)) if not pd.isna(avg_grade) else "N/A"
+        avg_grade = summary['mean_grade']
+        avg_grade_text = numeric_to_grade(int(avg_grade)) if avg_grade is not None else "N/A"
         st.metric("Average Grade", avg_grade_text)
     with col3:
-        avg_popularity = filtered_data['popularity'].mean()
+        avg_popularity = summary['mean_popularity'] or 0
         st.metric("Avg Popularity", f"{avg_popularity:.1f}")
     with col4:
-        unique_areas = filtered_data['area_name'].nunique()
-        st.metric("Areas", unique_areas) 
\ No newline at end of file
+        st.metric("Areas", summary['areas'])